@@ -1,13 +1,16 @@
-from neuron import h, gui
+from neuron import h
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
-import matplotlib.animation as animation
-from matplotlib.animation import FuncAnimation  
+
+from script_options import script_options
+from neuron_record import run_clamp, clamp_starts, use_rate_tables
+from phase_timers import enable, phase, end_sweep, end_run
+from peak_analysis import measure_peaks
+from trace_decimation import decimate_trace
 
 dtype = np.float64
 
+options = script_options('1_V_G_relation_dynamic_timings.jsonl')   # see script_options.py
+
 # one-compartment cell (soma)
 soma        = h.Section(name='soma')
 soma.diam   = 50        # micron
@@ -17,14 +20,24 @@ soma.cm     = 1         # uF/cm2
 soma.Ra     = 70        # ohm-cm
 
 soma.nseg   = 1
-soma.insert('na15')     # insert mechanism
+mechanism   = options.mechanism    # 'na15' (Na15.mod) or 'na15k' (Na15k.mod, --kinetic)
+soma.insert(mechanism) # insert mechanism
+use_rate_tables(options.rate_tables)   # tabulated rates (--rate-tables), off by default
 soma.ena    = 65
 h.celsius   = 24        # temperature in celsius
 v_init      = -120      # holding potential
 h.dt        = 0.01      # ms - value of the fundamental integration time step, dt, used by fadvance().
+cvode       = options.cvode        # CVODE atol (--cvode [ATOL]), None: fixed time step
+record_mode = True      # True: time loop inside NEURON (Vector.record), False: fadvance() loop
+ss_tol      = options.ss_tol       # levels on which na15 settles are jumped over (--ss-tol [TOL])
+ideal       = options.ideal        # True (--ideal) or 'check' (--ideal-check): see run_clamp
+plot_points = 2000      # traces plotted as min/max envelopes over this many bins (None: all)
+headless    = options.headless     # True (--headless): no NEURON GUI, no matplotlib, no figure
+timings     = options.timings      # phase timer report (--timings [report.jsonl]), None: off
 
 # clamping parameters
 dur         = 20        # clamp duration, ms
+windows     = [(1, 0, 5)]  # (level, start, end), ms from the level start
 step        = 2         # voltage clamp increment, mV
 st_cl       = -90       # clamp start, mV
 end_cl      = 11        # clamp end, mV
@@ -42,7 +55,10 @@ ipeak_vec = h.Vector() # vector for peak current
 
 
 # a two-electrodes voltage clamp
-f3cl = h.VClamp(soma(0.5))
+f3cl = h.VClamp_cvode(soma(0.5)) if cvode else h.VClamp(soma(0.5))   # VClamp does not work with CVODE
+if cvode:
+    h.CVode().active(1)
+    h.CVode().atol(cvode)
 f3cl.dur[0]=5	    # ms
 f3cl.amp[0]=-120	# mV
 f3cl.dur[1]=dur     # ms
@@ -58,20 +74,27 @@ print('Initial values [C1, C2, O1, I1, I2]=  ', initial_values)
 
 
 for seg in soma:
-    seg.na15.iC1=initial_values[0]
-    seg.na15.iC2=initial_values[1]
-    seg.na15.iO1=initial_values[2]
-    seg.na15.iI1=initial_values[3]
-    seg.na15.iI2=initial_values[4]
-
-
-# figures definition
-fig, ax = plt.subplots(1,3,figsize=(18,4))  
-ln0, = ax[0].plot([], [], '-')
-ln1, = ax[1].plot([], [], '-')
-ln2, = ax[2].plot([], [], '-')
-fig.subplots_adjust(wspace=0.5)
-fig.suptitle('1. Voltage-Normalized conductance relation', fontsize=15, fontweight='bold')
+    getattr(seg, mechanism).iC1=initial_values[0]
+    getattr(seg, mechanism).iC2=initial_values[1]
+    getattr(seg, mechanism).iO1=initial_values[2]
+    getattr(seg, mechanism).iI1=initial_values[3]
+    getattr(seg, mechanism).iI2=initial_values[4]
+
+
+# figures definition (not in headless mode: the NEURON GUI and matplotlib are only imported here)
+if not headless:
+    from neuron import gui
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    import matplotlib.cm as cmx
+    import matplotlib.animation as animation
+    from matplotlib.animation import FuncAnimation
+    fig, ax = plt.subplots(1,3,figsize=(18,4))  
+    ln0, = ax[0].plot([], [], '-')
+    ln1, = ax[1].plot([], [], '-')
+    ln2, = ax[2].plot([], [], '-')
+    fig.subplots_adjust(wspace=0.5)
+    fig.suptitle('1. Voltage-Normalized conductance relation', fontsize=15, fontweight='bold')
 
 def init():
 
@@ -98,10 +121,11 @@ def init():
     return ln0, ln1, ln2, 
 
 #to plot in rainbow colors
-values=range(L)
-rbw = cm = plt.get_cmap('rainbow') 
-cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
-scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
+if not headless:
+    values=range(L)
+    rbw = cm = plt.get_cmap('rainbow') 
+    cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
+    scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
 
 # animation definition
 def animate(frame):
@@ -115,52 +139,40 @@ def animate(frame):
 
         clamp(v_cl2)
 
-        colorVal1 = scalarMap.to_rgba(values[int(frame)])
+        with phase('plot'):
+            colorVal1 = scalarMap.to_rgba(values[int(frame)])
 
-        colorVal2 = scalarMap.to_rgba(values[0:int(frame)+2])
+            colorVal2 = scalarMap.to_rgba(values[0:int(frame)+2])
         
-        ln0,=ax[0].plot(t_vec, v_vec_t,color=colorVal1)
-        ln1,=ax[1].plot(t_vec, i_vec,color=colorVal1)
+            ln0,=ax[0].plot(t_vec, v_vec_t,color=colorVal1)
+            ln1,=ax[1].plot(t_vec, i_vec,color=colorVal1)
 
 
-        ln2=ax[2].scatter(v_vec, ipeak_vec, c=colorVal2)
+            ln2=ax[2].scatter(v_vec, ipeak_vec, c=colorVal2)
+        end_sweep(frame=int(frame))
         return ln0, ln1, ln2
 
 # clamping definition
 def clamp(v_cl):
     """Data from a single voltage clamp trace"""
-    
-    curr_tr = 0  # initialization of peak current
-    cond_tr = 0  # initialization of peak conductance
 
-    h.finitialize(v_init)
-    
-    # variables initialization
-    pre_i = 0      
-    dens = 0
-    t_peak = 0
-    
     f3cl.dur[1]=dur     # ms
     f3cl.amp[1]=v_cl    # mV
-    
-
 
-    while (h.t<h.tstop): # runs a single trace, calculates peak current
-        dens = f3cl.i/soma(0.5).area()*100.0-soma(0.5).i_cap # clamping current in mA/cm2, for each dt
-        
-        t_vec.append(h.t)       # code for store the current
-        v_vec_t.append(soma.v)  # to plot voltage as function of time
-        i_vec.append(dens)      # trace to be plotted
+    # runs a single trace: time, voltage, current density (mA/cm2) and conductance, for each dt
+    t, v, dens, g = run_clamp(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)
 
+    with phase('decimate'):
+        keep = decimate_trace(t, v, dens, plot_points, clamp_starts(f3cl), windows)    # samples to plot
+        t_vec.from_python(t[keep])        # code for store the current
+        v_vec_t.from_python(v[keep])      # to plot voltage as function of time
+        i_vec.from_python(dens[keep])     # trace to be plotted
 
-        if ((h.t>5)and(h.t<=10)):       # evaluate the peak
-            if(abs(dens)>abs(pre_i)):
-                cond_tr = soma.g_na15   # updates the peak conductance
-                curr_tr = dens          # updates the peak current
-                t_peak = h.t
-                
-        h.fadvance()
-        pre_i = dens
+    with phase('peaks'):
+        peaks = measure_peaks(t, dens, clamp_starts(f3cl), windows, g)   # evaluate the peak
+    cond_tr = peaks['gpeak'][0] # peak conductance
+    curr_tr = peaks['ipeak'][0] # peak current
+    t_peak = peaks['tpeak'][0]
 
     if len(v_vec) > L-1:   # resizing vectors when the protocol is completed (it is needed for looping the animation)
         v_vec.resize(0) 
@@ -172,16 +184,30 @@ def clamp(v_cl):
 
 def start():
 
+    if timings:
+        enable(timings, title='1. Voltage-Normalized conductance relation')
+
     h.tstop = 5 + dur + 5       # time stop
 
     v_vec.resize(0)
     ipeak_vec.resize(0)
 
+    if headless:    # no animation: one pass over the sweep, the curve is printed
+        for v_cl in np.arange(st_cl, end_cl, step):
+            clamp(v_cl)
+            end_sweep(voltage=v_cl)
+        with phase('print'):
+            for x, y in zip(v_vec, ipeak_vec):
+                print('Voltage:   ', x, 'mV', ',   Peak current density:   ', y)
+        end_run()
+        return
+
     # animation  
     ani = animation.FuncAnimation(fig, animate, frames=L,
                      init_func=init, blit=True, interval=500, repeat=True)
     
     plt.show()
+    end_run()
 
 
 
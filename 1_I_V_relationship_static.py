@@ -1,11 +1,21 @@
-from neuron import h, gui
+import shutil
+import tempfile
+
+from neuron import h
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
+
+from script_options import script_options
+from neuron_record import run_clamp, clamp_starts, use_rate_tables
+from phase_timers import enable, phase, end_sweep, end_run
+from sweep_pool import run_sweeps, cell_settings
+from result_bundle import create_bundle, append_columns, append_trace, iter_traces
+from peak_analysis import measure_peaks
+from trace_decimation import decimate_trace
 
 dtype = np.float64
 
+options = script_options('1_V_G_relation_timings.jsonl')   # see script_options.py
+
 # one-compartment cell (soma)
 soma        = h.Section(name='soma')
 soma.diam   = 50        # micron
@@ -15,14 +25,26 @@ soma.cm     = 1         # uF/cm2
 soma.Ra     = 70        # ohm-cm
 
 soma.nseg   = 1
-soma.insert('na15')     #insert mechanism
+mechanism   = options.mechanism    # 'na15' (Na15.mod) or 'na15k' (Na15k.mod, --kinetic)
+soma.insert(mechanism) # insert mechanism
+use_rate_tables(options.rate_tables)   # tabulated rates (--rate-tables), off by default
 soma.ena    = 65
 h.celsius   = 24        # temperature in celsius
 v_init      = -120      # holding potential
 h.dt        = 0.01      # ms - value of the fundamental integration time step, dt, used by fadvance().
+cvode       = options.cvode        # CVODE atol (--cvode [ATOL]), None: fixed time step
+record_mode = True      # True: time loop inside NEURON (Vector.record), False: fadvance() loop
+ss_tol      = options.ss_tol       # levels on which na15 settles are jumped over (--ss-tol [TOL])
+ideal       = options.ideal        # True (--ideal) or 'check' (--ideal-check): see run_clamp
+processes   = 1         # processes running the sweeps in parallel (1: one after the other)
+plot_points = 2000      # traces plotted as min/max envelopes over this many bins (None: all)
+save_traces = False     # True: the full trace of every sweep is also saved in the result bundle
+headless    = options.headless     # True (--headless): no NEURON GUI, no matplotlib, no figure
+timings     = options.timings      # phase timer report (--timings [report.jsonl]), None: off
 
 # clamping parameters
 dur         = 20        # clamp duration, ms
+windows     = [(1, 0, 5)]  # (level, start, end), ms from the level start
 step        = 2         # voltage clamp increment, the user can 
 st_cl       = -90       # clamp start, mV
 end_cl      = 11        # clamp end, mV
@@ -40,6 +62,9 @@ ipeak_vec   = h.Vector()  # vector for peak current
 gpeak_vec   = h.Vector()  # vector for peak conductance
 gnorm_vec   = h.Vector()  # vector for normalized conductance
 
+# binary result bundle: curve, run metadata and optionally the traces (see result_bundle.py)
+bundle      = '1_V_G_relation_results'
+
 # saving data (comment the following 4 lines if you don't want to save the data)
 f1          = open('1_V_G_relation_v_vec.dat', 'w')
 f2          = open('1_V_G_relation_norm_conductance.dat', 'w')
@@ -48,7 +73,10 @@ f2.write("normalized conductance=[\n")
 
 
 # a two-electrodes voltage clamp
-f3cl = h.VClamp(soma(0.5))
+f3cl = h.VClamp_cvode(soma(0.5)) if cvode else h.VClamp(soma(0.5))   # VClamp does not work with CVODE
+if cvode:
+    h.CVode().active(1)
+    h.CVode().atol(cvode)
 f3cl.dur[0] = 5	      # ms
 f3cl.amp[0] = -120	  # mV
 f3cl.dur[1] = dur     # ms
@@ -64,83 +92,85 @@ print('Initial values [C1, C2, O1, I1, I2]=  ', initial_values)
 
 
 for seg in soma:
-    seg.na15.iC1=initial_values[0]
-    seg.na15.iC2=initial_values[1]
-    seg.na15.iO1=initial_values[2]
-    seg.na15.iI1=initial_values[3]
-    seg.na15.iI2=initial_values[4]
-
-# figure definition
-fig, ax     = plt.subplots(1, 3,figsize=(18,6))  
-fig.suptitle('1. Voltage-Normalized conductance relation', fontsize=15, fontweight='bold')
-fig.subplots_adjust(wspace=0.5)
-
-ax[0].set_xlim(0,30)
-ax[0].set_ylim(-121,20)
-ax[0].set_xlabel('Time $(ms)$')
-ax[0].set_ylabel('Voltage $(mV)$')
-ax[0].set_title('Time/Voltage relation')
-
-ax[1].set_xlim(0,30)
-ax[1].set_ylim(-1.5,0.5)
-ax[1].set_xlabel('Time $(ms)$')
-ax[1].set_ylabel('Current density $(mA/cm^2)$')
-ax[1].set_title('Time/Current density relation')
-
-ax[2].set_xlim(-100,20)
-ax[2].set_ylim(-0.05,1.05)        
-ax[2].set_xlabel('Voltage $(mV)$')
-ax[2].set_ylabel('Normalized conductance')
-ax[2].set_title('Voltage/Normalized conductance')
-
-# to plot in rainbow colors
-values      = range(L)
-rbw         = cm = plt.get_cmap('rainbow') 
-cNorm       = colors.Normalize(vmin=0, vmax=values[-1])
-scalarMap   = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
+    getattr(seg, mechanism).iC1=initial_values[0]
+    getattr(seg, mechanism).iC2=initial_values[1]
+    getattr(seg, mechanism).iO1=initial_values[2]
+    getattr(seg, mechanism).iI1=initial_values[3]
+    getattr(seg, mechanism).iI2=initial_values[4]
+
+# figure definition (not in headless mode: the NEURON GUI and matplotlib are only imported here)
+if not headless:
+    from neuron import gui
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    import matplotlib.cm as cmx
+    fig, ax     = plt.subplots(1, 3,figsize=(18,6))  
+    fig.suptitle('1. Voltage-Normalized conductance relation', fontsize=15, fontweight='bold')
+    fig.subplots_adjust(wspace=0.5)
+
+    ax[0].set_xlim(0,30)
+    ax[0].set_ylim(-121,20)
+    ax[0].set_xlabel('Time $(ms)$')
+    ax[0].set_ylabel('Voltage $(mV)$')
+    ax[0].set_title('Time/Voltage relation')
+
+    ax[1].set_xlim(0,30)
+    ax[1].set_ylim(-1.5,0.5)
+    ax[1].set_xlabel('Time $(ms)$')
+    ax[1].set_ylabel('Current density $(mA/cm^2)$')
+    ax[1].set_title('Time/Current density relation')
+
+    ax[2].set_xlim(-100,20)
+    ax[2].set_ylim(-0.05,1.05)        
+    ax[2].set_xlabel('Voltage $(mV)$')
+    ax[2].set_ylabel('Normalized conductance')
+    ax[2].set_title('Voltage/Normalized conductance')
+
+    # to plot in rainbow colors
+    values      = range(L)
+    rbw         = cm = plt.get_cmap('rainbow') 
+    cNorm       = colors.Normalize(vmin=0, vmax=values[-1])
+    scalarMap   = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
 
 # clamping definition
-def clamp(v_cl):
-    
-    curr_tr = 0  # initialization of peak current
-    cond_tr = 0  # initialization of peak conductance
-
-    h.finitialize(v_init) # calling the INITIAL block of the mechanism inserted in the section.
-
-    # initialization of variables used to commute the peak current and conductance    
-    pre_i  = 0     
-    dens   = 0
+def clamp(v_cl, peaks=None, trace=None):   # peaks and trace (dict t, v, dens, g, or None) from run_sweeps
 
     f3cl.amp[1] = v_cl    # mV
-    
-
-
-    while (h.t<h.tstop): # runs a single trace, calculates peak current
-        dens = f3cl.i/soma(0.5).area()*100.0-soma(0.5).i_cap # clamping current in mA/cm2, for each dt
-        
-        t_vec.append(h.t)       # code for storing the current
-        v_vec_t.append(soma.v)  # trace to be plotted
-        i_vec.append(dens)      # trace to be plotted
-
-        if ((h.t>5)and(h.t<=10)):       # evaluate the peak 
-            if(abs(dens)>abs(pre_i)):
-                cond_tr = soma.g_na15   # updates the peak conductance
-                curr_tr = dens          # updates the peak current
 
-                
-        h.fadvance()
-        pre_i = dens
+    if peaks is None:
+        # runs a single trace: time, voltage, current density (mA/cm2) and conductance, for each dt
+        t, v, dens, g = run_clamp(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)
+        trace = dict(t=t, v=v, dens=dens, g=g)
+        if save_traces:
+            with phase('bundle'):
+                append_trace(bundle, t, v, dens, g)
+        with phase('peaks'):
+            peaks = measure_peaks(t, dens, clamp_starts(f3cl), windows, g)   # evaluate the peak
+
+    if trace is not None:     # to be plotted
+        t, v, dens = trace['t'], trace['v'], trace['dens']
+        with phase('decimate'):
+            keep = decimate_trace(t, v, dens, plot_points, clamp_starts(f3cl), windows)    # samples to plot
+            t_vec.from_python(t[keep])        # code for storing the current
+            v_vec_t.from_python(v[keep])      # trace to be plotted
+            i_vec.from_python(dens[keep])     # trace to be plotted
 
     # updates the vectors at the end of the run        
     v_vec.append(v_cl)              
-    gpeak_vec.append(cond_tr)
-    ipeak_vec.append(curr_tr)
+    gpeak_vec.append(peaks['gpeak'][0])    # peak conductance
+    ipeak_vec.append(peaks['ipeak'][0])    # peak current
 
 
 ### start program
 
 def start():
 
+    if timings:
+        enable(timings, title='1. Voltage-Normalized conductance relation')
+
+    create_bundle(bundle, dict(title='1. Voltage-Normalized conductance relation', windows=windows, sweep='voltage',
+                               **cell_settings(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)))
+
     h.tstop = 5 + dur + 5       # time stop
 
     # resizing the vectors
@@ -149,6 +179,18 @@ def start():
     ipeak_vec.resize(0)
 
     k=0     # counter
+    # with processes > 1 the sweeps are run first, in parallel, and then plotted in order: the workers
+    # measure the peaks and stream the traces into the bundle (save_traces) or, to be plotted, decimated
+    # into a temporary bundle, read back one sweep at a time
+    plots = None
+    if processes > 1 and (save_traces or not headless):
+        plots = bundle if save_traces else create_bundle(tempfile.mkdtemp())
+    with phase('run_sweeps'):
+        results = run_sweeps(f3cl, soma(0.5), v_init, ('amp', 1), np.arange(st_cl, end_cl, step), processes,
+                             record_mode, ss_tol, ideal=ideal, windows=windows, bundle=plots,
+                             trace_points=None if save_traces else plot_points) if processes > 1 else None
+    traces = iter_traces(plots) if plots else None
+
     for v_cl in np.arange(st_cl, end_cl, step): # iterates across voltages
 
             # resizing the vectors
@@ -158,39 +200,55 @@ def start():
 
             print('Voltage Clamp:    ', v_cl,'mV')
 
-            clamp(v_cl)
-            colorVal1 = scalarMap.to_rgba(v_cl-st_cl-k*(step-1)) # rainbow printing setting
+            clamp(v_cl, None if results is None else results[k], traces and next(traces))
             k=k+1
 
-            ln0,=ax[0].plot(t_vec, v_vec_t,color=colorVal1)
-            ln1,=ax[1].plot(t_vec, i_vec,color=colorVal1)
+            if not headless:
+                with phase('plot'):
+                    colorVal1 = scalarMap.to_rgba(v_cl-st_cl-(k-1)*(step-1)) # rainbow printing setting
+                    ln0,=ax[0].plot(t_vec, v_vec_t,color=colorVal1)
+                    ln1,=ax[1].plot(t_vec, i_vec,color=colorVal1)
+            end_sweep(voltage=v_cl)
             
  
     gpeak_max = gpeak_vec.max()           # maximum value of the conductance used to normalize the conductance vector
     for i in range(0, len(gpeak_vec), 1):
 
-         colorVal2 = scalarMap.to_rgba(i) # rainbow printing setting
-
          gnorm_vec.append(gpeak_vec.x[i]/gpeak_max) # normalization of peak conductance
-         ln2,=ax[2].plot(v_vec.x[i], gnorm_vec.x[i], 'o', c=colorVal2)
+         if not headless:
+             with phase('plot'):
+                 colorVal2 = scalarMap.to_rgba(i) # rainbow printing setting
+                 ln2,=ax[2].plot(v_vec.x[i], gnorm_vec.x[i], 'o', c=colorVal2)
 
          # printing and saving data (comment the following line if you don't want to print the data)
-         print('Voltage:   ', v_vec.x[i],'mV', ',   Normalized conductance:   ', gnorm_vec.x[i] )
-         # comment the following 2 lines if you don't want to save the data)
-         f1.write("%s ,\n" % v_vec.x[i])        
-         f2.write("%s ,\n" % gnorm_vec.x[i])            
-
-    #saving the figure (comment the following line if you don't want to save the figure)   
-    plt.savefig('1. Voltage-Normalized conductance relation', format='pdf', dpi=300, orientation='portrait')    
-
-
-    # comment the following 4 lines if you don't want to save the data
-    f1.write("];")
-    f2.write("];")
-    f1.close()
-    f2.close()
-
-    plt.show()
+         with phase('dat'):
+             print('Voltage:   ', v_vec.x[i],'mV', ',   Normalized conductance:   ', gnorm_vec.x[i] )
+             # comment the following 2 lines if you don't want to save the data)
+             f1.write("%s ,\n" % v_vec.x[i])        
+             f2.write("%s ,\n" % gnorm_vec.x[i])            
+
+    with phase('bundle'):
+        append_columns(bundle, voltage=v_vec.as_numpy(), normalized_conductance=gnorm_vec.as_numpy(),
+                       gpeak=gpeak_vec.as_numpy(), ipeak=ipeak_vec.as_numpy())
+
+    #saving the figure (comment the following 3 lines if you don't want to save the figure)   
+    if not headless:
+        with phase('savefig'):
+            plt.savefig('1. Voltage-Normalized conductance relation', format='pdf', dpi=300, orientation='portrait')    
+
+
+    # comment the following 5 lines if you don't want to save the data
+    with phase('dat'):
+        f1.write("];")
+        f2.write("];")
+        f1.close()
+        f2.close()
+    if plots and plots != bundle:
+        shutil.rmtree(plots, ignore_errors=True)
+    end_run()
+
+    if not headless:
+        plt.show()
 
 
 start()
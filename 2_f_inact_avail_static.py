@@ -1,11 +1,21 @@
-from neuron import h, gui
+import shutil
+import tempfile
+
+from neuron import h
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
+
+from script_options import script_options
+from neuron_record import run_clamp, clamp_starts, use_rate_tables
+from phase_timers import enable, phase, end_sweep, end_run
+from sweep_pool import run_sweeps, cell_settings
+from result_bundle import create_bundle, append_columns, append_trace, iter_traces
+from peak_analysis import measure_peaks
+from trace_decimation import decimate_trace
 
 dtype = np.float64
 
+options = script_options('2_f_inact_timings.jsonl')   # see script_options.py
+
 # one-compartment cell (soma)
 soma        = h.Section(name='soma')
 soma.diam   = 50         # micron
@@ -15,14 +25,26 @@ soma.cm     = 1          # uF/cm2
 soma.Ra     = 70         # ohm-cm
 
 soma.nseg   = 1
-soma.insert('na15')      # insert mechanism
+mechanism   = options.mechanism    # 'na15' (Na15.mod) or 'na15k' (Na15k.mod, --kinetic)
+soma.insert(mechanism) # insert mechanism
+use_rate_tables(options.rate_tables)   # tabulated rates (--rate-tables), off by default
 soma.ena    = 65
 h.celsius   = 24         # temperature in celsius
 v_init      = -120       # holding potential   
 h.dt        = 0.01       # ms - value of the fundamental integration time step, dt, used by fadvance().
+cvode       = options.cvode        # CVODE atol (--cvode [ATOL]), None: fixed time step
+record_mode = True      # True: time loop inside NEURON (Vector.record), False: fadvance() loop
+ss_tol      = options.ss_tol       # levels on which na15 settles are jumped over (--ss-tol [TOL])
+ideal       = options.ideal        # True (--ideal) or 'check' (--ideal-check): see run_clamp
+processes   = 1         # processes running the sweeps in parallel (1: one after the other)
+plot_points = 2000      # traces plotted as min/max envelopes over this many bins (None: all)
+save_traces = False     # True: the full trace of every sweep is also saved in the result bundle
+headless    = options.headless     # True (--headless): no NEURON GUI, no matplotlib, no figure
+timings     = options.timings      # phase timer report (--timings [report.jsonl]), None: off
 
 # clamping parameters
 dur         = 500        # clamp duration, ms
+windows     = [(2, 0, 2)]  # (level, start, end), ms from the level start
 step        = 3          # voltage clamp increment
 st_cl       = -120       # clamp start, mV
 end_cl      = 1          # clamp end, mV
@@ -39,6 +61,9 @@ i_vec       = h.Vector() # vector for current
 ipeak_vec   = h.Vector() # vector for peak current
 inorm_vec   = h.Vector() # vector for normalized current
 
+# binary result bundle: curve, run metadata and optionally the traces (see result_bundle.py)
+bundle      = '2_f_inact_results'
+
 # saving data (comment the following 4 lines if you don't want to save the data)
 f1 = open('2_f_inact_v_vec.dat', 'w')
 f2 = open('2_f_inact_inorm_vec.dat', 'w')
@@ -47,7 +72,10 @@ f2.write("normalized_current=[\n")
 
 
 # a two-electrodes voltage clamp
-f3cl = h.VClamp(soma(0.5))
+f3cl = h.VClamp_cvode(soma(0.5)) if cvode else h.VClamp(soma(0.5))   # VClamp does not work with CVODE
+if cvode:
+    h.CVode().active(1)
+    h.CVode().atol(cvode)
 f3cl.dur[0] = 40	     # ms
 f3cl.amp[0] = -120	     # mV
 f3cl.dur[1] = dur        # ms
@@ -64,86 +92,93 @@ print('Initial values [C1, C2, O1, I1, I2]=  ', initial_values)
 
 
 for seg in soma:
-    seg.na15.iC1=initial_values[0]
-    seg.na15.iC2=initial_values[1]
-    seg.na15.iO1=initial_values[2]
-    seg.na15.iI1=initial_values[3]
-    seg.na15.iI2=initial_values[4]
-
-
-#figure definition
-fig = plt.figure(figsize=(20,15))
-fig.suptitle('2. Fast inactivation availability', fontsize=15, fontweight='bold')
-
-ax1 = plt.subplot2grid((2, 4), (0, 0), colspan=2)
-ax1.set_xlim(0,560)
-ax1.set_ylim(-121,10)
-ax1.set_xlabel('Time $(ms)$')
-ax1.set_ylabel('Voltage $(mV)$')
-ax1.set_title('Time/Voltage relation')
-
-ax2 = plt.subplot2grid((2,4), (0, 2))
-ax2.set_xlim(538,548)
-ax2.set_ylim(-1.5,0.1)
-ax2.set_xlabel('Time $(ms)$')
-ax2.set_ylabel('Current density $(mA/cm^2)$')
-ax2.set_title('Time/Current density relation - zoom in')
-
-ax3 = plt.subplot2grid((2,4), (0, 3))
-ax3.set_xlim(538,548)
-ax3.set_ylim(-0.015,0.001)
-ax3.set_xlabel('Time $(ms)$')
-ax3.set_ylabel('Current density $(mA/cm^2)$')
-ax3.set_title('Time/Current density relation - zoom in')
-
-ax4 = plt.subplot2grid((2,4), (1, 0), colspan=2)
-ax4.set_xlim(0,560)
-ax4.set_ylim(-1.5,0.25)
-ax4.set_xlabel('Time $(ms)$')
-ax4.set_ylabel('Current density $(mA/cm^2)$')
-ax4.set_title('Time/Current density relation')
-
-ax5 = plt.subplot2grid((2,4), (1, 2), colspan=2)
-ax5.set_xlim(-125,3)
-ax5.set_ylim(-0.05,1.05)        
-ax5.set_xlabel('Voltage $(mV)$')
-ax5.set_ylabel('Normalized current')
-ax5.set_title('Voltage/Normalized current relation')
-
-
-
-fig.subplots_adjust(wspace=0.5)
-fig.subplots_adjust(hspace=0.5)
-
-# to plot in rainbow colors
-values=range(L)
-rbw = cm = plt.get_cmap('rainbow') 
-cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
-scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
+    getattr(seg, mechanism).iC1=initial_values[0]
+    getattr(seg, mechanism).iC2=initial_values[1]
+    getattr(seg, mechanism).iO1=initial_values[2]
+    getattr(seg, mechanism).iI1=initial_values[3]
+    getattr(seg, mechanism).iI2=initial_values[4]
+
+
+#figure definition (not in headless mode: the NEURON GUI and matplotlib are only imported here)
+if not headless:
+    from neuron import gui
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    import matplotlib.cm as cmx
+    fig = plt.figure(figsize=(20,15))
+    fig.suptitle('2. Fast inactivation availability', fontsize=15, fontweight='bold')
+
+    ax1 = plt.subplot2grid((2, 4), (0, 0), colspan=2)
+    ax1.set_xlim(0,560)
+    ax1.set_ylim(-121,10)
+    ax1.set_xlabel('Time $(ms)$')
+    ax1.set_ylabel('Voltage $(mV)$')
+    ax1.set_title('Time/Voltage relation')
+
+    ax2 = plt.subplot2grid((2,4), (0, 2))
+    ax2.set_xlim(538,548)
+    ax2.set_ylim(-1.5,0.1)
+    ax2.set_xlabel('Time $(ms)$')
+    ax2.set_ylabel('Current density $(mA/cm^2)$')
+    ax2.set_title('Time/Current density relation - zoom in')
+
+    ax3 = plt.subplot2grid((2,4), (0, 3))
+    ax3.set_xlim(538,548)
+    ax3.set_ylim(-0.015,0.001)
+    ax3.set_xlabel('Time $(ms)$')
+    ax3.set_ylabel('Current density $(mA/cm^2)$')
+    ax3.set_title('Time/Current density relation - zoom in')
+
+    ax4 = plt.subplot2grid((2,4), (1, 0), colspan=2)
+    ax4.set_xlim(0,560)
+    ax4.set_ylim(-1.5,0.25)
+    ax4.set_xlabel('Time $(ms)$')
+    ax4.set_ylabel('Current density $(mA/cm^2)$')
+    ax4.set_title('Time/Current density relation')
+
+    ax5 = plt.subplot2grid((2,4), (1, 2), colspan=2)
+    ax5.set_xlim(-125,3)
+    ax5.set_ylim(-0.05,1.05)        
+    ax5.set_xlabel('Voltage $(mV)$')
+    ax5.set_ylabel('Normalized current')
+    ax5.set_title('Voltage/Normalized current relation')
+
+
+
+    fig.subplots_adjust(wspace=0.5)
+    fig.subplots_adjust(hspace=0.5)
+
+    # to plot in rainbow colors
+    values=range(L)
+    rbw = cm = plt.get_cmap('rainbow') 
+    cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
+    scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
 
 # clamping definition
-def clamp(v_cl):
+def clamp(v_cl, peaks=None, trace=None):   # peaks and trace (dict t, v, dens, g, or None) from run_sweeps
 
     f3cl.amp[1] = v_cl
-    h.finitialize(v_init)  # calling the INITIAL block of the mechanism inserted in the section.
-
-    # parameters initialization
-    peak_curr = 0
-    dens = 0
-    t_peak = 0
-    
-    while (h.t<h.tstop): # runs a single trace, calculates peak current
-        dens = f3cl.i/soma(0.5).area()*100.0-soma(0.5).i_cap # clamping current in mA/cm2, for each dt
-        t_vec.append(h.t)       # code for store the current
-        v_vec_t.append(soma.v)  # trace to be plotted
-        i_vec.append(dens)      # trace to be plotted
-        
-        if ((h.t>=540)and(h.t<=542)):     # evaluate the peak (I know it is there)
-            if(abs(dens)>abs(peak_curr)):
-                peak_curr = dens        
-                t_peak = h.t
-                
-        h.fadvance()
+
+    if peaks is None:
+        # runs a single trace: time, voltage, current density (mA/cm2) and conductance, for each dt
+        t, v, dens, g = run_clamp(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)
+        trace = dict(t=t, v=v, dens=dens, g=g)
+        if save_traces:
+            with phase('bundle'):
+                append_trace(bundle, t, v, dens, g)
+        with phase('peaks'):
+            peaks = measure_peaks(t, dens, clamp_starts(f3cl), windows)   # evaluate the peak (I know it is there)
+
+    if trace is not None:     # to be plotted
+        t, v, dens = trace['t'], trace['v'], trace['dens']
+        with phase('decimate'):
+            keep = decimate_trace(t, v, dens, plot_points, clamp_starts(f3cl), windows)    # samples to plot
+            t_vec.from_python(t[keep])        # code for store the current
+            v_vec_t.from_python(v[keep])      # trace to be plotted
+            i_vec.from_python(dens[keep])     # trace to be plotted
+
+    peak_curr = peaks['ipeak'][0]
+    t_peak = peaks['tpeak'][0]
 
     # updates the vectors at the end of the run        
     v_vec.append(v_cl)             
@@ -153,12 +188,31 @@ def clamp(v_cl):
 ### start program
 
 def start():
+
+    if timings:
+        enable(timings, title='2. Fast inactivation availability')
+
+    create_bundle(bundle, dict(title='2. Fast inactivation availability', windows=windows, sweep='voltage',
+                               **cell_settings(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)))
+
     h.tstop = 40 + dur + 20 
     v_vec.resize(0)
     ipeak_vec.resize(0)
 
 
     k=0     # counter    
+    # with processes > 1 the sweeps are run first, in parallel, and then plotted in order: the workers
+    # measure the peaks and stream the traces into the bundle (save_traces) or, to be plotted, decimated
+    # into a temporary bundle, read back one sweep at a time
+    plots = None
+    if processes > 1 and (save_traces or not headless):
+        plots = bundle if save_traces else create_bundle(tempfile.mkdtemp())
+    with phase('run_sweeps'):
+        results = run_sweeps(f3cl, soma(0.5), v_init, ('amp', 1), np.arange(st_cl, end_cl, step), processes,
+                             record_mode, ss_tol, ideal=ideal, windows=windows, bundle=plots,
+                             trace_points=None if save_traces else plot_points) if processes > 1 else None
+    traces = iter_traces(plots) if plots else None
+
     for v_cl in np.arange(st_cl, end_cl, step): # iterates across voltages
 
         print('Voltage Clamp:    ', v_cl,'mV')
@@ -169,40 +223,56 @@ def start():
         v_vec_t.resize(0) 
        
 
-        clamp(v_cl)
+        clamp(v_cl, None if results is None else results[k], traces and next(traces))
             
         # code for showing traces
-        colorVal1 = scalarMap.to_rgba(v_cl-st_cl-k*(step-1)) 
+        if not headless:
+            with phase('plot'):
+                colorVal1 = scalarMap.to_rgba(v_cl-st_cl-k*(step-1)) 
+                ln1,=ax1.plot(t_vec, v_vec_t,color=colorVal1)
+                ln2,=ax2.plot(t_vec, i_vec,color=colorVal1)
+                ln3,=ax3.plot(t_vec, i_vec,color=colorVal1)
+                ln4,=ax4.plot(t_vec, i_vec,color=colorVal1)
         k=k+1
-
-        ln1,=ax1.plot(t_vec, v_vec_t,color=colorVal1)
-        ln2,=ax2.plot(t_vec, i_vec,color=colorVal1)
-        ln3,=ax3.plot(t_vec, i_vec,color=colorVal1)
-        ln4,=ax4.plot(t_vec, i_vec,color=colorVal1)
+        end_sweep(voltage=v_cl)
 
     ipeak_min = ipeak_vec.min()           # normalization of peak current with respect to the min since the values are negative
 
     for i in range(0, len(ipeak_vec), 1):
-         colorVal2 = scalarMap.to_rgba(i)
          inorm_vec.append(ipeak_vec.x[i]/ipeak_min)
-         ln5,=ax5.plot(v_vec.x[i], inorm_vec.x[i], 'o', c=colorVal2)
+         if not headless:
+             with phase('plot'):
+                 colorVal2 = scalarMap.to_rgba(i)
+                 ln5,=ax5.plot(v_vec.x[i], inorm_vec.x[i], 'o', c=colorVal2)
 
          #printing and saving data (comment the following line if you don't want to print the data)
-         print('Voltage:   ', v_vec.x[i],'mV', ',   Normalized current:   ', inorm_vec.x[i])
-         # comment the following 2 lines if you don't want to save the data)
-         f1.write("%s ,\n" % v_vec.x[i]) 
-         f2.write("%s ,\n" % inorm_vec.x[i]) 
-
-    #saving the figure (comment the following line if you don't want to save the figure)   
-    plt.savefig('2. Fast inactivation availability', format='pdf', dpi=300, orientation='portrait')    
-
-    # comment the following 4 lines if you don't want to save the data
-    f1.write("];")
-    f2.write("];")
-    f1.close()
-    f2.close()
-
-    plt.show()
+         with phase('dat'):
+             print('Voltage:   ', v_vec.x[i],'mV', ',   Normalized current:   ', inorm_vec.x[i])
+             # comment the following 2 lines if you don't want to save the data)
+             f1.write("%s ,\n" % v_vec.x[i]) 
+             f2.write("%s ,\n" % inorm_vec.x[i]) 
+
+    with phase('bundle'):
+        append_columns(bundle, voltage=v_vec.as_numpy(), normalized_current=inorm_vec.as_numpy(),
+                       ipeak=ipeak_vec.as_numpy())
+
+    #saving the figure (comment the following 3 lines if you don't want to save the figure)   
+    if not headless:
+        with phase('savefig'):
+            plt.savefig('2. Fast inactivation availability', format='pdf', dpi=300, orientation='portrait')    
+
+    # comment the following 5 lines if you don't want to save the data
+    with phase('dat'):
+        f1.write("];")
+        f2.write("];")
+        f1.close()
+        f2.close()
+    if plots and plots != bundle:
+        shutil.rmtree(plots, ignore_errors=True)
+    end_run()
+
+    if not headless:
+        plt.show()
 
 
 start()
@@ -1,11 +1,21 @@
-from neuron import h, gui
+import shutil
+import tempfile
+
+from neuron import h
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
+
+from script_options import script_options
+from neuron_record import run_clamp, clamp_starts, use_rate_tables
+from phase_timers import enable, phase, end_sweep, end_run
+from sweep_pool import run_sweeps, cell_settings
+from result_bundle import create_bundle, append_columns, append_trace, iter_traces
+from peak_analysis import measure_peaks
+from trace_decimation import decimate_trace
 
 dtype = np.float64
 
+options = script_options('3_rec_f_inact_timings.jsonl')   # see script_options.py
+
 # one-compartment cell (soma)
 soma        = h.Section(name='soma')
 soma.diam   = 50        # micron
@@ -15,11 +25,22 @@ soma.cm     = 1         # uF/cm2
 soma.Ra     = 70        # ohm-cm
 
 soma.nseg   = 1
-soma.insert('na15')     # insert mechanism
+mechanism   = options.mechanism    # 'na15' (Na15.mod) or 'na15k' (Na15k.mod, --kinetic)
+soma.insert(mechanism) # insert mechanism
+use_rate_tables(options.rate_tables)   # tabulated rates (--rate-tables), off by default
 soma.ena    = 65
 h.celsius   = 24        # temperature in celsius
 v_init      = -120      # holding potential
 h.dt        = 0.01      # ms - value of the fundamental integration time step, dt, used by fadvance().
+cvode       = options.cvode        # CVODE atol (--cvode [ATOL]), None: fixed time step
+record_mode = True      # True: time loop inside NEURON (Vector.record), False: fadvance() loop
+ss_tol      = options.ss_tol       # levels on which na15 settles are jumped over (--ss-tol [TOL])
+ideal       = options.ideal        # True (--ideal) or 'check' (--ideal-check): see run_clamp
+processes   = 1         # processes running the sweeps in parallel (1: one after the other)
+plot_points = 2000      # traces plotted as min/max envelopes over this many bins (None: all)
+save_traces = False     # True: the full trace of every sweep is also saved in the result bundle
+headless    = options.headless     # True (--headless): no NEURON GUI, no matplotlib, no figure
+timings     = options.timings      # phase timer report (--timings [report.jsonl]), None: off
 
 # clamping parameters
 min_inter    = 0.1   # pre-stimulus starting interval
@@ -28,6 +49,7 @@ num_pts    	 = 50    # number of points in logaritmic scale
 cond_st_dur  = 30    # conditioning stimulus duration
 res_pot		 = -120  # resting potential
 dur          = 0.1
+windows      = [(1, 0, 10), (3, 0, 10)]  # P1, P2: (level, start, end), ms from the level start
 
 # vector containing 'num_pts' values equispaced between log10(min_inter) and log10(max_inter)
 vec_pts = np.logspace(np.log10(min_inter), np.log10(max_inter), num=num_pts)
@@ -41,6 +63,9 @@ t_vec        = h.Vector()
 v_vec_t      = h.Vector()
 i_vec_t      = h.Vector()
 
+# binary result bundle: curve, run metadata and optionally the traces (see result_bundle.py)
+bundle      = '3_rec_f_inact_results'
+
 # saving data (comment the following 4 lines if you don't want to save the data)
 f1 = open('3_rec_f_inact_time_vec.dat', 'w')
 f2 = open('3_rec_f_inact_rec_vec.dat', 'w')
@@ -48,7 +73,10 @@ f1.write("time=[\n")
 f2.write("fractional_recovery=[\n")
 
 # voltage clamp with "five" levels
-f3cl = h.VClamp_plus(soma(0.5))
+f3cl = h.VClamp_cvode(soma(0.5)) if cvode else h.VClamp_plus(soma(0.5))   # VClamp_plus does not work with CVODE
+if cvode:
+    h.CVode().active(1)
+    h.CVode().atol(cvode)
 f3cl.dur[0] = 5	  		     # ms
 f3cl.amp[0] = -120    		 # mV
 f3cl.dur[1] = cond_st_dur    # ms
@@ -68,110 +96,118 @@ print('Initial values [C1, C2, O1, I1, I2]=  ', initial_values)
 
 
 for seg in soma:
-    seg.na15.iC1=initial_values[0]
-    seg.na15.iC2=initial_values[1]
-    seg.na15.iO1=initial_values[2]
-    seg.na15.iI1=initial_values[3]
-    seg.na15.iI2=initial_values[4]
+    getattr(seg, mechanism).iC1=initial_values[0]
+    getattr(seg, mechanism).iC2=initial_values[1]
+    getattr(seg, mechanism).iO1=initial_values[2]
+    getattr(seg, mechanism).iI1=initial_values[3]
+    getattr(seg, mechanism).iI2=initial_values[4]
 
 
-# figure definition
-fig, ax = plt.subplots(2, 2,figsize=(18,6))  
-ln0, = ax[0,0].plot([], [], '-')
-ln1, = ax[0,1].plot([], [], '-')
-ln2, = ax[1,0].plot([], [], '-')
-ln3, = ax[1,1].plot([], [], '-')
-fig.suptitle('3. Recovery from fast inactivation', fontsize=15, fontweight='bold')
+# figure definition (not in headless mode: the NEURON GUI and matplotlib are only imported here)
+if not headless:
+    from neuron import gui
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    import matplotlib.cm as cmx
+    fig, ax = plt.subplots(2, 2,figsize=(18,6))  
+    ln0, = ax[0,0].plot([], [], '-')
+    ln1, = ax[0,1].plot([], [], '-')
+    ln2, = ax[1,0].plot([], [], '-')
+    ln3, = ax[1,1].plot([], [], '-')
+    fig.suptitle('3. Recovery from fast inactivation', fontsize=15, fontweight='bold')
 
 
-fig.subplots_adjust(wspace=0.5)
-fig.subplots_adjust(hspace=0.5)
+    fig.subplots_adjust(wspace=0.5)
+    fig.subplots_adjust(hspace=0.5)
 
-ax[0,0].set_xlim(-2, 5 + cond_st_dur + max_inter + 20 + 5)
-ax[0,0].set_ylim(-121,0)
-ax[0,0].set_xlabel('Time $(ms)$')
-ax[0,0].set_ylabel('Voltage $(mV)$')
-ax[0,0].set_title('Time/Voltage relation')
+    ax[0,0].set_xlim(-2, 5 + cond_st_dur + max_inter + 20 + 5)
+    ax[0,0].set_ylim(-121,0)
+    ax[0,0].set_xlabel('Time $(ms)$')
+    ax[0,0].set_ylabel('Voltage $(mV)$')
+    ax[0,0].set_title('Time/Voltage relation')
 
-ax[0,1].set_xlim(0, 5 + cond_st_dur + max_inter + 20 + 5)
-ax[0,1].set_ylim(-1.75,0.2)
-ax[0,1].set_xlabel('Time $(ms)$')
-ax[0,1].set_ylabel('Current density $(mA/cm^2)$')
-ax[0,1].set_title('Time/Current density relation')
+    ax[0,1].set_xlim(0, 5 + cond_st_dur + max_inter + 20 + 5)
+    ax[0,1].set_ylim(-1.75,0.2)
+    ax[0,1].set_xlabel('Time $(ms)$')
+    ax[0,1].set_ylabel('Current density $(mA/cm^2)$')
+    ax[0,1].set_title('Time/Current density relation')
 
-ax[1,0].set_xlim(-20, 5 + cond_st_dur + max_inter + 20 + 5)
-ax[1,0].set_ylim(-0.1, 1.1)
-ax[1,0].set_xlabel('Time $(ms)$')
-ax[1,0].set_ylabel('Fractional recovery (P2/P1)')
-ax[1,0].set_title('Time/Fractional recovery (P2/P1)')
+    ax[1,0].set_xlim(-20, 5 + cond_st_dur + max_inter + 20 + 5)
+    ax[1,0].set_ylim(-0.1, 1.1)
+    ax[1,0].set_xlabel('Time $(ms)$')
+    ax[1,0].set_ylabel('Fractional recovery (P2/P1)')
+    ax[1,0].set_title('Time/Fractional recovery (P2/P1)')
 
-ax[1,1].set_xlim(-1.1,3.1)
-ax[1,1].set_ylim(-0.1, 1.1)
-ax[1,1].set_xlabel('Log(Time)')
-ax[1,1].set_ylabel('Fractional recovery (P2/P1)')
-ax[1,1].set_title('Log(Time)/Fractional recovery (P2/P1)')
+    ax[1,1].set_xlim(-1.1,3.1)
+    ax[1,1].set_ylim(-0.1, 1.1)
+    ax[1,1].set_xlabel('Log(Time)')
+    ax[1,1].set_ylabel('Fractional recovery (P2/P1)')
+    ax[1,1].set_title('Log(Time)/Fractional recovery (P2/P1)')
 
 
 
 
-# to plot in rainbow colors
-values=range(L)
-rbw = cm = plt.get_cmap('rainbow') 
-cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
-scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
+    # to plot in rainbow colors
+    values=range(L)
+    rbw = cm = plt.get_cmap('rainbow') 
+    cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
+    scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
 
 
 # clamping definition
-def Clamp(dur): 
+def Clamp(dur, peaks=None, trace=None):   # peaks and trace (dict t, v, dens, g, or None) from run_sweeps
 
     f3cl.dur[2] = dur 
 
     h.tstop = 5 + 30 + dur + 20 + 5
 
-    h.finitialize(v_init)
-    
-    #variables initialization
-    pre_i1 = 0
-    pre_i2 = 0
-    dens   = 0        
-     
-    peak_curr1 = 0     # initialization peak current
-    peak_curr2 = 0
-
-
-    while (h.t<h.tstop): # runs a single trace, calculates peak current
-        
-        dens = f3cl.i/soma(0.5).area()*100.0-soma(0.5).i_cap # clamping current in mA/cm2, for each dt
-        t_vec.append(h.t)      
-        v_vec_t.append(soma.v) 
-        i_vec_t.append(dens)
-
-
-        if ((h.t>5)and(h.t<15)):       # evaluate the first peak    
-            if(pre_i1<abs(dens)):
-                peak_curr1=abs(dens)
-            pre_i1=abs(dens)
-
-        
-        if ((h.t>(5+cond_st_dur+dur))and(h.t<(15+cond_st_dur+dur))):  # evaluate the second peak 
-
-
-            if(pre_i2<abs(dens)):
-                peak_curr2=abs(dens)
-            pre_i2=abs(dens)
-
-        h.fadvance()
+    if peaks is None:
+        # runs a single trace: time, voltage, current density (mA/cm2) and conductance, for each dt
+        t, v, dens, g = run_clamp(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)
+        trace = dict(t=t, v=v, dens=dens, g=g)
+        if save_traces:
+            with phase('bundle'):
+                append_trace(bundle, t, v, dens, g)
+        with phase('peaks'):
+            peaks = measure_peaks(t, dens, clamp_starts(f3cl), windows)   # evaluate the first and second peak
+
+    if trace is not None:     # to be plotted
+        t, v, dens = trace['t'], trace['v'], trace['dens']
+        with phase('decimate'):
+            keep = decimate_trace(t, v, dens, plot_points, clamp_starts(f3cl), windows)    # samples to plot
+            t_vec.from_python(t[keep])      
+            v_vec_t.from_python(v[keep]) 
+            i_vec_t.from_python(dens[keep])
 
     # updates the vectors at the end of the run  
     time_vec.append(dur)
     log_time_vec.append(np.log10(dur))
-    rec_vec.append(peak_curr2/peak_curr1)
+    rec_vec.append(peaks['ratio'])
 
 ### start program
 
 def start():
+
+    if timings:
+        enable(timings, title='3. Recovery from fast inactivation')
+
+    create_bundle(bundle, dict(title='3. Recovery from fast inactivation', windows=windows, sweep='time',
+                               **cell_settings(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)))
+
     k=0 #counter
 
+    # with processes > 1 the sweeps are run first, in parallel, and then plotted in order: the workers
+    # measure the peaks and stream the traces into the bundle (save_traces) or, to be plotted, decimated
+    # into a temporary bundle, read back one sweep at a time
+    plots = None
+    if processes > 1 and (save_traces or not headless):
+        plots = bundle if save_traces else create_bundle(tempfile.mkdtemp())
+    with phase('run_sweeps'):
+        results = run_sweeps(f3cl, soma(0.5), v_init, ('dur', 2), vec_pts, processes, record_mode, ss_tol,
+                             ideal=ideal, windows=windows, bundle=plots,
+                             trace_points=None if save_traces else plot_points) if processes > 1 else None
+    traces = iter_traces(plots) if plots else None
+
     for dur in vec_pts: 
         # resizing the vectors
         t_vec.resize(0)
@@ -180,35 +216,46 @@ def start():
         rec_vec.resize(0) 
         time_vec.resize(0)
         log_time_vec.resize(0)
-        Clamp(dur)
-
-        colorVal1 = scalarMap.to_rgba(k)    
-
+        Clamp(dur, None if results is None else results[k], traces and next(traces))
+
+        if not headless:
+            with phase('plot'):
+                colorVal1 = scalarMap.to_rgba(k)
+                ln0,=ax[0,0].plot(t_vec, v_vec_t, color=colorVal1)
+                ln1,=ax[0,1].plot(t_vec, i_vec_t, color=colorVal1)
+                ln2=ax[1,0].scatter(time_vec, rec_vec, c=colorVal1)
+                ln3=ax[1,1].scatter(log_time_vec, rec_vec, c=colorVal1)
         k+=1
 
-        ln0,=ax[0,0].plot(t_vec, v_vec_t, color=colorVal1)
-        ln1,=ax[0,1].plot(t_vec, i_vec_t, color=colorVal1)
-        ln2=ax[1,0].scatter(time_vec, rec_vec, c=colorVal1)
-        ln3=ax[1,1].scatter(log_time_vec, rec_vec, c=colorVal1)
-
-        #printing and saving data (comment the following 6 lines if you don't want to print and save the data)
-        for i in time_vec:
-            print ('time:    ', i,'ms')
-            f1.write("%s ,\n" % i) 
-        for i in rec_vec:
-            print('fractional recovery (P2/P1):    ',i)
-            f2.write("%s ,\n" % i) 
-
-    #saving the figure (comment the following line if you don't want to save the figure)   
-    plt.savefig('3. Recovery from fast inactivation', format='pdf', dpi=300, orientation='portrait')    
-
-    # comment the following 4 lines if you don't want to save the data
-    f1.write("];")
-    f2.write("];")
-    f1.close()
-    f2.close()
-
-    plt.show()
+        #printing and saving data (comment the following 7 lines if you don't want to print and save the data)
+        with phase('dat'):
+            for i in time_vec:
+                print ('time:    ', i,'ms')
+                f1.write("%s ,\n" % i) 
+            for i in rec_vec:
+                print('fractional recovery (P2/P1):    ',i)
+                f2.write("%s ,\n" % i) 
+        with phase('bundle'):
+            append_columns(bundle, time=time_vec.as_numpy(), fractional_recovery=rec_vec.as_numpy())
+        end_sweep(time=dur)
+
+    #saving the figure (comment the following 3 lines if you don't want to save the figure)   
+    if not headless:
+        with phase('savefig'):
+            plt.savefig('3. Recovery from fast inactivation', format='pdf', dpi=300, orientation='portrait')    
+
+    # comment the following 5 lines if you don't want to save the data
+    with phase('dat'):
+        f1.write("];")
+        f2.write("];")
+        f1.close()
+        f2.close()
+    if plots and plots != bundle:
+        shutil.rmtree(plots, ignore_errors=True)
+    end_run()
+
+    if not headless:
+        plt.show()
 
 
 start()
@@ -1,13 +1,16 @@
-from neuron import h, gui
+from neuron import h
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
-import matplotlib.animation as animation
-from matplotlib.animation import FuncAnimation  
+
+from script_options import script_options
+from neuron_record import run_clamp, clamp_starts, use_rate_tables
+from phase_timers import enable, phase, end_sweep, end_run
+from peak_analysis import measure_peaks
+from trace_decimation import decimate_trace
 
 dtype = np.float64
 
+options = script_options('5_rec_s_inact_dynamic_timings.jsonl')   # see script_options.py
+
 # one-compartment cell (soma)
 soma        = h.Section(name='soma')
 soma.diam   = 50        # micron
@@ -17,11 +20,20 @@ soma.cm     = 1         # uF/cm2
 soma.Ra     = 70        # ohm-cm
 
 soma.nseg   = 1
-soma.insert('na15')     # insert mechanism
+mechanism   = options.mechanism    # 'na15' (Na15.mod) or 'na15k' (Na15k.mod, --kinetic)
+soma.insert(mechanism) # insert mechanism
+use_rate_tables(options.rate_tables)   # tabulated rates (--rate-tables), off by default
 soma.ena    = 65
 h.celsius   = 24        # temperature in celsus
 v_init      = -120      # holding potential
 h.dt        = 0.075     # ms - value of the fundamental integration time step, dt, used by fadvance().
+cvode       = options.cvode        # CVODE atol (--cvode [ATOL]), None: fixed time step
+record_mode = True      # True: time loop inside NEURON (Vector.record), False: fadvance() loop
+ss_tol      = options.ss_tol       # levels on which na15 settles are jumped over (--ss-tol [TOL])
+ideal       = options.ideal        # True (--ideal) or 'check' (--ideal-check): see run_clamp
+plot_points = 2000      # traces plotted as min/max envelopes over this many bins (None: all)
+headless    = options.headless     # True (--headless): no NEURON GUI, no matplotlib, no figure
+timings     = options.timings      # phase timer report (--timings [report.jsonl]), None: off
 
 # clamping parameters
 min_inter    = 0.1      # pre-stimulus starting interval
@@ -30,6 +42,7 @@ num_pts    	 = 50       # number of points in logaritmic scale
 cond_st_dur  = 1000     # conditioning stimulus duration
 res_pot		 = -120     # resting potential
 dur          = 0.1
+windows      = [(1, 0, 10), (3, 0, 10)]  # P1, P2: (level, start, end), ms from the level start
 
 # vector containing 'num_pts' values equispaced between log10(min_inter) and log10(max_inter)
 vec_pts = np.logspace(np.log10(min_inter), np.log10(max_inter), num=num_pts)
@@ -45,7 +58,10 @@ i_vec_t      = h.Vector()
 
 
 # voltage clamp with "five" levels
-f3cl = h.VClamp_plus(soma(0.5))
+f3cl = h.VClamp_cvode(soma(0.5)) if cvode else h.VClamp_plus(soma(0.5))   # VClamp_plus does not work with CVODE
+if cvode:
+    h.CVode().active(1)
+    h.CVode().atol(cvode)
 f3cl.dur[0] = 5	  		     # ms
 f3cl.amp[0] = -120    		 # mV
 f3cl.dur[1] = cond_st_dur    # ms
@@ -65,22 +81,29 @@ print('initial values=  ', initial_values)
 
 
 for seg in soma:
-    seg.na15.iC1=initial_values[0]
-    seg.na15.iC2=initial_values[1]
-    seg.na15.iO1=initial_values[2]
-    seg.na15.iI1=initial_values[3]
-    seg.na15.iI2=initial_values[4]
-
-# figures definition
-fig, ax = plt.subplots(2, 2,figsize=(18,6))  
-ln0, = ax[0,0].plot([], [], '*')
-ln1, = ax[0,1].plot([], [], '-')
-ln2, = ax[1,0].plot([], [], '-')
-ln3, = ax[1,1].plot([], [], '-')
-fig.suptitle('Recovery from slow inactivation', fontsize=15, fontweight='bold')
-
-fig.subplots_adjust(wspace=0.5)
-fig.subplots_adjust(hspace=0.5)
+    getattr(seg, mechanism).iC1=initial_values[0]
+    getattr(seg, mechanism).iC2=initial_values[1]
+    getattr(seg, mechanism).iO1=initial_values[2]
+    getattr(seg, mechanism).iI1=initial_values[3]
+    getattr(seg, mechanism).iI2=initial_values[4]
+
+# figures definition (not in headless mode: the NEURON GUI and matplotlib are only imported here)
+if not headless:
+    from neuron import gui
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    import matplotlib.cm as cmx
+    import matplotlib.animation as animation
+    from matplotlib.animation import FuncAnimation
+    fig, ax = plt.subplots(2, 2,figsize=(18,6))  
+    ln0, = ax[0,0].plot([], [], '*')
+    ln1, = ax[0,1].plot([], [], '-')
+    ln2, = ax[1,0].plot([], [], '-')
+    ln3, = ax[1,1].plot([], [], '-')
+    fig.suptitle('Recovery from slow inactivation', fontsize=15, fontweight='bold')
+
+    fig.subplots_adjust(wspace=0.5)
+    fig.subplots_adjust(hspace=0.5)
 
 def init():
     ax[0,0].set_xlim(-150, 5 + cond_st_dur + max_inter + 20 + 100)
@@ -111,10 +134,11 @@ def init():
     return ln0, ln1, ln2, ln3,
 
 #to plot in rainbow colors
-values=range(L)
-rbw = cm = plt.get_cmap('rainbow') 
-cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
-scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
+if not headless:
+    values=range(L)
+    rbw = cm = plt.get_cmap('rainbow') 
+    cNorm  = colors.Normalize(vmin=0, vmax=values[-1])
+    scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=rbw)
 
 
 def animate(frame):
@@ -128,15 +152,17 @@ def animate(frame):
     
     Clamp(dur2)
 
-    colorVal1 = scalarMap.to_rgba(values[int(frame)])
-    colorVal2 = scalarMap.to_rgba(values[0:int(frame)+1])
+    with phase('plot'):
+        colorVal1 = scalarMap.to_rgba(values[int(frame)])
+        colorVal2 = scalarMap.to_rgba(values[0:int(frame)+1])
 
-    ln0,=ax[0,0].plot(t_vec, v_vec_t, color=colorVal1)
-    ln1,=ax[0,1].plot(t_vec, i_vec_t, color=colorVal1)
+        ln0,=ax[0,0].plot(t_vec, v_vec_t, color=colorVal1)
+        ln1,=ax[0,1].plot(t_vec, i_vec_t, color=colorVal1)
 
 
-    ln2=ax[1,0].scatter(time_vec, rec_vec, c=colorVal2)
-    ln3=ax[1,1].scatter(log_time_vec, rec_vec, c=colorVal2)
+        ln2=ax[1,0].scatter(time_vec, rec_vec, c=colorVal2)
+        ln3=ax[1,1].scatter(log_time_vec, rec_vec, c=colorVal2)
+    end_sweep(frame=int(frame))
 
     return ln0, ln1, ln2, ln3,
 
@@ -146,40 +172,17 @@ def Clamp(dur):
 
     f3cl.dur[2] = dur
     h.tstop = 5 + 1000 + dur + 20 + 5 
-    h.finitialize(v_init)
-   
-    #variables initialization 
-    pre_i1 = 0
-    pre_i2 = 0
-    dens   = 0        
-     
-    # initialization peak current
-    peak_curr1 = 0    
-    peak_curr2 = 0
-
-
-    while (h.t<h.tstop): # runs a single trace, calculates peak current
-        
-        dens = f3cl.i/soma(0.5).area()*100.0-soma(0.5).i_cap # clamping current in mA/cm2, for each dt
-        t_vec.append(h.t)      
-        v_vec_t.append(soma.v) 
-        i_vec_t.append(dens)
+    # runs a single trace: time, voltage, current density (mA/cm2) and conductance, for each dt
+    t, v, dens, g = run_clamp(f3cl, soma(0.5), v_init, record_mode, ss_tol, ideal)
 
+    with phase('decimate'):
+        keep = decimate_trace(t, v, dens, plot_points, clamp_starts(f3cl), windows)    # samples to plot
+        t_vec.from_python(t[keep])      
+        v_vec_t.from_python(v[keep]) 
+        i_vec_t.from_python(dens[keep])
 
-        if ((h.t>5)and(h.t<15)):       # evaluate the first peak
-            if(pre_i1<abs(dens)):
-                peak_curr1=abs(dens)
-            pre_i1=abs(dens)
-
-        
-        if ((h.t>(5+cond_st_dur+dur))and(h.t<(15+cond_st_dur+dur))):  # evaluate the second peak 
-
-
-            if(pre_i2<abs(dens)):
-                peak_curr2=abs(dens)
-            pre_i2=abs(dens)
-
-        h.fadvance()
+    with phase('peaks'):
+        peaks = measure_peaks(t, dens, clamp_starts(f3cl), windows)   # evaluate the first and second peak
 
     
 
@@ -191,13 +194,27 @@ def Clamp(dur):
 
     time_vec.append(dur)
     log_time_vec.append(np.log10(dur))
-    rec_vec.append(peak_curr2/peak_curr1)
+    rec_vec.append(peaks['ratio'])
 
 ### start program
 
 def start():
+
+    if timings:
+        enable(timings, title='5. Recovery from slow inactivation')
+
     k=0 #cunter
 
+    if headless:    # no animation: one pass over the sweep, the curve is printed
+        for dur in vec_pts:
+            Clamp(dur)
+            end_sweep(time=dur)
+        with phase('print'):
+            for x, y in zip(time_vec, rec_vec):
+                print('time:    ', x, 'ms', ',   fractional recovery (P2/P1):    ', y)
+        end_run()
+        return
+
     for dur in vec_pts: 
 
         t_vec.resize(0)
@@ -212,6 +229,7 @@ def start():
                          init_func=init, blit=True, interval=500, repeat=True)
 
     plt.show()
+    end_run()
 
 
 start()
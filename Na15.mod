@@ -4,12 +4,28 @@ COMMENT
 A five-state markovian kinetic model of ionic channel.
 Part of a study on kinetic models.
 Author: Piero Balbi, April 2019
+
+The ten transition rates can be tabulated (TABLE in PROCEDURE rates) over vmin_tab..vmax_tab with
+2501 points and linearly interpolated, the table being rebuilt when celsius, the range or any rate
+parameter changes. Only the range can be set at run time: NMODL takes the number of points (WITH)
+as a constant, so a different resolution needs that value changed and the mechanism recompiled.
+rate_table_error() in na15_kinetics.py reports the interpolation error of the table as built.
+The table is opt-in: NMODL loads the mechanism with usetable_na15 = 1, but neuron_record.py sets it
+to 0 when it is imported (use_rate_tables, --rate-tables in the scripts), so that the rates are
+evaluated directly at every step unless asked. The table moves the peaks of the protocols by up to
+2.5e-5 (relative) and does not make fadvance measurably faster.
+
+The mechanism is THREADSAFE (ParallelContext.nthread): the rates are RANGE variables of each
+instance, Q10 is LOCAL to rates() and the GLOBAL parameters are only read during a run, so the
+instances write nothing they share; the table is built once, by the main thread, at finitialize.
 ENDCOMMENT
 
 NEURON {
 	SUFFIX na15
+	THREADSAFE
 	USEION na READ ena WRITE ina
 	RANGE gbar, ina, g ,iC1,iC2,iO1,iI1,iI2
+	RANGE C1C2_a, C2C1_a, C2O1_a, O1C2_a, O1I1_a, I1O1_a, I1I2_a, I2I1_a, I1C1_a, C1I1_a
 }
 
 UNITS {
@@ -23,6 +39,8 @@ PARAMETER {
 	ena (mV)
 	celsius
 	gbar  = 0.1	 (mho/cm2)
+	vmin_tab = -150 (mV)	: voltage range of the rate tables (2501 points)
+	vmax_tab = 100 (mV)
 
     iC1
     iC2
@@ -95,8 +113,6 @@ ASSIGNED {
 	I2I1_a
 	I1C1_a 
 	C1I1_a
-	
-	Q10
 }
 
 STATE {
@@ -109,7 +125,6 @@ STATE {
 
 
 INITIAL {
-	Q10 = 3^((celsius-20(degC))/10 (degC))
 : valori delle variabili di stato calcolati da finding_state_variables
 	C1 = iC1
 	C2 = iC2
@@ -141,6 +156,19 @@ DERIVATIVE states {
 
 
 PROCEDURE rates(v(mV)) {
+	LOCAL Q10
+	TABLE C1C2_a, C2C1_a, C2O1_a, O1C2_a, O1I1_a, I1O1_a, I1C1_a, C1I1_a, I1I2_a, I2I1_a
+	DEPEND celsius, vmin_tab, vmax_tab,
+	       C1C2b2, C1C2v2, C1C2k2, C2C1b1, C2C1v1, C2C1k1,
+	       C2C1b2, C2C1v2, C2C1k2, C2O1b2, C2O1v2, C2O1k2,
+	       O1C2b1, O1C2v1, O1C2k1, O1C2b2, O1C2v2, O1C2k2,
+	       O1I1b1, O1I1v1, O1I1k1, O1I1b2, O1I1v2, O1I1k2,
+	       I1O1b1, I1O1v1, I1O1k1, I1C1b1, I1C1v1, I1C1k1,
+	       C1I1b2, C1I1v2, C1I1k2, I1I2b2, I1I2v2, I1I2k2,
+	       I2I1b1, I2I1v1, I2I1k1
+	FROM vmin_tab TO vmax_tab WITH 2501
+
+	Q10 = 3^((celsius-20(degC))/10 (degC))
 	C1C2_a = Q10*(rates2(v, C1C2b2, C1C2v2, C1C2k2))
 	C2C1_a = Q10*(rates2(v, C2C1b1, C2C1v1, C2C1k1) + rates2(v, C2C1b2, C2C1v2, C2C1k2))
 	C2O1_a = Q10*(rates2(v, C2O1b2, C2O1v2, C2O1k2))
@@ -0,0 +1,191 @@
+TITLE Nav1.5 ionic voltage-gated channel with kinetic scheme (KINETIC block, implicit solver)
+
+COMMENT
+A five-state markovian kinetic model of ionic channel.
+Part of a study on kinetic models.
+Author: Piero Balbi, April 2019
+
+The same model, parameters and RANGE variables as Na15.mod (SUFFIX na15), but the five states are
+integrated as one KINETIC scheme with CONSERVE C1+C2+O1+I1+I2 = 1, solved by METHOD sparse
+(backward Euler on the whole linear system, Newton's method being exact for it) instead of cnexp,
+which treats each equation as an independent gate with the other states frozen over the step.
+The scheme is unconditionally stable, so protocols can be run at dt of 0.1-0.5 ms; its error is
+first order in dt, like that of Na15.mod (compare_mechanisms.py). The GLOBAL parameters are
+those of Na15.mod with the suffix _na15k (e.g. C1C2b2_na15k, usetable_na15k).
+
+The ten transition rates can be tabulated (TABLE in PROCEDURE rates) over vmin_tab..vmax_tab with
+2501 points and linearly interpolated, the table being rebuilt when celsius, the range or any rate
+parameter changes. Only the range can be set at run time: NMODL takes the number of points (WITH)
+as a constant, so a different resolution needs that value changed and the mechanism recompiled.
+rate_table_error(mechanism='na15k') in na15_kinetics.py reports the interpolation error of the
+table as built. As in Na15.mod the table is opt-in: neuron_record.py sets usetable_na15k = 0 when
+it is imported (use_rate_tables, --rate-tables in the scripts).
+
+The mechanism is THREADSAFE (ParallelContext.nthread): the rates are RANGE variables of each
+instance, Q10 is LOCAL to rates() and the GLOBAL parameters are only read during a run, so the
+instances write nothing they share; the table is built once, by the main thread, at finitialize.
+ENDCOMMENT
+
+NEURON {
+	SUFFIX na15k
+	THREADSAFE
+	USEION na READ ena WRITE ina
+	RANGE gbar, ina, g ,iC1,iC2,iO1,iI1,iI2
+	RANGE C1C2_a, C2C1_a, C2O1_a, O1C2_a, O1I1_a, I1O1_a, I1I2_a, I2I1_a, I1C1_a, C1I1_a
+}
+
+UNITS {
+	(mA) = (milliamp)
+	(mV) = (millivolt)
+}
+
+
+PARAMETER {
+	v (mV)
+	ena (mV)
+	celsius
+	gbar  = 0.1	 (mho/cm2)
+	vmin_tab = -150 (mV)	: voltage range of the rate tables (2501 points)
+	vmax_tab = 100 (mV)
+
+    iC1
+    iC2
+    iO1
+    iI1
+    iI2
+	
+	C1C2b2	  = 8
+	C1C2v2    = -16
+	C1C2k2	  = -9
+	
+	C2C1b1	  = 2
+	C2C1v1    = -82
+	C2C1k1	  = 5
+	C2C1b2	  = 8
+	C2C1v2    = -16
+	C2C1k2	  = -9
+
+	C2O1b2	  = 8
+	C2O1v2    = -26
+	C2O1k2	  = -9
+	
+	O1C2b1	  = 3
+	O1C2v1    = -92
+	O1C2k1	  = 5
+	O1C2b2	  = 8
+	O1C2v2    = -26
+	O1C2k2	  = -9
+	
+	O1I1b1	  = 8
+	O1I1v1	  = -50
+	O1I1k1	  = 4
+	O1I1b2	  = 6
+	O1I1v2	  = 10
+	O1I1k2	  = -100
+	
+	I1O1b1	  = 0.00001
+	I1O1v1	  = -20
+	I1O1k1	  = 10
+	
+	I1C1b1	  = 0.35
+	I1C1v1	  = -122
+	I1C1k1	  = 9
+	
+	C1I1b2	  = 0.04
+	C1I1v2	  = -78
+	C1I1k2	  = -10
+	
+	I1I2b2	  = 0.00018
+	I1I2v2	  = -60
+	I1I2k2	  = -5
+
+	I2I1b1	  = 0.001825
+	I2I1v1	  = -88
+	I2I1k1	  = 31
+	
+}
+
+ASSIGNED {
+	ina  (mA/cm2)
+	g   (mho/cm2)
+	
+	C1C2_a
+	C2C1_a 
+	C2O1_a  
+	O1C2_a
+	O1I1_a
+	I1O1_a
+	I1I2_a
+	I2I1_a
+	I1C1_a 
+	C1I1_a
+}
+
+STATE {
+	C1
+	C2
+	O1
+	I1
+	I2
+}
+
+
+INITIAL {
+: valori delle variabili di stato calcolati da finding_state_variables
+	C1 = iC1
+	C2 = iC2
+	O1 = iO1
+	I1 = iI1
+	I2 = iI2
+}
+
+BREAKPOINT {
+	SOLVE states METHOD sparse
+	g = gbar * O1	: (mho/cm2)
+	ina = g * (v - ena)   	: (mA/cm2)
+}
+
+
+FUNCTION rates2(v, b, vv, k) {
+	rates2 = (b/(1+exp((v-vv)/k)))
+}
+
+KINETIC states {
+	rates(v)
+	~ C1 <-> C2	(C1C2_a, C2C1_a)
+	~ C2 <-> O1	(C2O1_a, O1C2_a)
+	~ O1 <-> I1	(O1I1_a, I1O1_a)
+	~ I1 <-> C1	(I1C1_a, C1I1_a)
+	~ I1 <-> I2	(I1I2_a, I2I1_a)
+	CONSERVE C1 + C2 + O1 + I1 + I2 = 1
+}
+
+
+PROCEDURE rates(v(mV)) {
+	LOCAL Q10
+	TABLE C1C2_a, C2C1_a, C2O1_a, O1C2_a, O1I1_a, I1O1_a, I1C1_a, C1I1_a, I1I2_a, I2I1_a
+	DEPEND celsius, vmin_tab, vmax_tab,
+	       C1C2b2, C1C2v2, C1C2k2, C2C1b1, C2C1v1, C2C1k1,
+	       C2C1b2, C2C1v2, C2C1k2, C2O1b2, C2O1v2, C2O1k2,
+	       O1C2b1, O1C2v1, O1C2k1, O1C2b2, O1C2v2, O1C2k2,
+	       O1I1b1, O1I1v1, O1I1k1, O1I1b2, O1I1v2, O1I1k2,
+	       I1O1b1, I1O1v1, I1O1k1, I1C1b1, I1C1v1, I1C1k1,
+	       C1I1b2, C1I1v2, C1I1k2, I1I2b2, I1I2v2, I1I2k2,
+	       I2I1b1, I2I1v1, I2I1k1
+	FROM vmin_tab TO vmax_tab WITH 2501
+
+	Q10 = 3^((celsius-20(degC))/10 (degC))
+	C1C2_a = Q10*(rates2(v, C1C2b2, C1C2v2, C1C2k2))
+	C2C1_a = Q10*(rates2(v, C2C1b1, C2C1v1, C2C1k1) + rates2(v, C2C1b2, C2C1v2, C2C1k2))
+	C2O1_a = Q10*(rates2(v, C2O1b2, C2O1v2, C2O1k2))
+	O1C2_a = Q10*(rates2(v, O1C2b1, O1C2v1, O1C2k1) + rates2(v, O1C2b2, O1C2v2, O1C2k2))
+	O1I1_a = Q10*(rates2(v, O1I1b1, O1I1v1, O1I1k1) + rates2(v, O1I1b2, O1I1v2, O1I1k2))
+	I1O1_a = Q10*(rates2(v, I1O1b1, I1O1v1, I1O1k1))
+	I1C1_a = Q10*(rates2(v, I1C1b1, I1C1v1, I1C1k1))
+	C1I1_a = Q10*(rates2(v, C1I1b2, C1I1v2, C1I1k2))
+	I1I2_a = Q10*(rates2(v, I1I2b2, I1I2v2, I1I2k2))
+	I2I1_a = Q10*(rates2(v, I2I1b1, I2I1v1, I2I1k1))
+}
+
+
+
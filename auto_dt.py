@@ -0,0 +1,142 @@
+# The following script chooses the time step of a protocol from an accuracy target instead of the
+# h.dt written in its script: 'choose_dt(number, tol)' returns the largest dt (the dt of the
+# specification times a power of 2) at which the peak currents, relative to the largest peak of their
+# window, and the P2/P1 ratios of a few probe sweeps are estimated to be within tol of their values
+# for dt -> 0, together with the estimated errors.
+#
+# The error of the probe peaks q(dt) is estimated from runs at dt, dt/2 and dt/4 (method):
+#   richardson  |q(dt) - q(dt/2)| / (1 - 2^-p), the order p being measured from the three runs,
+#   halving     the same with the order p of the integrator (1: fixed-step fadvance) and without dt/4,
+#   reference   |q(dt) - exact q(dt)|, the exact engine of na15_kinetics.py sampled on the same grid
+#               (no integration error, but without the dynamics of the clamp amplifier).
+# The probes run on the backend that will run the whole sweep (see run_protocol.py; NEURON by
+# default, whose error is that of the time integration; the exact, spectral and batch backends only
+# sample the windows every dt). e.g.
+#
+#   python run_protocol.py 4 5 --backend record --auto-dt 1e-3 --outdir results
+
+import numpy as np
+
+from na15_kinetics import batch_clamp
+from protocols import protocol, target_protocol, model_settings, exact_peaks, sweep_levels
+from peak_analysis import measure_peaks
+
+dtype = np.float64
+
+methods = ('richardson', 'halving', 'reference')
+
+
+def probe_protocol(number, probes=3):
+    """Protocol 'number' with its sweep reduced to 'probes' values: the first, the last and evenly
+    spaced ones in between (in the order of the sweep, e.g. logarithmically for the intervals)."""
+
+    p = protocol(number)
+    k = np.unique(np.round(np.linspace(0, len(p['sweep'])-1, max(probes, 1))).astype(int))
+    return target_protocol(p, np.asarray(p['sweep'], dtype)[k])
+
+
+def probe_peaks(p, dt, backend='record', ss_tol=None, mechanism='na15'):
+    """Peak currents (n_sweeps x n_windows) of the compiled protocol p at the time step dt with the
+    backend 'record' or 'loop' (NEURON, with the channel mechanism 'na15' or 'na15k'), 'batch' or 'exact'."""
+
+    if backend in ('record', 'loop'):
+        from run_protocol import neuron_peaks
+        return neuron_peaks(p, dt, backend == 'record', ss_tol, mechanism=mechanism)[0]
+    if backend in ('exact', 'spectral', 'auto'):
+        return exact_peaks(p, dt)[0]
+    if backend == 'batch':
+        dt, params, gbar, ena = model_settings(p, dt)
+        durs, amps = sweep_levels(p)
+        t, v, g, ina, x_end = batch_clamp(durs, amps, p['v_init'], p['celsius'], dt, params=params, gbar=gbar, ena=ena,
+                                          windows=p['windows'])
+        return measure_peaks(t, ina, np.cumsum(durs, axis=1)-durs, p['windows'])['ipeak']
+    raise ValueError('unknown backend %r' % backend)
+
+
+def peak_quantities(ipeak, scale):
+    """Peak currents relative to scale (the largest |peak| of each window) and, with two windows,
+    the P2/P1 ratios: (n_sweeps x n_windows, n_sweeps or empty)."""
+
+    ratio = np.abs(ipeak[:, 1])/np.abs(ipeak[:, 0]) if ipeak.shape[1] == 2 else np.empty(0, dtype)
+    return ipeak/scale, ratio
+
+
+def estimate_error(fine, coarse, finest=None, order=1.0):
+    """Estimated errors (max over the probes) of the coarse peaks from the peaks at half (fine) and,
+    for the Richardson estimate, a quarter (finest) of its time step, or from exact peaks (fine, with
+    order=inf): dict(ipeak_error, ratio_error, error (the larger of the two), order).
+
+    The peaks are sampled on the time grid, so they change by jumps and two runs may give the same
+    peak although neither has converged: unless fine is exact, a zero difference between coarse and
+    fine, a quantity changing between fine and finest but not between coarse and fine, or differences
+    which do not shrink from (coarse, fine) to (fine, finest) cannot be extrapolated, and the errors
+    are then inf (the step is not accepted, see choose_dt)."""
+
+    scale = np.abs(fine).max(axis=0)
+    q = [np.concatenate([x.ravel() for x in peak_quantities(ipeak, scale)]) for ipeak in (coarse, fine, finest) if ipeak is not None]
+    d1 = np.abs(q[0]-q[1])
+    estimable = np.isinf(order) or d1.max() > 0
+    if finest is not None:
+        d2 = np.abs(q[1]-q[2])
+        estimable = estimable and d2.max() < d1.max() and not np.any((d1 == 0) & (d2 > 0))
+        order = float(np.clip(np.log2(d1.max()/d2.max()), 0.5, 4)) if estimable and d2.max() > 0 else order
+    if not estimable:
+        return dict(ipeak_error=np.inf, ratio_error=np.inf, error=np.inf, order=order)
+    e = d1/(1-2.0**-order)
+    n = coarse.size
+    ipeak_error, ratio_error = e[:n].max(), (e[n:].max() if len(e) > n else 0.0)
+    return dict(ipeak_error=float(ipeak_error), ratio_error=float(ratio_error),
+                error=float(max(ipeak_error, ratio_error)), order=order)
+
+
+def choose_dt(number, tol, backend='record', method='richardson', probes=3, dt=None, max_steps=6, ss_tol=None, order=1.0,
+              mechanism='na15'):
+    """Largest dt = dt0*2^k (dt0: dt, default that of the specification; |k| <= max_steps) at which
+    the estimated errors of the peak currents (relative) and P2/P1 ratios of the probe sweeps are
+    within tol. The search doubles dt0 while the error stays within tol, or halves it until it does.
+
+    A dt whose error cannot be estimated (inf, see estimate_error) is never accepted, so that the
+    search goes on to smaller steps.
+
+    Returns (dt, info), info = dict(dt, error, ipeak_error, ratio_error, order, method, probes,
+    tried: [(dt, error), ...]); raises ValueError if no dt down to dt0/2^max_steps is accurate enough."""
+
+    if method not in methods:
+        raise ValueError('unknown method %r, expected one of %s' % (method, ', '.join(methods)))
+    p = probe_protocol(number, probes)
+    dt0 = model_settings(p, dt)[0]
+    runs = {}
+
+    def peaks(step, reference=False):
+        key = (step, reference)
+        if key not in runs:
+            runs[key] = exact_peaks(p, step)[0] if reference else probe_peaks(p, step, backend, ss_tol, mechanism)
+        return runs[key]
+
+    def error(step):
+        if method == 'reference':
+            return estimate_error(peaks(step, True), peaks(step), order=np.inf)
+        finest = peaks(step/4) if method == 'richardson' else None
+        return estimate_error(peaks(step/2), peaks(step), finest, order)
+
+    step = dt0
+    e = error(step)
+    tried = [(step, e['error'])]
+    if e['error'] <= tol:
+        for k in range(max_steps):
+            e_next = error(2*step)
+            tried.append((2*step, e_next['error']))
+            if not e_next['error'] <= tol:
+                break
+            step, e = 2*step, e_next
+    else:
+        for k in range(max_steps):
+            step = step/2
+            e = error(step)
+            tried.append((step, e['error']))
+            if e['error'] <= tol:
+                break
+        else:
+            raise ValueError('%s: estimated error %.3g > %g down to dt = %g ms' % (p['title'], e['error'], tol, step))
+
+    return step, dict(dt=step, method=method, probes=[float(x) for x in p['sweep']], tried=tried, **e)
@@ -0,0 +1,261 @@
+# The following script is the benchmark harness of the protocols: each of the five protocols is run
+# with each backend of run_protocol.py (exact, batch, spectral, record, loop) and each time step, every
+# case in a fresh process (so that NEURON starts clean and the peak memory is that of the case), and
+# the wall time, the time steps per second, the time per sweep and the peak memory (resident set) are
+# reported and saved as JSON. The steps are those of the fixed time grid dt over all the sweeps (for
+# the exact and spectral backends, which do not step, the equivalent number), so backends compare.
+#
+# It also contains microbenchmarks (finding_state_variables with and without its cache, batched
+# steady states, the rate functions of na15_kinetics.py and one NEURON fadvance() of na15 with and
+# without its rate tables) and scaling curves: wall time versus number of sweep points, a subset of
+# the sweep of the specification, with the fitted cost per sweep and fixed cost. e.g.
+#
+#   python benchmark.py 3 5 --backends exact,record --dt 0.025,0.075 --scaling 5,10,25,50 --out bench.json
+#   python benchmark.py --compare bench.json --out bench_new.json
+#
+# the second line reruns the cases of bench.json and reports the ratio of the wall times.
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import importlib.metadata
+import resource
+import multiprocessing
+
+import numpy as np
+
+from protocols import protocol, compile_spec, sweep_levels
+from run_protocol import run_protocol, backends
+
+dtype = np.float64
+
+default_backends = ('exact', 'spectral', 'batch', 'record')
+max_steps_default = 2e7         # cases with more steps (over all the sweeps) are skipped
+batch_backends = ('batch', 'loop')  # backends for which max_steps applies (memory / python loop)
+
+
+def rss_mb():
+    """Current resident set of this process (MB)."""
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+
+
+def sweep_steps(p, dt):
+    """Number of time steps of the fixed grid dt over all the sweeps of protocol p."""
+
+    durs, amps = sweep_levels(p)
+    return int(np.round(durs.sum(axis=1)/dt).sum())
+
+
+def subsampled_spec(number, n_sweeps=None):
+    """Specification of protocol 'number' with n_sweeps points of its sweep, spread over its range."""
+
+    p = protocol(number)
+    spec = dict(p['spec'])
+    if n_sweeps is not None and n_sweeps < len(p['sweep']):
+        idx = np.unique(np.round(np.linspace(0, len(p['sweep'])-1, n_sweeps)).astype(int))
+        spec['sweep'] = dict(name=spec['sweep']['name'], values=[float(x) for x in np.asarray(p['sweep'])[idx]])
+    return spec
+
+
+def _run_case(case):
+    spec, backend, dt, ss_tol, repeat = case
+    p = compile_spec(spec)
+    start = time.perf_counter()
+    import scipy.linalg         # imported at the first use by the backends: not part of the case
+    if backend in ('record', 'loop'):
+        import neuron_record, sweep_pool, state_variables
+    imports = time.perf_counter()-start
+    rss0 = rss_mb()
+    walls = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        run_protocol(p, backend, dt, ss_tol)
+        walls.append(time.perf_counter()-start)
+    return dict(wall=min(walls), walls=walls, import_s=imports, rss_before_mb=rss0, peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024)
+
+
+def run_case(number, backend, dt=None, ss_tol=None, n_sweeps=None, max_steps=max_steps_default, isolate=True, repeat=1):
+    """Benchmark of one protocol/backend/dt (dt None: that of the specification), in a fresh process
+    unless isolate is False; wall is the best of repeat runs. Returns a dict with the case and wall, steps_per_second, time_per_sweep
+    and peak_rss_mb (or 'skipped' and the reason)."""
+
+    spec = subsampled_spec(number, n_sweeps)
+    p = compile_spec(spec)
+    dt = p['dt'] if dt is None else dt
+    steps = sweep_steps(p, dt)
+    result = dict(protocol=number, title=p['title'], backend=backend, dt=dt, ss_tol=ss_tol, sweeps=len(p['sweep']), steps=steps)
+    if backend == 'spectral' and p['sweep_level'][0] != 'dur':
+        return dict(result, skipped='the spectral backend needs a swept interval')
+    if backend in batch_backends and steps > max_steps:
+        return dict(result, skipped='%d steps > max_steps' % steps)
+
+    case = (spec, backend, dt, ss_tol, repeat)
+    if isolate:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            measured = pool.apply(_run_case, (case,))
+    else:
+        measured = _run_case(case)
+    return dict(result, steps_per_second=steps/measured['wall'], time_per_sweep=measured['wall']/len(p['sweep']), **measured)
+
+
+def scaling(number, backend, points, dt=None, ss_tol=None, isolate=True, repeat=1):
+    """Wall time versus number of sweep points: the cases, and the fitted time = fixed + per_sweep*n."""
+
+    cases = [run_case(number, backend, dt, ss_tol, n, np.inf, isolate, repeat) for n in points]
+    done = [c for c in cases if 'wall' in c]
+    fit = np.polyfit([c['sweeps'] for c in done], [c['wall'] for c in done], 1) if len(done) > 1 else (np.nan, np.nan)
+    return dict(protocol=number, backend=backend, dt=cases[0]['dt'], cases=cases, per_sweep=fit[0], fixed=fit[1])
+
+
+def best_time(f, repeat=5):
+    """Best time (s) of one call of f over repeat timing rounds (timeit, auto-ranged)."""
+
+    timer = timeit.Timer(f)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number))/number
+
+
+def micro_benchmarks(repeat=5):
+    """Per-call times (s) of the state and rate functions, and per step of NEURON with na15."""
+
+    import state_variables
+    from state_variables import finding_state_variables, steady_states
+    from na15_kinetics import transition_rates, rate_matrix
+
+    v = np.linspace(-150, 50, 100000)
+    cached = lambda: finding_state_variables(-120, 24)
+    def uncached():
+        state_variables._cache.clear()
+        finding_state_variables(-120, 24)
+    def batched():
+        state_variables._cache.clear()
+        steady_states(v[:1000], 24)
+
+    results = [
+        dict(name='finding_state_variables (cached)', time=best_time(cached, repeat)),
+        dict(name='finding_state_variables (uncached)', time=best_time(uncached, repeat)),
+        dict(name='steady_states, 1000 voltages (uncached)', time=best_time(batched, repeat), per=1000),
+        dict(name='transition_rates, 1 voltage', time=best_time(lambda: transition_rates(-20, 24), repeat)),
+        dict(name='transition_rates, 100000 voltages', time=best_time(lambda: transition_rates(v, 24), repeat), per=len(v)),
+        dict(name='rate_matrix, 100000 voltages', time=best_time(lambda: rate_matrix(v, 24), repeat), per=len(v)),
+    ]
+    state_variables._cache.clear()
+
+    try:
+        from neuron import h
+    except ImportError:
+        return results + [dict(name='fadvance na15', skipped='NEURON is not available')]
+    if not hasattr(h, 'na15'):
+        raise ValueError('mechanism na15 is not loaded: compile the .mod files with nrnivmodl and run '
+                         'from their directory')
+    soma = h.Section(name='benchmark_soma')
+    soma.insert('na15')
+    clamp = h.VClamp(soma(0.5))
+    clamp.dur[0], clamp.amp[0] = 1e9, -20
+    h.dt = 0.025
+    h.finitialize(-120)
+    usetable_na15 = h.usetable_na15
+    for usetable in (1, 0):
+        h.usetable_na15 = usetable
+        h.finitialize(-120)
+        results.append(dict(name='fadvance na15, usetable_na15 = %d' % usetable, time=best_time(h.fadvance, repeat)))
+    h.usetable_na15 = usetable_na15
+    return results
+
+
+def compare(old, new, tolerance=0.1):
+    """Pairs of matching cases (protocol, backend, dt, sweeps, ss_tol) of two benchmark results with the
+    ratio of their wall times; the ratios above 1+tolerance are flagged."""
+
+    key = lambda c: (str(c['protocol']), c['backend'], c['dt'], c['sweeps'], c.get('ss_tol'))
+    previous = dict((key(c), c) for c in old['runs'] if 'wall' in c)
+    pairs = []
+    for c in new['runs']:
+        if 'wall' in c and key(c) in previous:
+            ratio = c['wall']/previous[key(c)]['wall']
+            pairs.append(dict(case=key(c), old=previous[key(c)]['wall'], new=c['wall'], ratio=ratio, slower=ratio > 1+tolerance))
+    return pairs
+
+
+def environment():
+    """Versions and machine of the run, saved with the results."""
+
+    info = dict(date=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(), numpy=np.__version__,
+                machine=platform.machine(), processor=platform.processor(), cpus=os.cpu_count())
+    try:
+        info['neuron'] = importlib.metadata.version('neuron')     # without loading NEURON
+    except importlib.metadata.PackageNotFoundError:
+        info['neuron'] = None
+    return info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the protocols, their backends and the Na15 functions.')
+    parser.add_argument('protocols', nargs='*', default=['1', '2', '3', '4', '5'], help='protocol numbers or specification files')
+    parser.add_argument('--backends', default=','.join(default_backends), help='comma-separated, among: %s' % ', '.join(backends[1:]))
+    parser.add_argument('--dt', default=None, help='comma-separated time steps (ms), default: that of each specification')
+    parser.add_argument('--ss-tol', type=float, default=None, help='steady-state fast-forward of the NEURON backends')
+    parser.add_argument('--max-steps', type=float, default=max_steps_default, help='skip batch and loop cases with more steps')
+    parser.add_argument('--scaling', default=None, help='comma-separated numbers of sweep points for the scaling curves')
+    parser.add_argument('--no-micro', action='store_true', help='skip the microbenchmarks')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, the best wall time is kept')
+    parser.add_argument('--in-process', action='store_true', help='run the cases in this process (no isolation of memory and NEURON)')
+    parser.add_argument('--compare', default=None, help='earlier .json results: rerun their cases and report the ratios')
+    parser.add_argument('--out', default=None, help='.json file of the results')
+    args = parser.parse_args(argv)
+
+    isolate = not args.in_process
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        cases = [(c['protocol'], c['backend'], c['dt'], c['sweeps'], c.get('ss_tol')) for c in old['runs'] if 'wall' in c]
+    else:
+        dts = [None] if args.dt is None else [float(dt) for dt in args.dt.split(',')]
+        cases = [(int(n) if n.isdigit() else n, backend, dt, None, args.ss_tol)
+                 for n in args.protocols for backend in args.backends.split(',') for dt in dts]
+
+    results = dict(environment=environment(), runs=[], micro=[], scaling=[])
+    for number, backend, dt, n_sweeps, ss_tol in cases:
+        case = run_case(number, backend, dt, ss_tol, n_sweeps, args.max_steps, isolate, args.repeat)
+        results['runs'].append(case)
+        if 'skipped' in case:
+            print('%-45s %-8s dt %-6g skipped: %s' % (case['title'], backend, case['dt'], case['skipped']))
+        else:
+            print('%-45s %-8s dt %-6g %8.3f s  %10.3g steps/s  %8.4f s/sweep  %7.1f MB'
+                  % (case['title'], backend, case['dt'], case['wall'], case['steps_per_second'], case['time_per_sweep'], case['peak_rss_mb']))
+
+    if args.scaling and not args.compare:
+        points = [int(n) for n in args.scaling.split(',')]
+        for n in args.protocols:
+            for backend in args.backends.split(','):
+                if backend == 'spectral' and protocol(int(n) if n.isdigit() else n)['sweep_level'][0] != 'dur':
+                    continue
+                curve = scaling(int(n) if n.isdigit() else n, backend, points, None if args.dt is None else float(args.dt.split(',')[0]),
+                                args.ss_tol, isolate, args.repeat)
+                results['scaling'].append(curve)
+                print('scaling %s %-8s %.4f s/sweep + %.3f s' % (n, backend, curve['per_sweep'], curve['fixed']))
+
+    if not args.no_micro and not args.compare:
+        results['micro'] = micro_benchmarks()
+        for m in results['micro']:
+            if 'skipped' in m:
+                print('%-45s skipped: %s' % (m['name'], m['skipped']))
+            else:
+                print('%-45s %10.3g s%s' % (m['name'], m['time'], '  (%.3g s each)' % (m['time']/m['per']) if 'per' in m else ''))
+
+    if args.compare:
+        for pair in compare(old, results):
+            print('%-40s %8.3f s -> %8.3f s  x%.2f%s' % (pair['case'][:3], pair['old'], pair['new'], pair['ratio'], '  SLOWER' if pair['slower'] else ''))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1, default=float)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,80 @@
+# The following script compares the accuracy versus dt of the two NEURON mechanisms of the model:
+#   na15   Na15.mod, the states integrated by METHOD cnexp (one exponential step per equation, the
+#          other states being held at their values at the beginning of the step)
+#   na15k  Na15k.mod, the same model as a KINETIC scheme with CONSERVE, solved by METHOD sparse
+#          (implicit: stable at any dt)
+# For each protocol, mechanism and dt the protocol runs on NEURON (record backend of run_protocol.py)
+# and its peak currents and main curve are compared with those of the exact engine of na15_kinetics.py
+# sampled on the same time grid, which has no integration error: the differences are those of the
+# time integration only. e.g.
+#
+#   python compare_mechanisms.py 4 5 --dt 0.05,0.1,0.2,0.5 --out mechanisms.json
+#
+# prints, per case, the largest error of the main curve, that of the peak currents relative to the
+# largest peak of their window, whether the run stayed finite and its wall time.
+
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from protocols import protocol, exact_peaks, main_curve
+from run_protocol import neuron_peaks
+
+dtype = np.float64
+
+mechanisms = ('na15', 'na15k')
+
+
+def compare(number, dts, mechanisms=mechanisms, ss_tol=1e-9, processes=1):
+    """Errors of the NEURON mechanisms against the exact engine for protocol 'number' at each dt of dts.
+    Returns a list of dict(title, mechanism, dt, curve_error, ipeak_error, finite, time)."""
+
+    p = protocol(number)
+    results = []
+    for dt in dts:
+        ipeak_exact, gpeak_exact = exact_peaks(p, dt)
+        curve_exact = main_curve(p, ipeak_exact, gpeak_exact)
+        scale = np.abs(ipeak_exact).max(axis=0)
+        for mechanism in mechanisms:
+            start = time.time()
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                ipeak, gpeak = neuron_peaks(p, dt, True, ss_tol, processes, mechanism=mechanism)
+                curve = main_curve(p, ipeak, gpeak)
+            finite = bool(np.isfinite(ipeak).all() and np.isfinite(curve).all())
+            results.append(dict(title=p['title'], mechanism=mechanism, dt=float(dt), finite=finite,
+                                curve_error=float(np.abs(curve-curve_exact).max()) if finite else np.inf,
+                                ipeak_error=float((np.abs(ipeak-ipeak_exact)/scale).max()) if finite else np.inf,
+                                time=time.time()-start))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Accuracy versus dt of the na15 (cnexp) and na15k (KINETIC) mechanisms.')
+    parser.add_argument('protocols', nargs='+', help='protocol number (1 to 5) or specification file (.json, .toml)')
+    parser.add_argument('--dt', default='0.05,0.1,0.2,0.5', help='comma-separated time steps (ms)')
+    parser.add_argument('--mechanisms', default=','.join(mechanisms), help='comma-separated mechanisms')
+    parser.add_argument('--ss-tol', type=float, default=1e-9, help='steady-state fast-forward of run_clamp (0: step every level)')
+    parser.add_argument('--processes', type=int, default=1, help='processes for the sweeps')
+    parser.add_argument('--out', default=None, help='JSON file of the results')
+    args = parser.parse_args(argv)
+
+    dts = [float(dt) for dt in args.dt.split(',')]
+    results = []
+    for name in args.protocols:
+        rows = compare(int(name) if name.isdigit() else name, dts, args.mechanisms.split(','), args.ss_tol or None, args.processes)
+        print(rows[0]['title'])
+        print('%-8s %8s %12s %12s %8s' % ('', 'dt (ms)', 'curve error', 'peak error', 'time (s)'))
+        for r in rows:
+            print('%-8s %8g %12.3e %12.3e %8.2f%s' % (r['mechanism'], r['dt'], r['curve_error'], r['ipeak_error'], r['time'],
+                                                    '' if r['finite'] else '  (not finite)'))
+        results += rows
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,386 @@
+# The following script contains the five-states Na15 kinetic scheme written as a linear system
+# dx/dt = Q(v) x, with x = [C1, C2, O1, I1, I2], and a function 'exact_clamp(segments, v_init, celsius)'
+# which propagates the state exactly with matrix exponentials across the piecewise-constant levels of
+# a voltage clamp. Rates are the same rates2/Q10 expressions used by Na15.mod and state_variables.py.
+
+import math
+import sys
+
+import numpy as np
+
+dtype = np.float64
+
+states = ('C1', 'C2', 'O1', 'I1', 'I2')
+
+### parameters (same names and default values as the PARAMETER block of Na15.mod)
+na15_parameters = {
+    'C1C2b2': 8,        'C1C2v2': -16,      'C1C2k2': -9,
+
+    'C2C1b1': 2,        'C2C1v1': -82,      'C2C1k1': 5,
+    'C2C1b2': 8,        'C2C1v2': -16,      'C2C1k2': -9,
+
+    'C2O1b2': 8,        'C2O1v2': -26,      'C2O1k2': -9,
+
+    'O1C2b1': 3,        'O1C2v1': -92,      'O1C2k1': 5,
+    'O1C2b2': 8,        'O1C2v2': -26,      'O1C2k2': -9,
+
+    'O1I1b1': 8,        'O1I1v1': -50,      'O1I1k1': 4,
+    'O1I1b2': 6,        'O1I1v2': 10,       'O1I1k2': -100,
+
+    'I1O1b1': 0.00001,  'I1O1v1': -20,      'I1O1k1': 10,
+
+    'I1C1b1': 0.35,     'I1C1v1': -122,     'I1C1k1': 9,
+
+    'C1I1b2': 0.04,     'C1I1v2': -78,      'C1I1k2': -10,
+
+    'I1I2b2': 0.00018,  'I1I2v2': -60,      'I1I2k2': -5,
+
+    'I2I1b1': 0.001825, 'I2I1v1': -88,      'I2I1k1': 31,
+}
+
+gbar_default = 0.1      # mho/cm2
+ena_default  = 65       # mV
+
+table_points = 2501     # WITH of the rate TABLEs of Na15.mod and Na15k.mod, fixed when they are compiled
+
+# (from, to) indices of the ten transitions, in the order returned by transition_rates
+transitions = {
+    'C1C2_a': (0, 1), 'C2C1_a': (1, 0),
+    'C2O1_a': (1, 2), 'O1C2_a': (2, 1),
+    'O1I1_a': (2, 3), 'I1O1_a': (3, 2),
+    'I1C1_a': (3, 0), 'C1I1_a': (0, 3),
+    'I1I2_a': (3, 4), 'I2I1_a': (4, 3),
+}
+
+
+def expm(A):
+    """scipy.linalg.expm, imported at the first call: the NEURON scripts only need numpy from here."""
+
+    from scipy.linalg import expm
+    return expm(A)
+
+
+def rates2(v, b, vv, k, exp=np.exp):
+    return b/(1+exp((v-vv)/k))
+
+
+def q10(celsius):
+    return 3**((np.asarray(celsius, dtype)-20)/10)
+
+
+def transition_rates(v, celsius, params=None):
+    """Ten transition rates (1/ms) at voltage v (mV), as in PROCEDURE rates of Na15.mod.
+    v and celsius may be arrays, they are broadcast against each other; python floats give floats."""
+
+    p = na15_parameters if params is None else {**na15_parameters, **params}
+    if isinstance(v, float) and isinstance(celsius, float):     # one voltage and temperature: no arrays
+        try:
+            return _transition_rates(v, 3**((celsius-20)/10), p, math.exp)
+        except OverflowError:       # beyond the float range, where np.exp gives inf and the rate 0
+            pass
+    return _transition_rates(np.asarray(v, dtype), q10(celsius), p, np.exp)
+
+
+def _transition_rates(v, Q10, p, exp):
+
+    def r(name, branch):
+        return rates2(v, p[name+'b'+branch], p[name+'v'+branch], p[name+'k'+branch], exp)
+
+    return {
+        'C1C2_a': Q10*(r('C1C2', '2')),
+        'C2C1_a': Q10*(r('C2C1', '1') + r('C2C1', '2')),
+        'C2O1_a': Q10*(r('C2O1', '2')),
+        'O1C2_a': Q10*(r('O1C2', '1') + r('O1C2', '2')),
+        'O1I1_a': Q10*(r('O1I1', '1') + r('O1I1', '2')),
+        'I1O1_a': Q10*(r('I1O1', '1')),
+        'I1C1_a': Q10*(r('I1C1', '1')),
+        'C1I1_a': Q10*(r('C1I1', '2')),
+        'I1I2_a': Q10*(r('I1I2', '2')),
+        'I2I1_a': Q10*(r('I2I1', '1')),
+    }
+
+
+def rate_matrix(v, celsius, params=None):
+    """Transition-rate matrix Q with shape v.shape+(5,5), such that dx/dt = Q @ x.
+    Q[..., i, j] is the rate from state j to state i; every column sums to zero."""
+
+    return matrix_from_rates(transition_rates(v, celsius, params))
+
+
+def matrix_from_rates(rates):
+    """Rate matrix Q (as rate_matrix) from a dict of the ten transition rates, e.g. C1C2_a."""
+
+    shape = np.broadcast(*rates.values()).shape
+    Q = np.zeros(shape+(5, 5), dtype)
+    for name, (i, j) in transitions.items():
+        Q[..., j, i] += rates[name]
+        Q[..., i, i] -= rates[name]
+    return Q
+
+
+def equilibrium(Q):
+    """Occupancies x with Q @ x = 0 and C1+C2+O1+I1+I2 = 1."""
+
+    A = np.array(Q, dtype)
+    A[..., -1, :] = 1   # conservation law C1+C2+O1+I1+I2 = 1 replaces the last equation
+    b = np.zeros(A.shape[:-1], dtype)
+    b[..., -1] = 1
+    return np.linalg.solve(A, b[..., None])[..., 0]
+
+
+def steady_state(v, celsius, params=None):
+    """Equilibrium occupancies [C1, C2, O1, I1, I2] at a constant voltage v (mV)."""
+
+    return equilibrium(rate_matrix(v, celsius, params))
+
+
+def segment_levels(segments):
+    """Durations, amplitudes, start and end times of (dur, amp) clamp segments."""
+
+    segments = np.asarray(segments, dtype).reshape(-1, 2)
+    durs, amps = segments[:, 0], segments[:, 1]
+    ends = np.cumsum(durs)
+    return durs, amps, ends-durs, ends
+
+
+def eigenmodes(Q):
+    """Eigenmodes (lam, V, W = V^-1) of the rate matrices Q (..., 5, 5): expm(Q*tau) = V diag(exp(lam*tau)) W."""
+
+    lam, V = np.linalg.eig(Q)
+    return lam, V, np.linalg.inv(V)
+
+
+def propagate_modes(modes, x0, tau):
+    """States x(tau) = expm(Q*tau) @ x0 from the eigenmodes (lam, V, W) of Q, so that any number of
+    offsets tau (ms) and initial states x0 (..., 5) cost one eigendecomposition instead of one expm
+    each. tau[..., None]*lam, broadcast against the modal coordinates of x0, gives the shape of the
+    result (e.g. tau (n_t,) and x0 (5,) give (n_t, 5)); lam may have leading axes (e.g. scaled by Q10)."""
+
+    lam, V, W = modes
+    c = np.asarray(x0) @ np.swapaxes(W, -1, -2)                         # modal coordinates
+    return np.real((np.exp(np.asarray(tau, dtype)[..., None]*lam)*c) @ np.swapaxes(V, -1, -2))
+
+
+def propagator(modes, tau):
+    """expm(Q*tau) (5 x 5) from the eigenmodes (lam, V, W) of Q."""
+
+    lam, V, W = modes
+    return np.real((V*np.exp(lam*tau)) @ W)
+
+
+def propagate_samples(Q, x0, tau):
+    """States x(tau) = expm(Q*tau) @ x0 (len(tau) x 5) at the offsets tau (ms), through the eigenmodes of Q."""
+
+    return propagate_modes(eigenmodes(Q), x0, np.asarray(tau, dtype))
+
+
+def exact_clamp(segments, v_init, celsius, t_sample=None, params=None, gbar=gbar_default, ena=ena_default, x_init=None):
+    """Exact response of Na15 to a piecewise-constant voltage clamp.
+
+    segments is a sequence of (dur, amp) pairs, as in f3cl.dur[j]/f3cl.amp[j]. The state starts at
+    equilibrium at v_init (as after h.finitialize), or at x_init if given (e.g. iC1..iI2 of the
+    mechanism), and is only evaluated at the times in t_sample
+    (default: the segment boundaries). As in vclmp_pl.mod, a time equal to a boundary belongs to the
+    following level.
+
+    Returns t, v, x (len(t) x 5 occupancies) and ina (mA/cm2)."""
+
+    durs, amps, starts, ends = segment_levels(segments)
+    t = np.concatenate(([0], ends)) if t_sample is None else np.atleast_1d(np.asarray(t_sample, dtype))
+    if t.size and (t.min() < 0 or t.max() > ends[-1]):
+        raise ValueError('sample times must lie between 0 and the end of the clamp (%g ms)' % ends[-1])
+
+    idx = np.minimum(np.searchsorted(ends, t, side='right'), len(durs)-1)
+    Q = rate_matrix(amps, celsius, params)
+    x0 = steady_state(v_init, celsius, params) if x_init is None else np.asarray(x_init, dtype)
+    x = np.empty((len(t), 5), dtype)
+
+    for j in range(len(durs)):
+        sel = idx == j
+        if sel.any():
+            x[sel] = propagate_samples(Q[j], x0, t[sel]-starts[j])
+        if durs[j] > 0:
+            x0 = expm(Q[j]*durs[j]) @ x0
+
+    v = amps[idx]
+    ina = gbar*x[:, 2]*(v-ena)
+    return t, v, x, ina
+
+
+def batch_clamp(durs, amps, v_init, celsius, dt, params=None, gbar=gbar_default, ena=ena_default, windows=None):
+    """Runs every sweep of a protocol together on the fixed time grid k*dt. durs and amps are
+    (n_sweeps, n_levels) arrays (they are broadcast against each other), one row of
+    f3cl.dur[j]/f3cl.amp[j] per sweep.
+
+    The rate matrices of all sweeps and levels are built, eigendecomposed and exponentiated at once
+    by broadcasting; the samples inside each constant level are then evaluated in closed form from
+    its eigenmodes (as exact_clamp), without stepping through the grid. Samples taken after the end
+    of a sweep (h.tstop = sum of its durations) are masked with NaN.
+
+    With windows ((j, start, end) as in peak_analysis.py) only the grid points covering the windows
+    are evaluated: t is then (n_sweeps x n_samples), the rows padded with NaN, instead of the whole grid.
+
+    Returns t (n_t), v, g = gbar*O1 and ina (n_sweeps x n_t), and the states at the end of each sweep (n_sweeps x 5)."""
+
+    durs, amps = np.broadcast_arrays(np.atleast_2d(np.asarray(durs, dtype)), np.atleast_2d(np.asarray(amps, dtype)))
+    n, L = durs.shape
+    ends = np.cumsum(durs, axis=1)
+    starts = ends-durs
+    total = ends[:, -1]
+
+    n_t = int(np.ceil(total.max()/dt - 1e-9))
+    t = np.arange(n_t)*dt
+    last = np.searchsorted(t, total)                            # samples before h.tstop, per sweep
+    if windows is None:
+        samples = [np.arange(k) for k in last]
+    else:
+        samples = [np.unique(np.concatenate([np.arange(np.floor((starts[i, j]+start)/dt), np.ceil((starts[i, j]+end)/dt)+1)
+                                             for j, start, end in windows])).astype(int) for i in range(n)]
+        samples = [k[(k >= 0) & (k < last[i])] for i, k in enumerate(samples)]
+
+    Q = rate_matrix(amps, celsius, params)                      # (n_sweeps, n_levels, 5, 5)
+    lam, V, W = eigenmodes(Q)
+    P = expm(Q*durs[..., None, None])                           # propagators across each whole level
+    x0 = steady_state(v_init, celsius, params)
+
+    m = max(len(k) for k in samples)
+    ts = np.full((n, m), np.nan)
+    v = np.full((n, m), np.nan)
+    o1 = np.full((n, m), np.nan)
+    x_end = np.empty((n, 5), dtype)
+    for i, k in enumerate(samples):
+        ti = k*dt
+        bounds = np.searchsorted(ti, ends[i])                   # a sample at a boundary belongs to the next level
+        ts[i, :len(k)] = ti
+        x = x0
+        for j in range(L):
+            sel = slice(bounds[j-1] if j else 0, bounds[j])
+            if sel.stop > sel.start:
+                o1[i, sel] = propagate_modes((lam[i, j], V[i, j], W[i, j]), x, ti[sel]-starts[i, j])[:, 2]
+                v[i, sel] = amps[i, j]
+            x = P[i, j] @ x
+        x_end[i] = x
+
+    g = gbar*o1
+    return (t if windows is None else ts), v, g, g*(v-ena), x_end
+
+
+def rate_table_error(vmin=None, vmax=None, celsius=None, params=None, refine=20, mechanism='na15'):
+    """Interpolation error of the rate tables of Na15.mod (or Na15k.mod with mechanism='na15k') as
+    NEURON builds them: table_points points from vmin_tab to vmax_tab and linear interpolation, as
+    in its TABLE, measured on a grid 'refine' times finer. vmin, vmax, celsius and params default
+    to the current values in NEURON (h.vmin_tab_na15, ..., h.celsius) when it is loaded with the
+    mechanism, else to the defaults of the .mod file at 24 degC.
+    Returns, for each of the ten rates, the maximum absolute (1/ms) and relative error."""
+
+    built = dict(vmin=-150, vmax=100, celsius=24, params=None)
+    if 'neuron' in sys.modules:
+        h = sys.modules['neuron'].h
+        try:
+            built = dict(vmin=getattr(h, 'vmin_tab_'+mechanism), vmax=getattr(h, 'vmax_tab_'+mechanism), celsius=h.celsius,
+                         params=dict((name, getattr(h, name+'_'+mechanism)) for name in na15_parameters))
+        except AttributeError:      # mechanism not loaded
+            pass
+    vmin, vmax = built['vmin'] if vmin is None else vmin, built['vmax'] if vmax is None else vmax
+    celsius, params = built['celsius'] if celsius is None else celsius, built['params'] if params is None else params
+
+    v_tab = np.linspace(vmin, vmax, table_points)
+    v = np.linspace(vmin, vmax, (table_points-1)*refine+1)
+    table = transition_rates(v_tab, celsius, params)
+    exact = transition_rates(v, celsius, params)
+    error = {}
+    for name in transitions:
+        diff = np.abs(np.interp(v, v_tab, table[name]) - exact[name])
+        error[name] = dict(absolute=diff.max(), relative=(diff/np.abs(exact[name])).max())
+    return error
+
+
+def interval_scan(segments, j_var, intervals, v_init, celsius, windows, dt, params=None, gbar=gbar_default, ena=ena_default):
+    """Peak responses of a protocol whose sweeps differ only in the duration of clamp level j_var
+    (f3cl.dur[j_var]), evaluated in closed form for any number of 'intervals' (ms).
+
+    The rate matrix of each level is eigendecomposed once: the state at the end of level j_var is
+    a sum of its eigenmodes weighted by exp(lambda*interval), and the O1 occupancy inside a later
+    measurement window is a fixed linear map of that state. Windows are (j, start, end) as in
+    peak_analysis.py, sampled on the global time grid k*dt as by exact_clamp and the scripts (the
+    phase of the grid in level j following from its start time); they must not extend past the end
+    of level j (past the shortest interval for j = j_var).
+
+    Returns dict(ipeak, gpeak, tpeak) of shape (n_intervals, n_windows), and the P2/P1 'ratio' when
+    there are two windows. segments gives the other levels; the duration given for j_var is ignored."""
+
+    durs, amps, starts, ends = segment_levels(segments)
+    tau = np.atleast_1d(np.asarray(intervals, dtype))
+    Q = rate_matrix(amps, celsius, params)
+    modes = [eigenmodes(Q[j]) for j in range(len(durs))]
+
+    x = steady_state(v_init, celsius, params)
+    level_state = []                                    # state at the beginning of each level up to j_var
+    for j in range(j_var+1):
+        level_state.append(x)
+        if j < j_var:
+            x = expm(Q[j]*durs[j]) @ x
+    X = propagate_modes(modes[j_var], x, tau).T                # (5, n_intervals) at the end of level j_var
+
+    ipeak = np.empty((len(tau), len(windows)), dtype)
+    gpeak = np.empty_like(ipeak)
+    tpeak = np.empty_like(ipeak)
+    cols = np.arange(len(tau))
+    for w, (j, start, end) in enumerate(windows):
+        limit = tau.min() if j == j_var else durs[j]
+        if end > limit:
+            raise ValueError('measurement window %r extends past the end of clamp level %d' % ((j, start, end), j))
+
+        if j <= j_var:      # level starting before the variable interval ends: at the same time for every interval
+            Xj = level_state[j][:, None]*np.ones(len(tau))
+            t0 = starts[j]*np.ones(len(tau))
+        else:
+            Xj = X
+            for i in range(j_var+1, j):
+                Xj = expm(Q[i]*durs[i]) @ Xj
+            t0 = starts[j] - durs[j_var] + tau
+
+        # samples k*dt of the global time grid with start < k*dt - t0 <= end (as peak_analysis.window_mask),
+        # at offsets first + i*dt from the beginning of the level, the phase 'first' depending on t0
+        eps = 1e-6*dt
+        k_first = np.floor((t0+start+eps)/dt) + 1
+        count = (np.floor((t0+end+eps)/dt) - k_first + 1).astype(int)
+        first = k_first*dt - t0
+        steps = dt*np.arange(count.max())
+        o1 = propagate_modes(modes[j], Xj.T, first+steps[:, None])[..., 2]              # (n_samples, n_intervals)
+
+        ina = gbar*o1*(amps[j]-ena)
+        k = np.argmax(np.where(np.arange(len(steps))[:, None] < count, np.abs(ina), -np.inf), axis=0)
+        ipeak[:, w] = ina[k, cols]
+        gpeak[:, w] = gbar*o1[k, cols]
+        tpeak[:, w] = t0 + first + steps[k]
+
+    peaks = dict(ipeak=ipeak, gpeak=gpeak, tpeak=tpeak)
+    if len(windows) == 2:
+        peaks['ratio'] = np.abs(ipeak[:, 1])/np.abs(ipeak[:, 0])
+    return peaks
+
+
+def settling_time(x, Q, tol, horizon=np.inf):
+    """Time (ms) after which the state x, evolving with the rate matrix Q, is guaranteed to stay within
+    tol (max norm) of the equilibrium of Q, from the bound  |x(t)-x_ss| <= sum_k |c_k v_k| exp(Re(lambda_k) t)
+    over the decaying eigenmodes. Returns (time, x_ss); time is 0 if x is already within tol, and inf
+    if the bound is still above tol at horizon (ms), without searching further."""
+
+    lam, V, W = eigenmodes(Q)
+    c = W @ np.asarray(x, dtype)
+    decaying = np.arange(5) != np.argmin(np.abs(lam))   # all but the zero eigenvalue
+    size = np.abs(c[decaying])*np.abs(V[:, decaying]).max(0)
+    x_ss = equilibrium(Q)
+
+    if size.sum() <= tol:
+        return 0.0, x_ss
+    rate = -np.real(lam[decaying])
+    if np.sum(size*np.exp(-rate*horizon)) > tol:
+        return np.inf, x_ss
+    lo, hi = 0.0, np.max(np.log(np.maximum(size*decaying.sum()/tol, 1))/rate)    # each mode below tol/4
+    hi = min(hi, horizon)
+    for n in range(60):     # the bound decreases with time: bisection for bound = tol
+        mid = 0.5*(lo+hi)
+        lo, hi = (lo, mid) if np.sum(size*np.exp(-rate*mid)) <= tol else (mid, hi)
+    return hi, x_ss
@@ -0,0 +1,169 @@
+# The following script contains the local sensitivities of the protocol curves to the rate parameters
+# of Na15.mod: 'protocol_sensitivity(number)' returns, next to the main curve of exact_protocol, its
+# Jacobian d(curve)/d(parameter) for every point of the curve and every rates2 parameter (b, v, k of
+# na15_parameters) and Q10, the factor 3^((celsius-20)/10) multiplying all the rates.
+#
+# The derivatives are exact for the model (no finite differences, no integration error):
+#   - the initial state, equilibrium of Q(v_init), by implicit differentiation of A x = e, where A is Q
+#     with its last row replaced by the conservation law: dx = -A^-1 dA x;
+#   - the state along each clamp level, x(tau) = expm(Q tau) x_j, by the forward sensitivities
+#     dx(tau) = expm(Q tau) dx_j + d[expm(Q tau)] x_j, the derivative of the matrix exponential being
+#     evaluated on the eigenmodes of Q (divided differences of exp(lambda tau));
+#   - the peaks, at the sample where they are found, and the normalization of the curve.
+
+import numpy as np
+
+from na15_kinetics import (na15_parameters, transitions, rates2, q10, transition_rates, matrix_from_rates,
+                           equilibrium, segment_levels, eigenmodes, propagate_modes, gbar_default, ena_default)
+from protocols import protocol, model_settings, window_times
+from peak_analysis import measure_peaks
+
+dtype = np.float64
+
+sensitivity_names = tuple(na15_parameters) + ('Q10',)
+
+
+def rate_derivatives(v, celsius, params=None, names=sensitivity_names):
+    """dQ/d(parameter) for each of names, shape (len(names),)+v.shape+(5, 5), with Q = rate_matrix(v, celsius)."""
+
+    p = na15_parameters if params is None else {**na15_parameters, **params}
+    v = np.asarray(v, dtype)
+    Q10 = q10(celsius)
+    dQ = np.zeros((len(names),)+v.shape+(5, 5), dtype)
+
+    for n, name in enumerate(names):
+        if name == 'Q10':
+            dQ[n] = matrix_from_rates(transition_rates(v, celsius, params))/Q10
+            continue
+        if name not in na15_parameters:
+            raise ValueError('unknown rate parameter %r' % name)
+        stem, kind, branch = name[:4], name[4], name[5]
+        b, vv, k = p[stem+'b'+branch], p[stem+'v'+branch], p[stem+'k'+branch]
+        e = np.exp((v-vv)/k)
+        if kind == 'b':
+            dr = rates2(v, 1, vv, k)
+        elif kind == 'v':
+            dr = b*e/(1+e)**2/k
+        else:
+            dr = b*e/(1+e)**2*(v-vv)/k**2
+        rate = dict((key, np.zeros_like(v)) for key in transitions)
+        rate[stem+'_a'] = Q10*dr
+        dQ[n] = matrix_from_rates(rate)
+    return dQ
+
+
+def steady_state_sensitivity(v, celsius, params=None, names=sensitivity_names):
+    """Equilibrium x (5) at the constant voltage v and its sensitivities dx/d(parameter) (5 x len(names)),
+    by implicit differentiation of the solve of finding_state_variables."""
+
+    Q = matrix_from_rates(transition_rates(v, celsius, params))
+    x = equilibrium(Q)
+    dQ = rate_derivatives(v, celsius, params, names)
+    A = np.array(Q, dtype)
+    A[-1, :] = 1
+    rhs = dQ @ x
+    rhs[:, -1] = 0      # the conservation law does not depend on the parameters
+    return x, -np.linalg.solve(A, rhs.T)
+
+
+def divided_exp(lam, tau):
+    """Phi[t, i, j] = (exp(lam_i tau_t) - exp(lam_j tau_t))/(lam_i - lam_j), or tau_t exp(lam_i tau_t)
+    when lam_i = lam_j, written so that it neither overflows nor cancels for long intervals."""
+
+    tau = np.asarray(tau, dtype)[:, None, None]
+    li, lj = lam[:, None], lam[None, :]
+    first = li.real >= lj.real
+    hi, lo = np.where(first, li, lj), np.where(first, lj, li)
+    d = hi-lo
+    same = np.abs(d) <= 1e-12*np.maximum(np.abs(hi), 1)
+    ratio = np.where(same, tau, -np.expm1((lo-hi)*tau)/np.where(same, 1, d))
+    return np.exp(hi*tau)*ratio
+
+
+def propagate_sensitivity(Q, dQ, x0, S0, tau):
+    """States x(tau) = expm(Q tau) x0 (len(tau) x 5) and their sensitivities (len(tau) x 5 x n_params)
+    from those of x0 (S0, 5 x n_params) and the derivatives dQ (n_params x 5 x 5) of the rate matrix."""
+
+    lam, V, W = modes = eigenmodes(Q)
+    E = np.exp(np.outer(tau, lam))                              # (n_tau, 5)
+    y0 = W @ x0
+    G = W @ dQ @ V                                              # (n_params, 5, 5) in the eigenbasis
+    x = propagate_modes(modes, x0, tau)
+    S = np.einsum('ki,ti,ip->tkp', V, E, W @ S0, optimize=True)
+    S = S + np.einsum('ki,tij,pij,j->tkp', V, divided_exp(lam, tau), G, y0, optimize=True)
+    return x, np.real(S)
+
+
+def exact_clamp_sensitivity(segments, v_init, celsius, t_sample, params=None, names=sensitivity_names,
+                            gbar=gbar_default, ena=ena_default):
+    """exact_clamp (see na15_kinetics.py) with sensitivities: returns t, v, x (n_t x 5), ina (n_t),
+    dx (n_t x 5 x len(names)) and dina (n_t x len(names))."""
+
+    durs, amps, starts, ends = segment_levels(segments)
+    t = np.atleast_1d(np.asarray(t_sample, dtype))
+    if t.size and (t.min() < 0 or t.max() > ends[-1]):
+        raise ValueError('sample times must lie between 0 and the end of the clamp (%g ms)' % ends[-1])
+
+    idx = np.minimum(np.searchsorted(ends, t, side='right'), len(durs)-1)
+    Q = matrix_from_rates(transition_rates(amps, celsius, params))
+    dQ = rate_derivatives(amps, celsius, params, names)
+    x0, S0 = steady_state_sensitivity(v_init, celsius, params, names)
+    x = np.empty((len(t), 5), dtype)
+    dx = np.empty((len(t), 5, len(names)), dtype)
+
+    for j in range(len(durs)):
+        sel = idx == j
+        if sel.any():
+            x[sel], dx[sel] = propagate_sensitivity(Q[j], dQ[:, j], x0, S0, t[sel]-starts[j])
+        if durs[j] > 0 and j < len(durs)-1:
+            x0, S0 = propagate_sensitivity(Q[j], dQ[:, j], x0, S0, durs[j:j+1])
+            x0, S0 = x0[0], S0[0]
+
+    v = amps[idx]
+    ina = gbar*x[:, 2]*(v-ena)
+    return t, v, x, ina, dx, gbar*dx[:, 2, :]*(v-ena)[:, None]
+
+
+def curve_jacobian(measure, ipeak, gpeak, dipeak, dgpeak):
+    """Main curve (as protocols.main_curve) and its Jacobian (n_sweeps x n_params) from the peaks
+    (n_sweeps x n_windows) and their sensitivities (n_sweeps x n_windows x n_params)."""
+
+    if measure in ('normalized_conductance', 'normalized_current'):
+        y, dy = (gpeak[:, 0], dgpeak[:, 0]) if measure == 'normalized_conductance' else (ipeak[:, 0], dipeak[:, 0])
+        m = np.argmax(y) if measure == 'normalized_conductance' else np.argmin(y)
+        return y/y[m], dy/y[m] - np.outer(y, dy[m])/y[m]**2
+    ratio = np.abs(ipeak[:, 1])/np.abs(ipeak[:, 0])
+    return ratio, ratio[:, None]*(dipeak[:, 1]/ipeak[:, 1, None] - dipeak[:, 0]/ipeak[:, 0, None])
+
+
+def protocol_sensitivity(number, names=sensitivity_names, dt=None, params=None, gbar=None, ena=None, relative=False):
+    """Main curve of protocol 'number' (as exact_protocol, windows sampled every dt) and its Jacobian
+    with respect to the rate parameters 'names' (default: all of na15_parameters and Q10).
+    With relative=True the derivatives are taken with respect to log(parameter), i.e. multiplied by its value.
+
+    Returns dict(x, y, jacobian (n_sweeps x len(names)), names, values)."""
+
+    p = protocol(number)
+    dt, params, gbar, ena = model_settings(p, dt, params, gbar, ena)
+    names = tuple(names)
+    n_w = len(p['windows'])
+    ipeak = np.empty((len(p['sweep']), n_w), dtype)
+    gpeak = np.empty_like(ipeak)
+    dipeak = np.empty((len(p['sweep']), n_w, len(names)), dtype)
+    dgpeak = np.empty_like(dipeak)
+
+    for n, x in enumerate(p['sweep']):
+        segments = p['segments'](x)
+        t_sample = np.unique(np.concatenate([window_times(segments, window, dt) for window in p['windows']]))
+        t, v, s, ina, ds, dina = exact_clamp_sensitivity(segments, p['v_init'], p['celsius'], t_sample, params, names, gbar, ena)
+        peaks = measure_peaks(t, ina, segment_levels(segments)[2], p['windows'], g=gbar*s[:, 2])
+        k = np.searchsorted(t, peaks['tpeak'])
+        ipeak[n], gpeak[n] = peaks['ipeak'], peaks['gpeak']
+        dipeak[n], dgpeak[n] = dina[k], gbar*ds[k, 2, :]
+
+    y, jacobian = curve_jacobian(p['measure'], ipeak, gpeak, dipeak, dgpeak)
+    all_params = dict(na15_parameters, **(params or {}), Q10=float(q10(p['celsius'])))
+    values = np.array([all_params[name] for name in names], dtype)
+    if relative:
+        jacobian = jacobian*values
+    return dict(x=np.asarray(p['sweep'], dtype), y=y, jacobian=jacobian, names=names, values=values)
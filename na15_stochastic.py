@@ -0,0 +1,313 @@
+# The following script contains a stochastic version of the Na15 scheme for a patch of n_channels
+# independent channels, each jumping between C1, C2, O1, I1 and I2 with the rates of Na15.mod
+# (transition_rates of na15_kinetics.py), driven by the clamp segments of the protocols.
+# 'stochastic_clamp(segments, v_init, celsius, n_channels, trials, dt)' simulates many independent
+# trials (patches) at once, as arrays of channel counts (trials x 5), with
+#   gillespie  exact event-by-event simulation (one exponential waiting time per transition and
+#              trial, all trials advanced together), for small n_channels;
+#   binomial   leaps of one time step dt: the channels of each state are split among the five states
+#              by binomial draws with the one-step transition probabilities expm(Q dt) (split exactly
+#              at the level changes), for large n_channels; since the channels are independent and the
+#              voltage constant over the step the leap has no bias, only the samples are every dt.
+# The initial counts are multinomial draws from the steady state at v_init. The current density is
+# ina = gbar*(open channels/n_channels)*(v-ena) (mA/cm2), so its ensemble mean is the deterministic
+# current of exact_clamp.
+#
+# Nothing is stored per trial: the trials are run in chunks and the ensemble mean and variance of ina
+# at every sample, and of the peaks of each trial in the measurement windows, are accumulated online
+# (pairwise merge of the chunk statistics), so millions of trials only cost memory for one chunk.
+# 'noise_analysis(mean, var)' fits the parabola of nonstationary noise analysis, var = i I - I^2/N,
+# giving back the unitary current density i and the number of channels N. The peaks are those of each
+# noisy trial, so with few channels their mean is larger than the peak of the mean current (e.g. the
+# P2/P1 ratio of protocol 3 at 1 ms is 0.27 with 200 channels, 0.214 with 200000 and exactly). e.g.
+#
+#   python na15_stochastic.py 1 --channels 20 --trials 100000 --sweeps -20
+#   python na15_stochastic.py 3 --channels 5000 --trials 10000 --outdir results
+
+import os
+import re
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from na15_kinetics import (na15_parameters, transitions, transition_rates, matrix_from_rates, steady_state,
+                           segment_levels, eigenmodes, propagator, gbar_default, ena_default)
+from protocols import protocol, model_settings, main_curve
+from peak_analysis import window_mask
+from result_bundle import create_bundle, append_columns
+
+dtype = np.float64
+
+gillespie_max = 100     # method 'auto': gillespie up to this many channels, binomial above
+chunk_size = 10000      # trials simulated together (binomial; gillespie uses chunk_size//10)
+
+_source = np.array([i for i, j in transitions.values()])
+_target = np.array([j for i, j in transitions.values()])
+
+
+def initial_counts(x_init, n_channels, trials, rng):
+    """Channel counts (trials x 5) drawn from the occupancies x_init."""
+
+    p = np.clip(np.asarray(x_init, dtype), 0, None)
+    return rng.multinomial(n_channels, p/p.sum(), size=trials)
+
+
+def binomial_step(counts, P, rng):
+    """Counts after one step with the transition probabilities P (P[i, j]: from state j to state i),
+    the channels of each state being split by successive binomial draws."""
+
+    new = np.zeros_like(counts)
+    for j in range(5):
+        remaining = counts[:, j]
+        left = 1.0
+        for i in range(5):
+            if i == 4:
+                k = remaining
+            else:
+                k = rng.binomial(remaining, np.clip(P[i, j]/left, 0, 1) if left > 0 else 0)
+            new[:, i] += k
+            remaining = remaining-k
+            left -= P[i, j]
+    return new
+
+
+def step_matrices(durs, amps, celsius, dt, n_t, params=None):
+    """One-step transition matrices of the grid steps [k dt, (k+1) dt): a list of n_t (5 x 5) arrays,
+    the steps crossing a level change being the product of the matrices of their parts."""
+
+    ends = np.cumsum(durs)
+    Q = matrix_from_rates(transition_rates(amps, celsius, params))
+    modes = [(lam, V, W) for lam, V, W in zip(*eigenmodes(Q))]
+    P = [propagator(m, dt) for m in modes]
+    matrices = []
+    for k in range(n_t):
+        s, t_next = k*dt, (k+1)*dt
+        j = min(int(np.searchsorted(ends, s, side='right')), len(durs)-1)
+        if ends[j] >= t_next or j == len(durs)-1:
+            matrices.append(P[j])
+            continue
+        M = np.eye(5)
+        while s < t_next and j < len(durs):
+            e = min(ends[j], t_next)
+            M = propagator(modes[j], e-s) @ M
+            s, j = e, j+1
+        matrices.append(M)
+    return matrices
+
+
+def gillespie_level(counts, rates, t0, t1, t_sample, rng):
+    """Advances the counts (trials x 5, in place) from t0 to t1 with the constant rates (10, in the
+    order of transitions) event by event; returns the open counts (len(t_sample) x trials) at the
+    sample times of the level (t0 <= t_sample < t1)."""
+
+    trials = len(counts)
+    delta = np.zeros((len(t_sample)+1, trials), counts.dtype)     # change of O1 from the sample on
+    open_start = counts[:, 2].copy()
+    t = np.full(trials, float(t0))
+    active = np.arange(trials)
+    while active.size:
+        a = rates*counts[active][:, _source]
+        a0 = a.sum(1)
+        with np.errstate(divide='ignore'):
+            t_next = t[active] + rng.exponential(1.0, active.size)/a0
+        fire = t_next < t1
+        active, a, a0, t_next = active[fire], a[fire], a0[fire], t_next[fire]
+        r = (np.cumsum(a, 1) < (rng.random(active.size)*a0)[:, None]).sum(1)
+        r = np.minimum(r, len(rates)-1)
+        counts[active, _source[r]] -= 1
+        counts[active, _target[r]] += 1
+        change = (_target[r] == 2).astype(counts.dtype) - (_source[r] == 2)
+        np.add.at(delta, (np.searchsorted(t_sample, t_next, side='left'), active), change)
+        t[active] = t_next
+    return open_start + np.cumsum(delta[:-1], axis=0)
+
+
+def _merge(stats, key, values):
+    """Merges the statistics over axis -1 of values (one column per trial of the chunk) into
+    stats[key] = [n, mean, m2] (Chan et al. pairwise update)."""
+
+    n, mean, m2 = stats[key]
+    m = values.shape[-1]
+    chunk_mean = values.mean(-1)
+    chunk_m2 = ((values-chunk_mean[..., None])**2).sum(-1)
+    d = chunk_mean-mean
+    stats[key] = [n+m, mean+d*m/(n+m), m2+chunk_m2+d**2*n*m/(n+m)]
+
+
+def stochastic_clamp(segments, v_init, celsius, n_channels, trials, dt, method='auto', windows=(), params=None,
+                     gbar=gbar_default, ena=ena_default, chunk=None, seed=None):
+    """Ensemble statistics of the current density of 'trials' patches of n_channels stochastic Na15
+    channels under the clamp segments [(dur, amp), ...], sampled on the grid k*dt (as batch_clamp).
+
+    Returns dict(t, v, mean, var (of ina at each sample), trials, method) and, for each measurement
+    window (see peak_analysis.py), the mean and variance over the trials of the peak current and of
+    the conductance at the peak, ipeak_mean, ipeak_var, gpeak_mean, gpeak_var (n_windows), and with
+    two windows those of the P2/P1 ratio, ratio_mean and ratio_var. The ratio is only defined for the
+    trials in which a channel opened in the P1 window: the others are left out of its statistics and
+    counted in ratio_dropped (ratio_mean and ratio_var are NaN if no trial opened)."""
+
+    if method == 'auto':
+        method = 'gillespie' if n_channels <= gillespie_max else 'binomial'
+    if method not in ('gillespie', 'binomial'):
+        raise ValueError("unknown method %r, expected 'gillespie', 'binomial' or 'auto'" % method)
+    rng = np.random.default_rng(seed)
+    chunk = chunk or (chunk_size//10 if method == 'gillespie' else chunk_size)
+
+    durs, amps, starts, ends = segment_levels(segments)
+    n_t = int(np.ceil(ends[-1]/dt - 1e-9))
+    t = np.arange(n_t)*dt
+    level = np.minimum(np.searchsorted(ends, t, side='right'), len(durs)-1)
+    v = amps[level]
+    scale = gbar/n_channels*(v-ena)                                 # ina per open channel at each sample
+    masks = [window_mask(t, starts[None], window)[0] for window in windows]
+    x_init = steady_state(v_init, celsius, params)
+    if method == 'binomial':
+        matrices = step_matrices(durs, amps, celsius, dt, n_t, params)
+    else:
+        rates = np.array([transition_rates(amps, celsius, params)[name] for name in transitions]).T    # (n_levels, 10)
+
+    stats = dict(ina=[0, np.zeros(n_t), np.zeros(n_t)])
+    for name in ('ipeak', 'gpeak', 'ratio'):
+        stats[name] = [0, np.zeros(len(masks)), np.zeros(len(masks))]
+    done = dropped = 0
+    while done < trials:
+        m = min(chunk, trials-done)
+        counts = initial_counts(x_init, n_channels, m, rng)
+        best = np.full((len(masks), m), -1.0)       # largest |ina| of each trial in each window
+        ipeak = np.zeros((len(masks), m))
+        gpeak = np.zeros((len(masks), m))
+        chunk_stats = dict(ina=[0, np.zeros(n_t), np.zeros(n_t)])
+
+        def block(k0, opened):
+            """Statistics of the open counts of the samples k0, k0+1, ... (rows) of the chunk."""
+            rows = slice(k0, k0+len(opened))
+            ina = opened*scale[rows, None]
+            chunk_stats['ina'][1][rows] = ina.mean(1)
+            chunk_stats['ina'][2][rows] = ((ina-ina.mean(1, keepdims=True))**2).sum(1)
+            for w, mask in enumerate(masks):
+                inside = mask[rows]
+                if inside.any():
+                    values = np.abs(ina[inside])
+                    k = values.argmax(0)
+                    better = values[k, np.arange(m)] > best[w]
+                    best[w, better] = values[k, np.arange(m)][better]
+                    ipeak[w, better] = ina[inside][k, np.arange(m)][better]
+                    gpeak[w, better] = (gbar/n_channels*opened[inside])[k, np.arange(m)][better]
+
+        if method == 'binomial':
+            buffer = []
+            for k in range(n_t):
+                buffer.append(counts[:, 2].copy())
+                if len(buffer) == 256 or k == n_t-1:
+                    block(k+1-len(buffer), np.array(buffer))
+                    buffer = []
+                counts = binomial_step(counts, matrices[k], rng)
+        else:
+            for j in range(len(durs)):
+                inside = (t >= starts[j]) & (t < ends[j]) if j < len(durs)-1 else t >= starts[j]
+                k = np.flatnonzero(inside)
+                opened = gillespie_level(counts, rates[j], starts[j], ends[j], t[k], rng)
+                if len(k):
+                    block(k[0], opened)
+
+        # merge the chunk into the ensemble
+        n, mean, m2 = stats['ina']
+        d = chunk_stats['ina'][1]-mean
+        stats['ina'] = [n+m, mean+d*m/(n+m), m2+chunk_stats['ina'][2]+d**2*n*m/(n+m)]
+        if masks:
+            _merge(stats, 'ipeak', ipeak)
+            _merge(stats, 'gpeak', gpeak)
+            if len(masks) == 2:
+                opened = ipeak[0] != 0          # trials with a P1 peak: the others have no ratio
+                dropped += m-int(opened.sum())
+                if opened.any():
+                    _merge(stats, 'ratio', np.abs(ipeak[1:2, opened])/np.abs(ipeak[0:1, opened]))
+        done += m
+
+    var = lambda key: stats[key][2]/max(stats[key][0]-1, 1)
+    result = dict(t=t, v=v, mean=stats['ina'][1], var=var('ina'), trials=trials, method=method,
+                  ipeak_mean=stats['ipeak'][1], ipeak_var=var('ipeak'), gpeak_mean=stats['gpeak'][1], gpeak_var=var('gpeak'))
+    if len(masks) == 2:
+        defined = stats['ratio'][0] > 0
+        result.update(ratio_mean=float(stats['ratio'][1][0]) if defined else np.nan,
+                      ratio_var=float(var('ratio')[0]) if defined else np.nan, ratio_dropped=dropped)
+    return result
+
+
+def noise_analysis(mean, var, select=None):
+    """Nonstationary noise analysis: least-squares fit of var = i*mean - mean^2/N over the samples
+    (select: boolean mask, default those with a current). Returns dict(i, N) (i in the units of mean)."""
+
+    mean, var = np.asarray(mean, dtype), np.asarray(var, dtype)
+    select = np.abs(mean) > 1e-3*np.abs(mean).max() if select is None else select
+    A = np.stack([mean[select], mean[select]**2], axis=1)
+    (i, b), *rest = np.linalg.lstsq(A, var[select], rcond=None)
+    return dict(i=float(i), N=float(-1/b) if b != 0 else np.inf)
+
+
+def stochastic_protocol(number, n_channels, trials, dt=None, method='auto', sweeps=None, params=None, gbar=None,
+                        ena=None, chunk=None, seed=None):
+    """stochastic_clamp for every sweep value of protocol 'number' (or only those of 'sweeps').
+    Returns x, y (main curve of the ensemble-mean peaks, as exact_protocol) and the list of the
+    stochastic_clamp results, each with its noise analysis (key 'noise', see noise_analysis)."""
+
+    p = protocol(number)
+    dt, params, gbar, ena = model_settings(p, dt, params, gbar, ena)
+    x = np.asarray(p['sweep'] if sweeps is None else sweeps, dtype)
+    rng = np.random.default_rng(seed)
+    results = []
+    for value in x:
+        r = stochastic_clamp(p['segments'](value), p['v_init'], p['celsius'], n_channels, trials, dt, method,
+                             p['windows'], params, gbar, ena, chunk, rng)
+        r['noise'] = noise_analysis(r['mean'], r['var'])
+        results.append(r)
+    y = main_curve(p, np.array([r['ipeak_mean'] for r in results]), np.array([r['gpeak_mean'] for r in results]))
+    return x, y, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs clamp protocols on patches of stochastic Na15 channels.')
+    parser.add_argument('protocols', nargs='+', help='protocol number (1 to 5) or specification file (.json, .toml)')
+    parser.add_argument('--channels', type=int, required=True, help='channels per patch')
+    parser.add_argument('--trials', type=int, default=1000, help='independent patches per sweep value')
+    parser.add_argument('--method', default='auto', choices=('auto', 'gillespie', 'binomial'))
+    parser.add_argument('--dt', type=float, default=None, help='sampling step (ms), default: that of the specification')
+    parser.add_argument('--sweeps', default=None, help='comma-separated sweep values (default: the sweep of the specification)')
+    parser.add_argument('--chunk', type=int, default=None, help='trials simulated together')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--outdir', default=None, help='directory of the result bundles (default: none written)')
+    args = parser.parse_args(argv)
+
+    sweeps = [float(x) for x in args.sweeps.split(',')] if args.sweeps else None
+    for name in args.protocols:
+        p = protocol(int(name) if name.isdigit() else name)
+        start = time.time()
+        x, y, results = stochastic_protocol(p, args.channels, args.trials, args.dt, args.method, sweeps,
+                                            chunk=args.chunk, seed=args.seed)
+        print('%s: %d sweeps x %d trials of %d channels, %s, %.2f s'
+              % (p['title'], len(x), args.trials, args.channels, results[0]['method'], time.time()-start))
+        for value, r in zip(x, results):
+            print('%s %g: ipeak %s +- %s, noise analysis N = %.1f, i = %.3g' % (p['sweep_name'], value, r['ipeak_mean'],
+                  np.sqrt(r['ipeak_var']), r['noise']['N'], r['noise']['i']))
+            if 'ratio_mean' in r:
+                print('    P2/P1 %.4g +- %.2g (%d trials without a P1 peak left out)'
+                      % (r['ratio_mean'], np.sqrt(r['ratio_var']), r['ratio_dropped']))
+        if args.outdir:
+            if not os.path.isdir(args.outdir):
+                os.makedirs(args.outdir)
+            dt = model_settings(p, args.dt)[0]
+            bundle = os.path.join(args.outdir, p['outputs'].get('bundle', re.sub(r'\W+', '_', p['title']).strip('_'))+'_stochastic')
+            create_bundle(bundle, dict(title=p['title'], backend='stochastic', method=results[0]['method'], dt=dt,
+                                       channels=args.channels, trials=args.trials, seed=args.seed,
+                                       parameters=dict(na15_parameters, **(p['params'] or {})), spec=p['spec']))
+            append_columns(bundle, **{p['sweep_name']: x, p['measure']: y,
+                                      'ipeak_mean': np.array([r['ipeak_mean'] for r in results]),
+                                      'ipeak_var': np.array([r['ipeak_var'] for r in results]),
+                                      'noise_N': np.array([r['noise']['N'] for r in results]),
+                                      'noise_i': np.array([r['noise']['i'] for r in results])})
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,323 @@
+# The following script contains a function 'run_clamp(f3cl, seg, v_init)' which runs a single voltage
+# clamp trace up to h.tstop and returns time, voltage, current density and na15 conductance as NumPy
+# arrays. With record_mode=True the time loop stays inside NEURON (Vector.record and h.continuerun),
+# otherwise the trace is stepped from python with h.fadvance() as in the original scripts.
+# Optionally, clamp levels on which the na15 state reaches its steady state are jumped over.
+# The channel mechanism is either na15 (Na15.mod) or na15k (Na15k.mod, the same model as a KINETIC
+# scheme), whichever is inserted in the section of seg. Their rate tables are switched off when this
+# module is loaded, and on again with use_rate_tables(True) (--rate-tables of the scripts).
+# With CVODE active the trace is sampled at the variable time steps (see vclmp_cvode.mod for a clamp).
+# With ideal=True the clamp is ideal: v is prescribed from the clamp levels, the amplifier of the clamp
+# is not simulated and the current density is read from the na15 state, gbar*O1*(v-ena).
+# The trace can also be handed over level by level as it is computed (pieces), so that a long trace
+# is never held in memory as a whole: 'clamp_peaks' measures the peaks of the pieces and appends them
+# to a result bundle.
+# When the phase timers are enabled (see phase_timers.py) the phases of each trace are timed.
+
+from time import perf_counter
+from contextlib import contextmanager
+
+from neuron import h
+import numpy as np
+
+from na15_kinetics import states, transitions, matrix_from_rates, settling_time
+from peak_analysis import measure_peaks, merge_peaks
+from trace_decimation import decimate_trace
+from result_bundle import append_trace
+import phase_timers
+from phase_timers import phase
+
+dtype = np.float64
+
+h.load_file('stdrun.hoc')   # h.continuerun
+
+mechanisms = ('na15', 'na15k')      # SUFFIX of Na15.mod (cnexp) and of Na15k.mod (KINETIC, sparse)
+
+
+def use_rate_tables(on=True):
+    """Switches the rate tables of na15 and na15k (h.usetable_na15, h.usetable_na15k) on or off, for
+    those of the two mechanisms that are loaded. NMODL loads them with their tables on; the tables
+    change the peaks by up to 2.5e-5 (relative) for no measurable gain in speed, so they are off
+    unless asked for (see Na15.mod)."""
+
+    for name in mechanisms:
+        if hasattr(h, 'usetable_'+name):
+            setattr(h, 'usetable_'+name, int(bool(on)))
+
+
+use_rate_tables(False)
+
+
+def na15_mechanism(seg):
+    """Name of the na15 mechanism inserted at seg: 'na15' or 'na15k'."""
+
+    for name in mechanisms:
+        if seg.sec.has_membrane(name):
+            return name
+    raise ValueError('neither of %s is inserted in %s' % (', '.join(mechanisms), seg.sec.name()))
+
+
+def na15_state(seg):
+    """Current [C1, C2, O1, I1, I2] of na15 at seg (I2 is not integrated by Na15.mod: 1-C1-C2-O1-I1)."""
+
+    x = [getattr(getattr(seg, na15_mechanism(seg)), s) for s in states[:4]]
+    return np.array(x+[1-sum(x)], dtype)
+
+
+def na15_rate_matrix(seg):
+    """Rate matrix of na15 at seg from the transition rates last evaluated by NEURON (RANGE C1C2_a, ...),
+    i.e. at the present voltage, as tabulated by Na15.mod."""
+
+    mech = getattr(seg, na15_mechanism(seg))
+    return matrix_from_rates(dict((name, getattr(mech, name)) for name in transitions))
+
+
+def run_clamp(f3cl, seg, v_init, record_mode=True, ss_tol=None, ideal=False, pieces=None):
+    """Single trace of the clamp f3cl on the segment seg, sampled at every time step with t < h.tstop.
+    Returns t (ms), v (mV), dens (clamping current density minus capacitive current, mA/cm2)
+    and g (na15 conductance, mho/cm2).
+
+    With ss_tol (e.g. 1e-9) the time after which the na15 state provably stays within ss_tol of its
+    steady state (settling_time in na15_kinetics.py) is evaluated once, at the start of every clamp
+    level; a level that settles before its end is stepped only until then, the state is set to the
+    steady state and the rest of the level is crossed in one NEURON step to its last grid point, the
+    samples in between being filled in with the steady-state values on the same time grid. A level
+    that does not settle in time costs one bound, and is stepped as without ss_tol.
+
+    With CVODE active (h.CVode().active(1), with a clamp that supports it: VClamp_cvode) the samples
+    are those of the variable time steps and ss_tol is ignored.
+
+    With ideal=True the clamp is ideal (see ideal_clamp): v is prescribed from the levels of f3cl,
+    which is switched off, and dens is the current of the na15 state, gbar*O1*(v-ena), instead of the
+    clamp current minus the capacitive current; the mechanism is stepped by NEURON as with the full
+    clamp. With ideal='check' the trace of the full clamp is computed as well and compared with the
+    ideal one (see check_ideal_clamp).
+
+    With pieces (a function) the trace is not returned but handed over in consecutive pieces, one
+    per clamp level, as pieces(t, v, dens, g): the samples already handed over are dropped from the
+    recordings, so that only one level is held in memory at a time (both traces with ideal='check')."""
+
+    if ideal == 'check':
+        trace = check_ideal_clamp(f3cl, seg, v_init, record_mode, ss_tol)[0]
+        return trace if pieces is None else pieces(*trace)
+    if ideal:
+        with ideal_clamp(f3cl, seg) as durs:
+            return _clamp_trace(f3cl, seg, v_init, record_mode, ss_tol, pieces, durs, ideal=True)
+    return _clamp_trace(f3cl, seg, v_init, record_mode, ss_tol, pieces, list(f3cl.dur))
+
+
+def _clamp_trace(f3cl, seg, v_init, record_mode, ss_tol, pieces, durs, ideal=False):
+    tstop = h.tstop
+    cvode = bool(h.CVode().active())
+    mechanism = na15_mechanism(seg)
+    names = ('t', 'v', 'O1') if ideal else ('t', 'v', 'i', 'i_cap', 'g')
+    refs = dict(t=h._ref_t, v=seg._ref_v, i=f3cl._ref_i, i_cap=seg._ref_i_cap, g=getattr(seg, '_ref_g_'+mechanism),
+                O1=getattr(seg, '_ref_O1_'+mechanism))
+    refs = [refs[name] for name in names]
+    if record_mode:
+        recs = [h.Vector().record(ref) for ref in refs]
+        h.steps_per_ms = 1.0/h.dt   # so that continuerun does not change h.dt
+    else:
+        recs = [[] for ref in refs]
+
+    def step():
+        h.fadvance()
+        if not record_mode:
+            for rec, ref in zip(recs, refs):
+                rec.append(ref[0])
+
+    timed = phase_timers.enabled
+    if timed:   # the same step, fadvance and the appends timed apart (summed here, added at the end)
+        steps = [0.0, 0.0, 0]
+
+        def step():
+            start = perf_counter()
+            h.fadvance()
+            middle = perf_counter()
+            if not record_mode:
+                for rec, ref in zip(recs, refs):
+                    rec.append(ref[0])
+            steps[0] += middle-start
+            steps[1] += perf_counter()-middle
+            steps[2] += 1
+
+    def advance(t_target):
+        if record_mode:
+            with phase('continuerun'):
+                if cvode:   # continuerun stops dt/2 early, dt being the last variable step
+                    h.CVode().solve(t_target)
+                else:
+                    h.continuerun(t_target)
+        else:
+            while (h.t<t_target):
+                step()
+
+    jumped = []     # samples of the levels jumped over, one array per name
+
+    def collect():
+        """(t, v, dens, g) of the samples recorded (and jumped over) since the last call."""
+
+        with phase('vectors'):
+            traces = [np.array(x.as_numpy() if record_mode else x, dtype) for x in recs]
+            for x in recs:
+                if record_mode:
+                    x.resize(0)
+                else:
+                    del x[:]
+            if jumped:
+                traces = [np.concatenate([x]+[piece[n] for piece in jumped]) for n, x in enumerate(traces)]
+                order = np.argsort(traces[0], kind='stable')
+                traces = [x[order] for x in traces]
+                del jumped[:]
+
+            keep = traces[0] < tstop    # continuerun also records the point at tstop
+            traces = dict((name, x[keep]) for name, x in zip(names, traces))
+            t, v = traces['t'], traces['v']
+            if ideal:
+                g = getattr(seg, mechanism).gbar*traces['O1']
+                dens = g*(v-seg.ena)                                # ina of the na15 state, mA/cm2
+            else:
+                g = traces['g']
+                dens = traces['i']/seg.area()*100.0-traces['i_cap']    # clamping current in mA/cm2, for each dt
+        return t, v, dens, g
+
+    with phase('finitialize'):
+        h.finitialize(v_init)
+    if not record_mode:
+        for rec, ref in zip(recs, refs):
+            rec.append(ref[0])
+
+    jump = ss_tol is not None and not cvode
+    if jump or pieces is not None:
+        ends = np.cumsum(durs)
+        for j, t_start in enumerate(ends-durs):
+            t_end = min(ends[j], tstop)
+            if t_start >= t_end or h.t >= t_end:
+                continue
+            advance(t_start)
+            if pieces is not None and t_start > 0:
+                pieces(*collect())                  # the previous level
+            if not jump:
+                continue
+            step()                              # the rates of na15 are those of the last step
+            with phase('fast_forward'):         # one bound per level, from the state at its start
+                tau, x_ss = settling_time(na15_state(seg), na15_rate_matrix(seg), ss_tol, t_end-h.t-4*h.dt)
+            if tau == np.inf:
+                continue                        # does not settle early enough to be worth a jump
+            advance(h.t + np.ceil(tau/h.dt)*h.dt)
+            v_last = seg.v
+            step()                              # the clamp itself must have settled as well
+            settled = abs(seg.v-v_last) <= 1e-9 and np.abs(na15_state(seg)-x_ss).max() <= ss_tol
+            if not settled or h.t + 2*h.dt >= t_end:
+                continue
+            with phase('fast_forward'):
+                for s, value in zip(states, x_ss):
+                    setattr(getattr(seg, mechanism), s, value)
+
+                # grid points up to the last one before the end of the level, whose step crosses into level j+1
+                t = h.t + h.dt*np.arange(1, int(round((t_end-h.t)/h.dt)))
+                g = getattr(seg, mechanism).gbar*x_ss[2]
+                i = g*(seg.v-seg.ena)*seg.area()/100.0     # at steady state the clamp current is ina
+                values = dict(v=seg.v, i=i, i_cap=0.0, g=g, O1=x_ss[2])
+                jumped.append([t[:-1]]+[np.full(len(t)-1, values[name]) for name in names[1:]])
+
+                # one NEURON step to the last grid point (recorded as any other), so that events and
+                # played vectors are delivered and every mechanism advances with the time
+                dt = h.dt
+                h.dt = t[-1]-h.t
+                try:
+                    step()
+                finally:
+                    h.dt = dt
+    advance(tstop)
+    if timed and steps[2]:
+        phase_timers.add('fadvance', steps[0], steps[2])
+        if not record_mode:
+            phase_timers.add('append', steps[1], steps[2])
+
+    trace = collect()
+    if record_mode:
+        for x in recs:
+            x.play_remove()
+    return trace if pieces is None else pieces(*trace)
+
+
+@contextmanager
+def ideal_clamp(f3cl, seg):
+    """Makes the clamp f3cl on seg ideal while the block runs: the levels of f3cl are played into v
+    (each from the time it begins, the last one held to the end of the run), f3cl is switched off
+    (its durations set to 0) and the capacitance of seg made so large that the membrane current
+    cannot move v, so that NEURON steps the na15 (or na15k) mechanism, with its tables and
+    integration method, at the prescribed v without the amplifier of the clamp. Yields the
+    durations of f3cl, restored afterwards with cm."""
+
+    durs, cm = list(f3cl.dur), seg.cm
+    levels = [(t_start, amp) for t_start, d, amp in zip(clamp_starts(f3cl), durs, f3cl.amp) if d > 0]
+    played = [h.Vector([t_start for t_start, amp in levels]), h.Vector([amp for t_start, amp in levels])]
+    played[1].play(seg._ref_v, played[0])
+    try:
+        for j in range(len(durs)):
+            f3cl.dur[j] = 0             # the clamp is off
+        seg.cm = 1e12                   # uF/cm2: v moves by less than 1e-9 mV per ms at 1 mA/cm2
+        yield durs
+    finally:
+        played[1].play_remove()
+        for j, d in enumerate(durs):
+            f3cl.dur[j] = d
+        seg.cm = cm
+
+
+def clamp_peaks(f3cl, seg, v_init, windows, record_mode=True, ss_tol=None, ideal=False, bundle=None,
+                trace_points=None):
+    """Peaks (as measure_peaks: ipeak, gpeak, tpeak and ratio) of the trace of run_clamp, measured
+    level by level as the trace is computed, so that it is never held in memory as a whole. With
+    bundle the trace is appended to it as one sweep, piece by piece, each piece decimated to its
+    share of trace_points time bins over 0..h.tstop (see trace_decimation.py)."""
+
+    starts = clamp_starts(f3cl)
+    t_range = (0.0, h.tstop)
+    peaks = [None, True]      # peaks so far, next piece starts a new sweep of the bundle
+
+    def piece(t, v, dens, g):
+        if not len(t):
+            return
+        with phase('peaks'):
+            peaks[0] = merge_peaks(peaks[0], measure_peaks(t, dens, starts, windows, g, missing=True))
+        if bundle is not None:
+            with phase('bundle'):
+                keep = decimate_trace(t, v, dens, trace_points, starts, windows, t_range)
+                append_trace(bundle, t[keep], v[keep], dens[keep], g[keep], new_sweep=peaks[1])
+            peaks[1] = False
+
+    run_clamp(f3cl, seg, v_init, record_mode, ss_tol, ideal, piece)
+    if peaks[0] is None or np.isnan(peaks[0]['ipeak']).any():
+        raise ValueError('a measurement window of %r contains no samples' % (windows,))
+    return peaks[0]
+
+
+def check_ideal_clamp(f3cl, seg, v_init, record_mode=True, ss_tol=None):
+    """Ideal clamp trace (t, v, dens, g) of run_clamp(ideal=True) and its difference from the trace of
+    the full clamp f3cl, both stepped by NEURON with the same mechanism, so that the difference is
+    that of the amplifier and of the capacitive current: dict(error, rel_error, t, peak_error) with the largest |difference| of dens (mA/cm2), relative
+    to the largest |dens| of the full clamp, and its time, and the relative difference of the
+    largest |dens| of the two traces. The full trace is interpolated at the ideal
+    samples (the grids differ with CVODE) and its first sample, the current of the clamp at
+    finitialize, is left out."""
+
+    full = run_clamp(f3cl, seg, v_init, record_mode, ss_tol)
+    trace = run_clamp(f3cl, seg, v_init, record_mode, ss_tol, ideal=True)
+    later = trace[0] > 0
+    d = np.abs(trace[2]-np.interp(trace[0], full[0], full[2]))[later]
+    k = int(np.argmax(d))
+    peak = np.abs(full[2][full[0] > 0]).max()
+    check = dict(error=float(d[k]), rel_error=float(d[k]/peak), t=float(trace[0][later][k]),
+                 peak_error=float(abs(np.abs(trace[2][later]).max()-peak)/peak))
+    print('ideal clamp check: largest difference %.3g mA/cm2 (%.3g of the peak) at t = %g ms, peaks %.3g apart'
+          % (check['error'], check['rel_error'], check['t'], check['peak_error']))
+    return trace, check
+
+
+def clamp_starts(f3cl):
+    """Times (ms) at which the levels of f3cl begin: 0, dur[0], dur[0]+dur[1], ..."""
+
+    return np.cumsum([0]+list(f3cl.dur)[:-1])
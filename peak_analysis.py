@@ -0,0 +1,76 @@
+# The following script contains the analysis stage shared by the five protocols: a function
+# 'measure_peaks(t, dens, level_starts, windows)' which takes recorded traces (one sweep, or a batch of
+# sweeps stacked as rows of a 2-D array) and declarative measurement windows, and returns peak current,
+# conductance at the peak, time of peak and P2/P1 ratio for all sweeps at once with NumPy reductions.
+#
+# A window is (j, start, end): the samples with  start < t - t_j <= end, where t_j is the time at which
+# clamp level j begins (f3cl.dur[0] + ... + f3cl.dur[j-1]), so windows follow the sweep variable.
+
+import numpy as np
+
+dtype = np.float64
+
+
+def window_mask(t, level_starts, window):
+    """Boolean mask (n_sweeps x n_t) of the samples inside a window; t is (n_t) or (n_sweeps x n_t)
+    and level_starts is (n_sweeps x n_levels)."""
+
+    j, start, end = window
+    t = np.asarray(t, dtype)
+    t0 = np.asarray(level_starts, dtype)[:, j:j+1]
+    eps = 1e-6*np.nanmin(np.diff(t, axis=-1)) if t.shape[-1] > 1 else 0     # round-off of h.t
+    return (t > t0+start+eps) & (t <= t0+end+eps)
+
+
+def measure_peaks(t, dens, level_starts, windows, g=None, missing=False):
+    """Peaks of |dens| inside each window, for a single trace (t, dens and g of shape n_t,
+    level_starts of shape n_levels) or a batch (dens and g n_sweeps x n_t, t n_t or n_sweeps x n_t,
+    level_starts n_sweeps x n_levels). NaN samples (e.g. after the end of a shorter sweep) are ignored.
+
+    Returns a dict with, per sweep and window, the peak current 'ipeak' (signed, as dens), the
+    conductance 'gpeak' at the same sample (if g is given) and the time of peak 'tpeak'; 'ratio' is
+    the P2/P1 ratio |ipeak of the 2nd window| / |ipeak of the 1st window| when there are two windows.
+    A window without samples is an error, or with missing=True (e.g. for a piece of a trace, see
+    merge_peaks) gives NaN."""
+
+    single = np.ndim(dens) == 1
+    dens = np.atleast_2d(np.asarray(dens, dtype))
+    t = np.asarray(t, dtype)
+    level_starts = np.atleast_2d(np.asarray(level_starts, dtype))
+    rows = np.arange(dens.shape[0])
+    t_all = np.broadcast_to(t, dens.shape)
+
+    ipeak = np.empty((dens.shape[0], len(windows)), dtype)
+    gpeak = np.full_like(ipeak, np.nan)
+    tpeak = np.empty_like(ipeak)
+    for w, window in enumerate(windows):
+        inside = window_mask(t, level_starts, window) & np.isfinite(dens)
+        found = inside.any(axis=-1)
+        if not missing and not found.all():
+            raise ValueError('measurement window %r contains no samples' % (window,))
+        k = np.argmax(np.where(inside, np.abs(dens), -np.inf), axis=-1)
+        ipeak[:, w] = np.where(found, dens[rows, k], np.nan)
+        tpeak[:, w] = np.where(found, t_all[rows, k], np.nan)
+        if g is not None:
+            gpeak[:, w] = np.where(found, np.atleast_2d(np.asarray(g, dtype))[rows, k], np.nan)
+
+    peaks = dict(ipeak=ipeak, gpeak=gpeak, tpeak=tpeak)
+    if len(windows) == 2:
+        peaks['ratio'] = np.abs(ipeak[:, 1])/np.abs(ipeak[:, 0])
+    if single:
+        peaks = {key: value[0] for key, value in peaks.items()}
+    return peaks
+
+
+def merge_peaks(peaks, more):
+    """Peaks of a trace measured in consecutive pieces: per window, that of peaks or of more (both
+    of measure_peaks(..., missing=True) for a single trace, peaks possibly None) with the larger
+    |ipeak|, the earlier one on a tie; windows without samples in either stay NaN."""
+
+    if peaks is None:
+        return more
+    take = np.isnan(peaks['ipeak']) | (np.abs(more['ipeak']) > np.abs(peaks['ipeak']))
+    merged = dict((key, np.where(take, more[key], peaks[key])) for key in ('ipeak', 'gpeak', 'tpeak'))
+    if 'ratio' in peaks:
+        merged['ratio'] = np.abs(merged['ipeak'][1])/np.abs(merged['ipeak'][0])
+    return merged
@@ -0,0 +1,175 @@
+# The following script contains the phase timers of the scripts and of run_protocol.py: the wall time of
+# each phase of a run (h.finitialize, the time loop, the per-step appends of the python loop, the
+# steady-state fast-forward, the conversion of the recorded vectors, the peaks, the plots, savefig, the
+# .dat and result-bundle writes, ...) is summed per sweep and per run and written to a JSONL report, one
+# line per sweep ("record": "sweep") and one per run ("record": "run", with the totals of every phase).
+#
+# The timers are off unless enabled, e.g. from the command line of any script
+#
+#   python 3_f_inact_rec_static.py --timings                     (report: 3_rec_f_inact_timings.jsonl)
+#   python run_protocol.py 1 5 --backend loop --timings loop.jsonl
+#
+# Off, phase(name) returns one shared no-op context manager and nothing is measured inside the time loop.
+#
+# Phases may be nested (e.g. exact inside cache, or the phases of run_clamp inside run_sweeps): each is
+# reported with its own time, but only the top-level ones are subtracted from the wall time to give
+# 'other'. The phases timed in the worker processes of sweep_pool.run_sweeps are sent back with the
+# traces and reported as 'worker:<phase>' in the line of the sweep each worker ran, summed over the
+# workers in the run line (so they can exceed the wall time).
+
+import os
+import sys
+import json
+import time
+import atexit
+import contextlib
+
+enabled = False     # True between enable() and disable()
+
+_report = None      # open report file
+_owner = None       # pid of the process that enabled the timers (not its forked workers)
+_info = {}          # fields of the current run (e.g. script, title, backend)
+_sweep = {}         # {phase: [seconds, calls]} since the last end_sweep
+_pending = {}       # {sweep: {phase: [seconds, calls]}} merged for the sweeps after the current one
+_run = {}           # {phase: [seconds, calls]} since begin_run
+_sweeps = 0         # sweeps ended in the current run
+_stack = []         # phases open at present, outermost first
+_top = [0.0, 0.0]   # seconds of the top-level phases of the sweep and of the run
+_marks = [0.0, 0.0] # perf_counter at the beginning of the run and of the sweep
+_off = contextlib.nullcontext()
+
+
+def enable(path, **info):
+    """Switches the timers on, the report being written to path (overwritten); info is added to every run."""
+
+    global enabled, _report, _owner
+    disable()
+    _report = open(path, 'w')
+    _owner = os.getpid()
+    enabled = True
+    begin_run(**info)
+    atexit.register(disable)
+
+
+def disable():
+    """Ends the current run, if it has any timings, and closes the report."""
+
+    global enabled, _report
+    if not enabled or os.getpid() != _owner:
+        return
+    if _sweep or _pending or _run or _sweeps:
+        end_run()
+    enabled = False
+    _report.close()
+    _report = None
+
+
+def begin_run(**info):
+    """Starts a new run (the previous one, if not ended, is discarded); info is written with its lines."""
+
+    global _sweeps
+    _info.clear()
+    _info.update(script=os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None, **info)
+    _sweep.clear()
+    _pending.clear()
+    _run.clear()
+    _sweeps = 0
+    _top[:] = [0.0, 0.0]
+    _marks[:] = [time.perf_counter()]*2
+
+
+def add(name, seconds, calls=1):
+    """Adds seconds (measured by the caller, e.g. summed over the steps of a loop) to the phase name,
+    a top-level phase unless it is added inside another phase."""
+
+    entry = _sweep.setdefault(name, [0.0, 0])
+    entry[0] += seconds
+    entry[1] += calls
+    if not _stack:
+        _top[0] += seconds
+
+
+def take():
+    """Phases timed since the previous sweep, removed from it: {phase: [seconds, calls]} (used by the
+    worker processes of run_sweeps to send their timings back)."""
+
+    phases = dict((name, list(entry)) for name, entry in _sweep.items())
+    _sweep.clear()
+    _top[0] = 0.0
+    return phases
+
+
+def merge(phases, prefix='worker:', ahead=0):
+    """Adds the phases of take() in another process to the current sweep, or with ahead=k to the k-th
+    sweep after it (they are reported when it ends), as prefix+phase; they are never top-level, having
+    run in parallel with this process."""
+
+    entries = _sweep if ahead == 0 else _pending.setdefault(_sweeps+ahead, {})
+    for name, (seconds, calls) in phases.items():
+        entry = entries.setdefault(prefix+name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+
+@contextlib.contextmanager
+def _timed(name):
+    start = time.perf_counter()
+    _stack.append(name)
+    try:
+        yield
+    finally:
+        _stack.pop()
+        add(name, time.perf_counter()-start)
+
+
+def phase(name):
+    """Context manager timing its block as the phase name (of the current sweep)."""
+
+    return _timed(name) if enabled else _off
+
+
+def _phases(entries):
+    return dict((name, dict(seconds=seconds, calls=calls)) for name, (seconds, calls) in entries.items())
+
+
+def _write(line):
+    _report.write(json.dumps(line, default=float)+'\n')   # default: NumPy scalars
+    _report.flush()
+
+
+def end_sweep(**info):
+    """Writes the phases timed since the previous sweep (or the beginning of the run) as one sweep
+    line, with info (e.g. sweep=k, value=x), and adds them to the totals of the run."""
+
+    global _sweeps
+    if not enabled:
+        return
+    now = time.perf_counter()
+    merge(_pending.pop(_sweeps, {}), prefix='')
+    _write({'record': 'sweep', **_info, 'sweep': _sweeps, **info, 'wall': now-_marks[1], 'phases': _phases(_sweep)})
+    for name, (seconds, calls) in _sweep.items():
+        entry = _run.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+    _sweep.clear()
+    _top[1] += _top[0]
+    _top[0] = 0.0
+    _sweeps += 1
+    _marks[1] = now
+
+
+def end_run(**info):
+    """Writes the run line: its wall time, number of sweeps and the totals of every phase, the phases
+    timed after the last sweep (e.g. savefig) included; 'other' is the wall time of no top-level phase."""
+
+    if not enabled:
+        return
+    wall = time.perf_counter()-_marks[0]
+    for phases in [_sweep]+list(_pending.values()):     # and those of the sweeps that were not ended
+        for name, (seconds, calls) in phases.items():
+            entry = _run.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+    _write({'record': 'run', **_info, **info, 'sweeps': _sweeps, 'wall': wall, 'phases': _phases(_run),
+            'other': wall-_top[1]-_top[0]})
+    begin_run(**dict((key, value) for key, value in _info.items() if key != 'script'))
@@ -0,0 +1,154 @@
+# The following script evaluates protocols over a 2-D grid of temperatures and holding potentials,
+# in place of changing h.celsius and v_init and rerunning the whole sweep for each combination:
+# 'grid_curves(number, celsius, v_init)' returns the main curves stacked as (n_celsius, n_v_init, n_sweeps),
+# computed with the exact solution of na15_kinetics.py (sampled in the measurement windows every dt).
+#
+# The work shared between grid points and protocols:
+#   - every rate shares the factor Q10 = 3^((celsius-20)/10), so Q(v, celsius) = Q10 Q(v, 20): the rate
+#     matrix of each clamp voltage is eigendecomposed once ('level_modes', shared by all the protocols
+#     and temperatures), a temperature only scales its eigenvalues;
+#   - for the same reason the steady state does not depend on the temperature: it is solved once per
+#     holding potential (steady_states of state_variables.py), for all the grid points at once;
+#   - all the grid points of a sweep are then propagated together, as arrays over (celsius, v_init).
+# 'run_grid' distributes the temperatures of the grid over worker processes, e.g.
+#
+#   python protocol_grid.py 1 2 3 4 5 --celsius 6,10,14,18,22,24,26,30,34,37 --v-init=-130,-120,-110,-100,-90,-80,-70,-60
+#
+# writes one result bundle per protocol (see result_bundle.py) with the columns celsius, v_init, the
+# sweep values and the curves (n_celsius x n_v_init x n_sweeps).
+
+import os
+import re
+import sys
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from na15_kinetics import (na15_parameters, transition_rates, matrix_from_rates, segment_levels, q10, eigenmodes,
+                           propagate_modes)
+from state_variables import steady_states, parameters_key
+from protocols import protocol, model_settings, window_times, main_curve
+from peak_analysis import measure_peaks
+from result_bundle import create_bundle, append_columns
+
+dtype = np.float64
+
+
+def level_modes(amps, params=None, modes=None):
+    """Eigenmodes (lam, V, W = V^-1) of the rate matrices at the voltages amps for Q10 = 1 (20 degC),
+    added to the dict modes {(amp, parameters_key(params)): (lam, V, W)}, which is returned."""
+
+    modes = {} if modes is None else modes
+    key = parameters_key(params)
+    missing = sorted(set(float(a) for a in np.ravel(amps)) - set(a for a, k in modes if k == key))
+    if missing:
+        Q = matrix_from_rates(transition_rates(np.array(missing, dtype), 20, params))
+        for a, l, v, w in zip(missing, *eigenmodes(Q)):
+            modes[(a, key)] = (l, v, w)
+    return modes
+
+
+def grid_curves(number, celsius, v_init, dt=None, params=None, gbar=None, ena=None, modes=None):
+    """Main curve of protocol 'number' at every (celsius, v_init) of the grid: returns x (n_sweeps) and
+    y (len(celsius) x len(v_init) x n_sweeps). modes (see level_modes) is shared between calls."""
+
+    p = protocol(number)
+    dt, params, gbar, ena = model_settings(p, dt, params, gbar, ena)
+    celsius = np.atleast_1d(np.asarray(celsius, dtype))
+    v_init = np.atleast_1d(np.asarray(v_init, dtype))
+    key = parameters_key(params)
+    Q10 = q10(celsius)
+    x_init = steady_states(v_init, 20, params)                             # (n_v, 5), the same at any celsius
+
+    n_c, n_v, n_w = len(celsius), len(v_init), len(p['windows'])
+    ipeak = np.empty((n_c, n_v, len(p['sweep']), n_w), dtype)
+    gpeak = np.empty_like(ipeak)
+    for n, x in enumerate(p['sweep']):
+        segments = p['segments'](x)
+        durs, amps, starts, ends = segment_levels(segments)
+        modes = level_modes(amps, params, modes)
+        t = np.unique(np.concatenate([window_times(segments, window, dt) for window in p['windows']]))
+        idx = np.minimum(np.searchsorted(ends, t, side='right'), len(durs)-1)
+
+        o1 = np.empty((n_c, n_v, len(t)), dtype)
+        X = np.broadcast_to(x_init[:, None], (n_c, n_v, 1, 5))             # state at the beginning of the level
+        for j in range(len(durs)):
+            lam, V, W = modes[(float(amps[j]), key)]
+            scaled = (Q10[:, None, None, None]*lam, V, W)                   # the eigenvalues at each temperature
+            sel = idx == j
+            if sel.any():
+                o1[..., sel] = propagate_modes(scaled, X, t[sel]-starts[j])[..., 2]     # (n_c, n_v, n_t)
+            if j < len(durs)-1:
+                X = propagate_modes(scaled, X, durs[j])
+
+        ina = gbar*o1*(amps[idx]-ena)
+        peaks = measure_peaks(t, ina.reshape(n_c*n_v, -1), np.tile(starts, (n_c*n_v, 1)), p['windows'],
+                              g=gbar*o1.reshape(n_c*n_v, -1))
+        ipeak[:, :, n] = peaks['ipeak'].reshape(n_c, n_v, n_w)
+        gpeak[:, :, n] = peaks['gpeak'].reshape(n_c, n_v, n_w)
+
+    y = np.array([[main_curve(p, ipeak[c, v], gpeak[c, v]) for v in range(n_v)] for c in range(n_c)], dtype)
+    return np.asarray(p['sweep'], dtype), y
+
+
+def _grid_task(task):
+    numbers, celsius, v_init, dt = task
+    modes = {}
+    return [grid_curves(number, celsius, v_init, dt, modes=modes)[1] for number in numbers]
+
+
+def run_grid(numbers, celsius, v_init, dt=None, processes=None, start_method=None):
+    """Curves of the protocols 'numbers' over the grid: {number: (x, y)}, y being len(celsius) x
+    len(v_init) x n_sweeps. The temperatures are split among 'processes' workers (default: all cores)."""
+
+    numbers = list(numbers)
+    celsius = np.atleast_1d(np.asarray(celsius, dtype))
+    processes = min(processes or os.cpu_count(), len(celsius))
+    chunks = [c for c in np.array_split(celsius, processes) if len(c)]
+    tasks = [(numbers, c, v_init, dt) for c in chunks]
+
+    if processes == 1:
+        results = [_grid_task(task) for task in tasks]
+    else:
+        if start_method is None:
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        with multiprocessing.get_context(start_method).Pool(processes) as pool:
+            results = pool.map(_grid_task, tasks, chunksize=1)
+
+    return dict((number, (np.asarray(protocol(number)['sweep'], dtype), np.concatenate([r[k] for r in results])))
+                for k, number in enumerate(numbers))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs clamp protocols over a grid of temperatures and holding potentials.')
+    parser.add_argument('protocols', nargs='+', help='protocol number (1 to 5) or specification file (.json, .toml)')
+    parser.add_argument('--celsius', required=True, help='comma-separated temperatures (degC)')
+    parser.add_argument('--v-init', required=True, help='comma-separated holding potentials (mV), e.g. --v-init=-120,-90')
+    parser.add_argument('--dt', type=float, default=None, help='sampling step of the windows (ms), default: that of the specification')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes, the temperatures being split among them')
+    parser.add_argument('--outdir', default='.', help='directory of the result bundles')
+    args = parser.parse_args(argv)
+
+    celsius = np.array([float(c) for c in args.celsius.split(',')], dtype)
+    v_init = np.array([float(v) for v in args.v_init.split(',')], dtype)
+    numbers = [int(name) if name.isdigit() else name for name in args.protocols]
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    start = time.time()
+    curves = run_grid(numbers, celsius, v_init, args.dt, args.processes)
+    print('%d protocols x %d temperatures x %d holding potentials, %.2f s' % (len(numbers), len(celsius), len(v_init), time.time()-start))
+    for number in numbers:
+        p = protocol(number)
+        dt, params, gbar, ena = model_settings(p, args.dt)
+        x, y = curves[number]
+        bundle = os.path.join(args.outdir, p['outputs'].get('bundle', re.sub(r'\W+', '_', p['title']).strip('_'))+'_grid')
+        create_bundle(bundle, dict(title=p['title'], backend='grid', dt=dt, parameters=dict(na15_parameters, **(params or {})),
+                                   spec=p['spec']))
+        append_columns(bundle, celsius=celsius, v_init=v_init, **{p['sweep_name']: x, p['measure']: y})
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+# The following script reads the clamp protocols from declarative specifications (the .json files of
+# 'protocol_specs', one per stand-alone script: cell, clamp levels, sweep grid, measurement windows and
+# output files) and computes their main curves without NEURON: 'exact_protocol(number)' with the
+# matrix-exponential engine of na15_kinetics.py instead of stepping NEURON with fadvance(),
+# 'batch_protocol(number)' running all the sweeps of a protocol at once on the time grid of the script
+# (also returning the traces), and 'spectral_protocol(number, intervals)' evaluating the recovery/onset
+# curves of protocols 3, 4 and 5 in closed form at any number of interval values. Wherever a protocol
+# number is expected, a specification file (.json or .toml) or dict can be given instead.
+#
+# A specification has the keys title, cell (diam, L, nseg, cm, Ra, ena, gbar), clamp ('VClamp' or
+# 'VClamp_plus'), celsius, v_init, dt, segments (list of [dur, amp], the sweep variable written "x"
+# in place of one duration or amplitude), sweep (name and one of "arange": [start, stop, step],
+# "logspace": [first, last, num] or "values": [...]), windows (list of [level, start, end], see
+# peak_analysis.py), measure ('normalized_conductance', 'normalized_current' or
+# 'fractional_recovery'), outputs (bundle: result bundle, x and y: file and name of the .dat files)
+# and optionally parameters (rate parameters of Na15.mod to change).
+
+import os
+import json
+import glob
+
+import numpy as np
+
+from na15_kinetics import exact_clamp, batch_clamp, interval_scan, segment_levels, gbar_default, ena_default
+from peak_analysis import measure_peaks
+
+dtype = np.float64
+
+spec_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'protocol_specs')
+
+default_cell = dict(diam=50, L=63.66198, nseg=1, cm=1, Ra=70, ena=ena_default, gbar=gbar_default)
+
+
+def read_spec(path):
+    """Protocol specification (dict) from a .json or .toml file."""
+
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def sweep_values(sweep):
+    """Values of the sweep variable from the 'sweep' entry of a specification."""
+
+    if 'arange' in sweep:
+        return np.arange(*sweep['arange'])
+    if 'logspace' in sweep:
+        first, last, num = sweep['logspace']
+        return np.logspace(np.log10(first), np.log10(last), num=int(num))
+    if 'values' in sweep:
+        return np.asarray(sweep['values'], dtype)
+    raise ValueError('the sweep needs one of "arange", "logspace" or "values"')
+
+
+def compile_spec(spec):
+    """Protocol settings (see protocol()) from a specification dict."""
+
+    levels = [tuple(level) for level in spec['segments']]
+    swept = [(name, j) for j, level in enumerate(levels) for name, value in zip(('dur', 'amp'), level) if value == 'x']
+    if len(swept) != 1:
+        raise ValueError('exactly one clamp duration or amplitude must be the sweep variable "x"')
+
+    return dict(title=spec['title'], dt=spec['dt'], v_init=spec['v_init'], celsius=spec['celsius'],
+                sweep=sweep_values(spec['sweep']), sweep_name=spec['sweep']['name'], sweep_level=swept[0],
+                segments=lambda x: [tuple(x if value == 'x' else value for value in level) for level in levels],
+                windows=[tuple(window) for window in spec['windows']], measure=spec['measure'],
+                cell=dict(default_cell, **spec.get('cell', {})), clamp=spec.get('clamp', 'VClamp_plus'),
+                params=spec.get('parameters') or None, outputs=spec.get('outputs', {}), spec=spec)
+
+
+def protocol(number):
+    """Settings of protocol 'number' (1 to 5, read from protocol_specs as in the corresponding
+    *_static.py), of a specification file or of a specification dict.
+
+    'segments(x)' returns the (dur, amp) levels of f3cl for the sweep value x ('sweep_level' says
+    which one it sets, e.g. ('dur', 2) for f3cl.dur[2]), and each measurement
+    window is (j, start, end): from 'start' to 'end' ms after the beginning of clamp level j
+    (see peak_analysis.py)."""
+
+    if isinstance(number, dict):
+        return number if callable(number.get('segments')) else compile_spec(number)
+    if isinstance(number, str):
+        return compile_spec(read_spec(number))
+    paths = sorted(glob.glob(os.path.join(spec_dir, '%s_*.json' % (number,))))
+    if not paths:
+        raise ValueError('unknown protocol %r, expected 1 to 5' % (number,))
+    return compile_spec(read_spec(paths[0]))
+
+
+def target_protocol(number, x):
+    """Protocol 'number' (see protocol) with its sweep replaced by the values x."""
+
+    spec = dict(protocol(number)['spec'])
+    spec['sweep'] = dict(spec['sweep'], values=[float(value) for value in x])
+    for key in ('arange', 'logspace'):
+        spec['sweep'].pop(key, None)
+    return compile_spec(spec)
+
+
+def window_times(segments, window, dt):
+    """Points of the global time grid k*dt covering a measurement window (and within the clamp)."""
+
+    j, start, end = window
+    t0 = sum(d for d, a in segments[:j])
+    total = sum(d for d, a in segments)
+    k = np.arange(np.floor((t0+start)/dt), np.ceil((t0+end)/dt)+1)
+    return k[k*dt <= total]*dt
+
+
+def exact_protocol(number, dt=None, params=None, gbar=None, ena=None):
+    """Main curve of protocol 'number' (x values and y values as written in its two .dat files),
+    sampling the exact solution only inside the measurement windows, on the grid of step dt.
+    params, gbar and ena default to those of the specification."""
+
+    p = protocol(number)
+    ipeak, gpeak = exact_peaks(p, dt, params, gbar, ena)
+    return np.asarray(p['sweep'], dtype), main_curve(p, ipeak, gpeak)
+
+
+def exact_peaks(number, dt=None, params=None, gbar=None, ena=None):
+    """Peak currents and the conductances at the peaks (n_sweeps x n_windows) of exact_protocol."""
+
+    p = protocol(number)
+    dt, params, gbar, ena = model_settings(p, dt, params, gbar, ena)
+
+    ipeak = np.empty((len(p['sweep']), len(p['windows'])), dtype)   # peak current per window
+    gpeak = np.empty_like(ipeak)                                    # conductance at the peak
+    for n, x in enumerate(p['sweep']):
+        segments = p['segments'](x)
+        t_sample = np.unique(np.concatenate([window_times(segments, window, dt) for window in p['windows']]))
+        t, v, s, ina = exact_clamp(segments, p['v_init'], p['celsius'], t_sample, params=params, gbar=gbar, ena=ena)
+        peaks = measure_peaks(t, ina, segment_levels(segments)[2], p['windows'], g=gbar*s[:, 2])
+        ipeak[n], gpeak[n] = peaks['ipeak'], peaks['gpeak']
+    return ipeak, gpeak
+
+
+def model_settings(p, dt=None, params=None, gbar=None, ena=None):
+    """dt, rate parameters, gbar and ena of protocol p unless given."""
+
+    return (p['dt'] if dt is None else dt, p['params'] if params is None else params,
+            p['cell']['gbar'] if gbar is None else gbar, p['cell']['ena'] if ena is None else ena)
+
+
+def main_curve(p, ipeak, gpeak):
+    """y values of the main plot from the peak currents/conductances (n_sweeps x n_windows)."""
+
+    if p['measure'] == 'normalized_conductance':
+        return gpeak[:, 0]/gpeak[:, 0].max()
+    if p['measure'] == 'normalized_current':
+        return ipeak[:, 0]/ipeak[:, 0].min()
+    return np.abs(ipeak[:, 1])/np.abs(ipeak[:, 0])
+
+
+def sweep_levels(p):
+    """(n_sweeps x n_levels) arrays of clamp durations and amplitudes, one row per sweep value."""
+
+    levels = np.array([p['segments'](x) for x in p['sweep']], dtype)
+    return levels[..., 0], levels[..., 1]
+
+
+def batch_protocol(number, dt=None, params=None, gbar=None, ena=None):
+    """Main curve of protocol 'number' computed with batch_clamp, all sweeps advanced together.
+    Returns x, y and the traces dict(t, v, g, ina), whose rows are the sweeps."""
+
+    p = protocol(number)
+    dt, params, gbar, ena = model_settings(p, dt, params, gbar, ena)
+    durs, amps = sweep_levels(p)
+    t, v, g, ina, x_end = batch_clamp(durs, amps, p['v_init'], p['celsius'], dt, params=params, gbar=gbar, ena=ena)
+
+    peaks = measure_peaks(t, ina, np.cumsum(durs, axis=1)-durs, p['windows'], g=g)
+    return np.asarray(p['sweep'], dtype), main_curve(p, peaks['ipeak'], peaks['gpeak']), dict(t=t, v=v, g=g, ina=ina)
+
+
+def spectral_protocol(number, intervals=None, dt=None, params=None, gbar=None, ena=None):
+    """P2/P1 curve of protocol 3, 4 or 5 at the given intervals (default: the sweep of the script)
+    from the eigenmodes of the rate matrices (interval_scan), without simulating each sweep.
+    The windows are sampled on the time grid k*dt, as by exact_protocol."""
+
+    intervals, peaks = _interval_peaks(number, intervals, dt, params, gbar, ena)
+    return intervals, peaks['ratio']
+
+
+def spectral_peaks(number, intervals=None, dt=None, params=None, gbar=None, ena=None):
+    """Peak currents and the conductances at the peaks (n_intervals x n_windows) of spectral_protocol."""
+
+    intervals, peaks = _interval_peaks(number, intervals, dt, params, gbar, ena)
+    return peaks['ipeak'], peaks['gpeak']
+
+
+def _interval_peaks(number, intervals, dt, params, gbar, ena):
+    p = protocol(number)
+    if p['sweep_level'][0] != 'dur':
+        raise ValueError('protocol %r sweeps a clamp amplitude, not an interval' % p['title'])
+    dt, params, gbar, ena = model_settings(p, dt, params, gbar, ena)
+    intervals = np.asarray(p['sweep'] if intervals is None else intervals, dtype)
+
+    return intervals, interval_scan(p['segments'](intervals.min()), p['sweep_level'][1], intervals, p['v_init'],
+                                    p['celsius'], p['windows'], dt, params=params, gbar=gbar, ena=ena)
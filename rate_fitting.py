@@ -0,0 +1,284 @@
+# The following script contains the fitting of a subset of the Na15.mod rate parameters (the b/v/k
+# triplets of na15_parameters) to target curves of the five protocols: I-V/normalized conductance,
+# fast inactivation availability, recovery from fast inactivation, onset and recovery of slow
+# inactivation. 'fit_parameters(targets, names)' minimizes the sum over the protocols of the mean
+# squared difference between the model and the target curves, each curve being computed without
+# NEURON by the fast backends of protocols.py: the closed form of spectral_protocol for the protocols
+# sweeping an interval (3, 4, 5), the matrix-exponential engine of exact_protocol for the others.
+#
+# The optimizers are population based and see the model only through 'evaluate(Z)', the costs of a
+# whole generation (one candidate per row of Z), which is mapped over a pool of processes. The b
+# parameters are searched in log10 (they are scale factors of the rates), v and k linearly. e.g.
+#
+#   python rate_fitting.py O1I1b1 O1I1v1 I1O1b1 --targets results --processes 4 --out fitted.json
+#
+# fits three parameters to the .dat files written in 'results' (run_protocol.py --dat or the scripts);
+# fitted.json can be given as "parameters" of a protocol specification.
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from na15_kinetics import na15_parameters
+from protocols import protocol, target_protocol, exact_protocol, spectral_protocol
+
+dtype = np.float64
+
+b_range = 10        # default bounds: b within a factor b_range of its value,
+v_range = 20        # v within v_range mV,
+k_range = 2         # k within a factor k_range (same sign)
+
+_fit = None         # (protocols, names, weights) used by the worker processes
+
+
+def read_dat(path):
+    """Values of a .dat file written by the scripts ('name=[', one value per line, '];')."""
+
+    with open(path) as f:
+        text = f.read()
+    body = text[text.index('[')+1:text.rindex(']')]
+    return np.array([float(x) for x in body.split(',') if x.strip()], dtype)
+
+
+def fast_curve(p, params=None):
+    """y values of the main curve of the compiled protocol p with the rate parameters params (on top
+    of those of the specification): spectral_protocol when an interval is swept, else exact_protocol."""
+
+    params = dict(p['params'] or {}, **(params or {}))
+    if p['sweep_level'][0] == 'dur':
+        try:
+            return spectral_protocol(p, params=params)[1]
+        except ValueError:      # a window longer than the shortest interval
+            pass
+    return exact_protocol(p, params=params)[1]
+
+
+def target_curves(numbers=(1, 2, 3, 4, 5), directory=None, params=None):
+    """Targets {number: (x, y)}: read from the two .dat files of each specification in 'directory',
+    or, without directory, computed with the rate parameters params (e.g. to test a fit)."""
+
+    targets = {}
+    for number in numbers:
+        p = protocol(number)
+        if directory is None:
+            targets[number] = (np.asarray(p['sweep'], dtype), fast_curve(p, params))
+        else:
+            targets[number] = tuple(read_dat(os.path.join(directory, p['outputs'][key]['file'])) for key in ('x', 'y'))
+    return targets
+
+
+def parameter_bounds(names, bounds=None):
+    """(lower, upper) arrays of the search space of the parameters 'names' (b in log10), from
+    bounds {name: (low, high)} where given, else around the values of na15_parameters."""
+
+    lower, upper = [], []
+    for name in names:
+        value = na15_parameters[name]
+        kind = name[-2]
+        if bounds and name in bounds:
+            low, high = sorted(bounds[name])
+        elif kind == 'b':
+            low, high = value/b_range, value*b_range
+        elif kind == 'v':
+            low, high = value-v_range, value+v_range
+        else:
+            low, high = sorted((value/k_range, value*k_range))
+        if kind == 'b':
+            if low <= 0:
+                raise ValueError('the bounds of %s must be positive' % name)
+            low, high = np.log10(low), np.log10(high)
+        lower.append(low)
+        upper.append(high)
+    return np.array(lower, dtype), np.array(upper, dtype)
+
+
+def encode(params, names):
+    """Search-space vector of the parameters 'names' (b in log10)."""
+
+    return np.array([np.log10(params[name]) if name[-2] == 'b' else params[name] for name in names], dtype)
+
+
+def decode(z, names):
+    """Parameter dict from a search-space vector."""
+
+    return dict((name, float(10**x if name[-2] == 'b' else x)) for name, x in zip(names, z))
+
+
+def curve_cost(params, protocols, weights=None):
+    """Sum over the protocols {number: (compiled protocol, target y)} of weight * mean squared error
+    of the main curve; inf if the model fails or is not finite."""
+
+    cost = 0.0
+    for number, (p, y) in protocols.items():
+        try:
+            model = fast_curve(p, params)
+        except (np.linalg.LinAlgError, FloatingPointError, ZeroDivisionError):
+            return np.inf
+        error = np.mean((model-y)**2)
+        if not np.isfinite(error):
+            return np.inf
+        cost += (weights or {}).get(number, 1.0)*error
+    return float(cost)
+
+
+def _init_worker(targets, names, weights):
+    global _fit
+    _fit = (dict((number, (target_protocol(number, x), y)) for number, (x, y) in targets.items()), names, weights)
+
+
+def _candidate_cost(z):
+    protocols, names, weights = _fit
+    with np.errstate(all='ignore'):
+        return curve_cost(decode(z, names), protocols, weights)
+
+
+### population-based optimizers: optimizer(evaluate, lower, upper, x0, population, generations, rng, callback)
+### evaluate(Z) returns the costs of the rows of Z; callback(generation, best_z, best_cost) after each generation
+
+def differential_evolution(evaluate, lower, upper, x0=None, population=None, generations=100, rng=None,
+                           callback=None, F=0.7, CR=0.9):
+    """DE/rand/1/bin, the trial vectors of a generation evaluated as one batch. Returns (z, cost)."""
+
+    rng = np.random.default_rng(rng)
+    d = len(lower)
+    population = population or max(10*d, 20)
+    Z = lower + rng.random((population, d))*(upper-lower)
+    if x0 is not None:
+        Z[0] = np.clip(x0, lower, upper)
+    cost = evaluate(Z)
+
+    for generation in range(generations):
+        others = np.array([rng.choice(np.delete(np.arange(population), i), 3, replace=False) for i in range(population)])
+        mutant = Z[others[:, 0]] + F*(Z[others[:, 1]]-Z[others[:, 2]])
+        mutant = np.where(mutant < lower, lower+rng.random((population, d))*(Z-lower), mutant)   # back inside the
+        mutant = np.where(mutant > upper, upper-rng.random((population, d))*(upper-Z), mutant)   # bounds, toward Z
+        cross = rng.random((population, d)) < CR
+        cross[np.arange(population), rng.integers(d, size=population)] = True
+        trial = np.where(cross, mutant, Z)
+
+        trial_cost = evaluate(trial)
+        better = trial_cost <= cost
+        Z[better], cost[better] = trial[better], trial_cost[better]
+        if callback is not None:
+            callback(generation, Z[np.argmin(cost)], cost.min())
+    return Z[np.argmin(cost)], cost.min()
+
+
+def cross_entropy(evaluate, lower, upper, x0=None, population=None, generations=100, rng=None,
+                  callback=None, elite=0.2, smoothing=0.7):
+    """Cross-entropy method: each generation is sampled from a normal distribution (diagonal) and
+    evaluated as one batch; the distribution moves to the mean and spread of the elite fraction."""
+
+    rng = np.random.default_rng(rng)
+    d = len(lower)
+    population = population or max(10*d, 20)
+    n_elite = max(2, int(round(elite*population)))
+    mean = 0.5*(lower+upper) if x0 is None else np.clip(x0, lower, upper)
+    std = 0.25*(upper-lower)
+    best_z, best_cost = mean, np.inf
+
+    for generation in range(generations):
+        Z = np.clip(mean + std*rng.standard_normal((population, d)), lower, upper)
+        Z[0] = best_z if np.isfinite(best_cost) else mean
+        cost = evaluate(Z)
+        order = np.argsort(cost)
+        if cost[order[0]] < best_cost:
+            best_z, best_cost = Z[order[0]].copy(), cost[order[0]]
+        top = Z[order[:n_elite]]
+        mean = smoothing*top.mean(0) + (1-smoothing)*mean
+        std = smoothing*top.std(0) + (1-smoothing)*std
+        if callback is not None:
+            callback(generation, best_z, best_cost)
+    return best_z, best_cost
+
+
+optimizers = dict(differential_evolution=differential_evolution, cross_entropy=cross_entropy)
+
+
+def fit_parameters(targets, names, bounds=None, weights=None, optimizer='differential_evolution', population=None,
+                   generations=100, processes=None, seed=None, start_method=None, callback=None):
+    """Fits the rate parameters 'names' to targets {protocol number: (x, y)} (see target_curves);
+    weights {number: weight} scales the cost of each protocol (default 1).
+
+    optimizer is a name of 'optimizers' or a function with their signature. Each generation is one
+    call of evaluate(Z), mapped over 'processes' worker processes (default: all cores; 1: in this
+    process). Returns dict(parameters, cost, initial_cost, history, evaluations, time)."""
+
+    global _fit
+    names = list(names)
+    unknown = [name for name in names if name not in na15_parameters]
+    if unknown:
+        raise ValueError('unknown rate parameters: %s' % ', '.join(unknown))
+    optimizer = optimizers[optimizer] if isinstance(optimizer, str) else optimizer
+    lower, upper = parameter_bounds(names, bounds)
+    x0 = encode(na15_parameters, names)
+    history = []
+    evaluations = [0]
+
+    def record(generation, z, cost):
+        history.append(float(cost))
+        if callback is not None:
+            callback(generation, decode(z, names), cost)
+
+    processes = processes or os.cpu_count()
+    start = time.time()
+    if processes == 1:
+        _init_worker(targets, names, weights)
+        pool = None
+    else:
+        if start_method is None:
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        pool = multiprocessing.get_context(start_method).Pool(processes, _init_worker, (targets, names, weights))
+
+    def evaluate(Z):
+        Z = np.atleast_2d(Z)
+        evaluations[0] += len(Z)
+        if pool is None:
+            return np.array([_candidate_cost(z) for z in Z], dtype)
+        return np.array(pool.map(_candidate_cost, list(Z), chunksize=max(1, len(Z)//(4*processes))), dtype)
+
+    try:
+        initial_cost = evaluate(x0[None])[0]
+        z, cost = optimizer(evaluate, lower, upper, x0, population, generations, np.random.default_rng(seed), record)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _fit = None
+
+    return dict(parameters=decode(z, names), cost=float(cost), initial_cost=float(initial_cost), history=history,
+                evaluations=evaluations[0], time=time.time()-start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fits Na15 rate parameters to protocol curves.')
+    parser.add_argument('names', nargs='+', help='rate parameters to fit (names of Na15.mod, e.g. O1I1b1)')
+    parser.add_argument('--targets', default=None, help='directory of the target .dat files (default: curves of the current parameters)')
+    parser.add_argument('--protocols', default='1,2,3,4,5', help='comma-separated protocol numbers')
+    parser.add_argument('--optimizer', default='differential_evolution', choices=sorted(optimizers))
+    parser.add_argument('--population', type=int, default=None)
+    parser.add_argument('--generations', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default=None, help='.json file of the fitted parameters')
+    args = parser.parse_args(argv)
+
+    numbers = [int(n) for n in args.protocols.split(',')]
+    targets = target_curves(numbers, args.targets)
+    fit = fit_parameters(targets, args.names, optimizer=args.optimizer, population=args.population,
+                         generations=args.generations, processes=args.processes, seed=args.seed,
+                         callback=lambda n, params, cost: print('generation %d: cost %.3e' % (n, cost)))
+    print('cost %.3e -> %.3e, %d evaluations, %.1f s' % (fit['initial_cost'], fit['cost'], fit['evaluations'], fit['time']))
+    for name, value in fit['parameters'].items():
+        print('%-8s %12.6g  (was %g)' % (name, value, na15_parameters[name]))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(fit['parameters'], f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
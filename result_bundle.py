@@ -0,0 +1,132 @@
+# The following script contains the functions writing and reading result bundles, the binary
+# replacement of the one-value-per-line .dat files: a bundle is a directory with 'meta.json' (run
+# metadata: title, dt, celsius, v_init, cell, rate parameters, clamp levels, windows, ...) and one
+# .npy file per column (e.g. x and y, the summary curves), appended to in chunks with
+# 'append_columns(path, x=..., y=...)'. Full traces are appended one sweep (or one part of a sweep)
+# at a time with 'append_trace(path, t, v, dens, g)' into the flat columns trace_t, trace_v,
+# trace_dens and trace_g, and the number of samples of each sweep goes into trace_length.
+#
+# Each .npy file has a fixed-size header rewritten after every append, so that the files are valid
+# .npy at any time and 'load_bundle(path)' opens them as memory maps: a long protocol-5 run is never
+# held in memory, neither when writing nor when reading ('iter_traces(path)' yields one sweep at a time).
+
+import os
+import ast
+import json
+import struct
+
+import numpy as np
+
+dtype = np.float64
+
+header_size = 128       # bytes of the .npy headers, whatever the number of rows
+trace_columns = ('t', 'v', 'dens', 'g')
+
+
+def _npy_header(descr, shape):
+    """Header of a version 1.0 .npy file padded to header_size bytes."""
+
+    d = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (descr, tuple(shape))
+    d = d.ljust(header_size-10-1)+'\n'
+    return b'\x93NUMPY\x01\x00'+struct.pack('<H', len(d))+d.encode('latin1')
+
+
+def _jsonable(x):
+    if isinstance(x, dict):
+        return dict((str(key), _jsonable(value)) for key, value in x.items())
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return [_jsonable(value) for value in x]
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+def create_bundle(path, meta=None):
+    """Creates (or empties) the bundle directory 'path' and writes its metadata."""
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in os.listdir(path):
+        if name.endswith('.npy'):
+            os.remove(os.path.join(path, name))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(_jsonable(meta or {}), f, indent=1)
+    return path
+
+
+def append_columns(path, **columns):
+    """Appends chunks (arrays along their first axis, or scalars) to columns of the bundle; a column
+    is created at its first append and later chunks must have the same dtype and row shape."""
+
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            values = values.astype(dtype)
+        values = np.ascontiguousarray(values.reshape((-1,)+values.shape[1:]) if values.ndim else values[None])
+        descr = np.lib.format.dtype_to_descr(values.dtype)
+        file_name = os.path.join(path, name+'.npy')
+
+        if not os.path.exists(file_name):
+            with open(file_name, 'wb') as f:
+                f.write(_npy_header(descr, (0,)+values.shape[1:]))
+        with open(file_name, 'r+b') as f:
+            f.seek(10)
+            header = f.read(header_size-10).decode('latin1')
+            info = ast.literal_eval(header.strip())
+            if info['descr'] != descr or tuple(info['shape'][1:]) != values.shape[1:]:
+                raise ValueError('column %r holds %s rows of shape %r, not %s %r'
+                                 % (name, info['descr'], tuple(info['shape'][1:]), descr, values.shape[1:]))
+            f.seek(0, 2)
+            f.write(values.tobytes())
+            f.seek(0)
+            f.write(_npy_header(descr, (info['shape'][0]+len(values),)+values.shape[1:]))
+
+
+def append_trace(path, t, v, dens, g, new_sweep=True):
+    """Appends the trace of one sweep; with new_sweep=False the samples continue the last sweep,
+    so that a long trace can be written in pieces as it is computed."""
+
+    append_columns(path, trace_t=t, trace_v=v, trace_dens=dens, trace_g=g)
+    if new_sweep or not os.path.exists(os.path.join(path, 'trace_length.npy')):
+        append_columns(path, trace_length=np.array([len(t)], np.int64))
+    else:
+        lengths = np.load(os.path.join(path, 'trace_length.npy'), mmap_mode='r+')
+        lengths[-1] += len(t)
+        lengths.flush()
+
+
+def load_bundle(path, mmap=True):
+    """Dict with 'meta' and every column of the bundle, memory-mapped (read only) unless mmap is False."""
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        bundle = dict(meta=json.load(f))
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.npy'):
+            x = np.load(os.path.join(path, name), mmap_mode='r' if mmap else None)
+            bundle[name[:-4]] = x if len(x) else np.asarray(x)
+    return bundle
+
+
+def iter_traces(path):
+    """Yields dict(t, v, dens, g) for each sweep of the bundle, read from the memory maps."""
+
+    bundle = load_bundle(path)
+    if 'trace_length' not in bundle:
+        return
+    ends = np.cumsum(bundle['trace_length'])
+    for start, end in zip(ends-bundle['trace_length'], ends):
+        yield dict((name, np.asarray(bundle['trace_'+name][start:end])) for name in trace_columns)
+
+
+def copy_traces(path, source, rows=1 << 20):
+    """Appends the traces of the bundle source to those of the bundle path, sweep by sweep, in chunks
+    of at most rows samples read from the memory maps."""
+
+    bundle = load_bundle(source)
+    if 'trace_length' not in bundle:
+        return
+    ends = np.cumsum(bundle['trace_length'])
+    for start, end in zip(ends-bundle['trace_length'], ends):
+        for first in range(start, max(end, start+1), rows):
+            append_trace(path, *[np.asarray(bundle['trace_'+name][first:min(first+rows, end)]) for name in trace_columns],
+                         new_sweep=first == start)
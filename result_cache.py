@@ -0,0 +1,185 @@
+# The following script contains the functions of the on-disk cache of protocol results: the peak
+# currents and conductances of every sweep value (and, optionally, its trace) are stored in an entry
+# whose name is the sha256 of everything the result depends on:
+#   the specification of the protocol without its sweep, title and outputs (levels, windows, cell,
+#   clamp, rate parameters, v_init, celsius), the sweep value, the backend and its settings (dt, and
+#   for the NEURON backends mechanism, ss_tol, cvode, ideal, rate tables and the NEURON version), and
+#   the contents of the sources the results are computed by (source_files: the .mod mechanisms, the
+#   engines, the protocols, the peak analysis and decimation, and the NEURON drivers), so that editing
+#   a plotting script, the benchmark or the fitting leaves the cache valid.
+# A run whose inputs are all identical therefore reads every sweep from the cache, and a sweep grid
+# overlapping one already run computes only the values that are missing. Any change of a source or
+# of a setting gives other keys, old entries being left to the eviction.
+#
+# Entries are .npz files '<cache_dir>/<key[:2]>/<key>.npz', written to a temporary file and renamed
+# so that a killed run never leaves a partial entry. Reading an entry updates its modification time,
+# and 'evict(cache_dir, max_bytes)' removes the least recently used entries beyond max_bytes.
+# e.g.
+#
+#   python run_protocol.py 4 5 --backend record --cache --cache-size 512
+
+import os
+import json
+import hashlib
+import tempfile
+import shutil
+
+import numpy as np
+
+from protocols import protocol, target_protocol
+from result_bundle import create_bundle, append_trace, iter_traces, trace_columns, _jsonable
+
+dtype = np.float64
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+cache_dir_default = os.path.join(package_dir, '.protocol_cache')
+max_bytes_default = 1 << 30     # 1 GiB
+
+result_sources = ('na15_kinetics.py', 'protocols.py', 'peak_analysis.py', 'trace_decimation.py', 'state_variables.py',
+                  'neuron_record.py', 'sweep_pool.py', 'run_protocol.py')   # run_protocol: the NEURON cell of neuron_peaks
+
+_source_digest = []
+
+
+def source_files():
+    """Names of the sources the cached results depend on: the .mod files and result_sources."""
+
+    return sorted([name for name in os.listdir(package_dir) if name.endswith('.mod')] + list(result_sources))
+
+
+def source_digest():
+    """sha256 of the contents of the sources of the package (computed once per process)."""
+
+    if not _source_digest:
+        digest = hashlib.sha256()
+        for name in source_files():
+            digest.update(name.encode())
+            with open(os.path.join(package_dir, name), 'rb') as f:
+                digest.update(f.read())
+        _source_digest.append(digest.hexdigest())
+    return _source_digest[0]
+
+
+def sweep_key(p, x, settings):
+    """Key of the result of the sweep value x of the compiled protocol p run with settings (a dict
+    of the backend and of whatever else changes the result)."""
+
+    spec = dict((key, value) for key, value in p['spec'].items() if key not in ('sweep', 'outputs', 'title'))
+    spec['sweep'] = dict((key, value) for key, value in p['spec']['sweep'].items()
+                         if key not in ('values', 'arange', 'logspace'))
+    text = json.dumps(_jsonable(dict(spec=spec, x=float(x), settings=settings, sources=source_digest())),
+                      sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key+'.npz')
+
+
+def read_entry(path, traces=False, trace_points=None):
+    """dict(ipeak, gpeak) of the entry, or None if it is missing or, with traces, holds no trace
+    decimated to trace_points. A hit marks the entry as recently used."""
+
+    try:
+        with np.load(path) as f:
+            if traces and int(f['trace_points']) != (-1 if trace_points is None else trace_points):
+                return None
+            entry = dict(ipeak=f['ipeak'], gpeak=f['gpeak'])
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    os.utime(path, None)
+    return entry
+
+
+def write_entry(path, **arrays):
+    """Writes the entry atomically (temporary file in the same directory, then renamed)."""
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def cache_entries(cache_dir):
+    """[(mtime, bytes, path)] of the entries of the cache."""
+
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.npz'):
+                path = os.path.join(root, name)
+                try:
+                    s = os.stat(path)
+                except OSError:         # removed by another run
+                    continue
+                entries.append((s.st_mtime, s.st_size, path))
+    return entries
+
+
+def evict(cache_dir, max_bytes=max_bytes_default):
+    """Removes the least recently used entries until the cache holds at most max_bytes.
+    Returns the number of entries removed."""
+
+    entries = sorted(cache_entries(cache_dir))
+    total = sum(size for mtime, size, path in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def cached_peaks(number, settings, compute, cache_dir=None, max_bytes=max_bytes_default, bundle=None, trace_points=None):
+    """Peak currents and the conductances at the peaks (n_sweeps x n_windows) of protocol 'number',
+    read from the cache for the sweep values already run with settings and computed for the others
+    by compute(q, bundle) -> (ipeak, gpeak), q being the protocol reduced to the missing values
+    (see protocols.target_protocol) and bundle None or a bundle receiving their traces.
+    With bundle the traces of all the sweeps are appended to it in the order of the sweep, a cached
+    trace being used only if it was decimated to the same trace_points.
+    Returns (ipeak, gpeak, number of sweep values computed)."""
+
+    p = protocol(number)
+    cache_dir = cache_dir or cache_dir_default
+    x = np.asarray(p['sweep'], dtype)
+    paths = [entry_path(cache_dir, sweep_key(p, value, settings)) for value in x]
+    entries = [read_entry(path, bundle is not None, trace_points) for path in paths]
+    missing = [n for n, entry in enumerate(entries) if entry is None]
+
+    if missing:
+        tmp = tempfile.mkdtemp(prefix='protocol_cache_') if bundle is not None else None
+        try:
+            ipeak, gpeak = compute(target_protocol(p, x[missing]), tmp and create_bundle(tmp))
+            traces = iter_traces(tmp) if tmp else iter([None]*len(missing))
+            for k, n in enumerate(missing):
+                entry = dict(ipeak=ipeak[k], gpeak=gpeak[k])
+                trace = next(traces)
+                if trace is not None:
+                    entry['trace_points'] = np.int64(-1 if trace_points is None else trace_points)
+                    entry.update(('trace_'+name, trace[name]) for name in trace_columns)
+                write_entry(paths[n], **entry)
+                entries[n] = dict(ipeak=ipeak[k], gpeak=gpeak[k])
+        finally:
+            if tmp:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    if bundle is not None:
+        for path in paths:     # one sweep in memory at a time
+            with np.load(path) as f:
+                append_trace(bundle, *[f['trace_'+name] for name in trace_columns])
+    if missing:
+        evict(cache_dir, max_bytes)
+    return (np.array([entry['ipeak'] for entry in entries], dtype),
+            np.array([entry['gpeak'] for entry in entries], dtype), len(missing))
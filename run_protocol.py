@@ -0,0 +1,258 @@
+# The following script is the single entry point for running clamp protocols in batch from their
+# specifications (see protocols.py and the .json files of 'protocol_specs'): each protocol is compiled
+# to one of the backends below and its main curve is written, without figures, into a result bundle
+# (see result_bundle.py: curve, metadata and, with --traces, the trace of every sweep), and with --dat
+# also into the two .dat files of the specification, in the same format as the stand-alone scripts.
+#
+#   exact     matrix-exponential engine of na15_kinetics.py, sampled in the measurement windows
+#   batch     all sweeps advanced together on the time grid dt (NumPy)
+#   spectral  closed form over the intervals (protocols sweeping a duration only)
+#   record    NEURON with the clamp of the specification, time loop inside NEURON (Vector.record)
+#   loop      NEURON, time loop in python with h.fadvance() as in the original scripts
+#             (both with the mechanism na15 of Na15.mod or, with --mechanism na15k, the KINETIC scheme of Na15k.mod,
+#             and with --cvode [ATOL] on the variable time step of CVODE, the clamp being VClamp_cvode;
+#             with --ideal the clamp is ideal, v following the levels and ina read from the na15 state,
+#             and --ideal-check compares each ideal trace with that of the full clamp;
+#             with --rate-tables the rates are interpolated in the TABLE of the mechanism)
+#   auto      the fastest available: exact (no NEURON needed)
+#
+# e.g.  python run_protocol.py 1 3 protocol_specs/5_sl_inact_rec.json --backend record --traces --outdir results
+#
+# With --timings [report.jsonl] the phases of every sweep and of every protocol are timed (see phase_timers.py),
+# with --auto-dt TOL each protocol runs at the largest dt meeting the accuracy target TOL (see auto_dt.py),
+# and with --cache [DIR] the results of every sweep value are kept on disk and reused by the runs with the
+# same inputs (see result_cache.py).
+
+import os
+import re
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from protocols import protocol, exact_peaks, spectral_peaks, sweep_levels, main_curve, model_settings
+from result_bundle import create_bundle, append_columns, append_trace
+from trace_decimation import decimate_trace
+from na15_kinetics import na15_parameters, batch_clamp
+from peak_analysis import measure_peaks
+from result_cache import cached_peaks, cache_dir_default, max_bytes_default
+from auto_dt import choose_dt, methods
+import phase_timers
+from phase_timers import phase, end_sweep, end_run
+from script_options import add_neuron_options
+
+dtype = np.float64
+
+backends = ('auto', 'exact', 'batch', 'spectral', 'record', 'loop')
+
+
+def neuron_protocol(number, dt=None, record_mode=True, ss_tol=None, processes=1, bundle=None, trace_points=None,
+                    mechanism='na15', cvode=None, ideal=False):
+    """Main curve of a protocol simulated with NEURON: a soma with na15 (or mechanism, e.g. na15k;
+    initial state from finding_state_variables) and the clamp of the specification, one run_clamp per sweep value.
+    With cvode (absolute tolerance, e.g. 1e-6) the traces are integrated by CVODE, with VClamp_cvode in
+    place of the clamp of the specification. ideal (True or 'check') is that of run_clamp (see neuron_record.py).
+    With bundle the trace of each sweep is appended to it level by level as it is computed (see
+    clamp_peaks in neuron_record.py), decimated to trace_points time bins (see trace_decimation.py)
+    unless trace_points is None."""
+
+    p = protocol(number)
+    ipeak, gpeak = neuron_peaks(p, dt, record_mode, ss_tol, processes, bundle, trace_points, mechanism, cvode, ideal)
+    return np.asarray(p['sweep'], dtype), main_curve(p, ipeak, gpeak)
+
+
+def neuron_peaks(number, dt=None, record_mode=True, ss_tol=None, processes=1, bundle=None, trace_points=None,
+                 mechanism='na15', cvode=None, ideal=False):
+    """Peak currents and the conductances at the peaks (n_sweeps x n_windows) of neuron_protocol."""
+
+    from neuron import h
+    from neuron_record import clamp_peaks
+    from sweep_pool import build_cell, run_sweeps
+    from state_variables import finding_state_variables
+    from na15_kinetics import states
+
+    p = protocol(number)
+    dt, params, gbar, ena = model_settings(p, dt)
+    cell = p['cell']
+    initial_values = finding_state_variables(p['v_init'], p['celsius'], params)
+    rates = dict(na15_parameters, **(params or {}))
+    levels = p['segments'](p['sweep'][0])
+    settings = dict(
+        section=dict((name, cell[name]) for name in ('diam', 'L', 'nseg', 'cm', 'Ra', 'ena')),
+        mechanism=mechanism,
+        na15=dict([('gbar', gbar)]+[('i'+s, float(x)) for s, x in zip(states, initial_values)]),
+        globals=dict([(name+'_'+mechanism, value) for name, value in rates.items()]
+                     + [('usetable_'+mechanism, getattr(h, 'usetable_'+mechanism)), ('celsius', p['celsius']), ('dt', dt)]),
+        clamp=p['clamp'] if cvode is None else 'VClamp_cvode',
+        clamp_params=dict(dur=[d for d, a in levels], amp=[a for d, a in levels]),
+        cvode=dict(active=cvode is not None, atol=cvode or 1e-3))
+    f3cl, seg, soma = build_cell(settings)
+
+    level = p['sweep_level']
+    with phase('run_sweeps'):
+        results = run_sweeps(f3cl, seg, p['v_init'], level, p['sweep'], processes, record_mode, ss_tol, ideal=ideal,
+                             windows=p['windows'], bundle=bundle, trace_points=trace_points) if processes > 1 else None
+
+    ipeak = np.empty((len(p['sweep']), len(p['windows'])), dtype)
+    gpeak = np.empty_like(ipeak)
+    for n, x in enumerate(p['sweep']):
+        getattr(f3cl, level[0])[level[1]] = x
+        h.tstop = sum(f3cl.dur)
+        if results is None:
+            peaks = clamp_peaks(f3cl, seg, p['v_init'], p['windows'], record_mode, ss_tol, ideal, bundle, trace_points)
+        else:
+            peaks = results[n]
+        ipeak[n], gpeak[n] = peaks['ipeak'], peaks['gpeak']
+        end_sweep(value=x)
+    return ipeak, gpeak
+
+
+def run_protocol(number, backend='auto', dt=None, ss_tol=None, processes=1, bundle=None, trace_points=None,
+                 mechanism='na15', cvode=None, ideal=False, cache=None, cache_bytes=max_bytes_default):
+    """(x, y) main curve of a protocol (number, specification file or dict) with the given backend
+    (the NEURON backends with the channel mechanism 'na15' or 'na15k', and with cvode, the absolute
+    tolerance, on the variable time step, and ideal, True or 'check', for an ideal clamp).
+    With bundle (see result_bundle.py) the batch and NEURON backends append the sweep traces to it,
+    decimated to trace_points time bins if given; the exact and spectral backends do not compute traces.
+    With cache (a directory, see result_cache.py) the sweep values already run with the same inputs
+    are read from it and only the others are computed, the cache being kept within cache_bytes."""
+
+    p = protocol(number)
+    if cache is None:
+        ipeak, gpeak = protocol_peaks(p, backend, dt, ss_tol, processes, bundle, trace_points, mechanism, cvode, ideal)
+    else:
+        backend = 'exact' if backend == 'auto' else backend
+        settings = dict(backend=backend, dt=model_settings(p, dt)[0])
+        if backend in ('record', 'loop'):
+            import neuron
+            from neuron import h
+            import neuron_record    # the rate tables are off unless use_rate_tables(True) was called
+            settings.update(mechanism=mechanism, ss_tol=ss_tol, cvode=cvode, ideal=bool(ideal), neuron=neuron.__version__,
+                            rate_tables=bool(getattr(h, 'usetable_'+mechanism)))
+        traces = bundle is not None and backend not in ('exact', 'spectral')
+
+        def compute(q, tmp):
+            return protocol_peaks(q, backend, dt, ss_tol, processes, tmp, trace_points, mechanism, cvode, ideal)
+
+        with phase('cache'):
+            ipeak, gpeak, computed = cached_peaks(p, settings, compute, cache, cache_bytes, bundle if traces else None, trace_points)
+        print('%s: %d of %d sweeps read from the cache' % (p['title'], len(p['sweep'])-computed, len(p['sweep'])))
+    return np.asarray(p['sweep'], dtype), main_curve(p, ipeak, gpeak)
+
+
+def protocol_peaks(number, backend='auto', dt=None, ss_tol=None, processes=1, bundle=None, trace_points=None,
+                   mechanism='na15', cvode=None, ideal=False):
+    """Peak currents and the conductances at the peaks (n_sweeps x n_windows) of run_protocol."""
+
+    p = protocol(number)
+    if backend == 'auto':
+        backend = 'exact'
+    if backend == 'exact':
+        with phase('exact'):
+            return exact_peaks(p, dt)
+    if backend == 'batch':
+        with phase('batch'):
+            dt, params, gbar, ena = model_settings(p, dt)
+            durs, amps = sweep_levels(p)
+            t, v, g, ina, x_end = batch_clamp(durs, amps, p['v_init'], p['celsius'], dt, params=params, gbar=gbar, ena=ena,
+                                              windows=None if bundle is not None else p['windows'])
+            peaks = measure_peaks(t, ina, np.cumsum(durs, axis=1)-durs, p['windows'], g=g)
+        if bundle is not None:
+            for n in range(len(p['sweep'])):
+                valid = np.isfinite(ina[n])     # shorter sweeps end with NaN
+                keep = decimate_trace(t[valid], v[n][valid], ina[n][valid], trace_points, np.cumsum(durs[n])-durs[n], p['windows'])
+                with phase('bundle'):
+                    append_trace(bundle, t[valid][keep], v[n][valid][keep], ina[n][valid][keep], g[n][valid][keep])
+        return peaks['ipeak'], peaks['gpeak']
+    if backend == 'spectral':
+        with phase('spectral'):
+            return spectral_peaks(p, dt=dt)
+    if backend in ('record', 'loop'):
+        return neuron_peaks(p, dt, backend == 'record', ss_tol, processes, bundle, trace_points, mechanism, cvode, ideal)
+    raise ValueError('unknown backend %r, expected one of %s' % (backend, ', '.join(backends)))
+
+
+def write_dat(path, name, values):
+    """Writes values in the format of the scripts: 'name=[', one value per line, '];'."""
+
+    with open(path, 'w') as f:
+        f.write("%s=[\n" % name)
+        for x in values:
+            f.write("%s ,\n" % x)
+        f.write("];")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs clamp protocols from their specifications.')
+    parser.add_argument('protocols', nargs='+', help='protocol number (1 to 5) or specification file (.json, .toml)')
+    parser.add_argument('--backend', default='auto', choices=backends)
+    parser.add_argument('--dt', type=float, default=None, help='time step (ms), default: that of the specification')
+    add_neuron_options(parser)     # --mechanism, --kinetic, --cvode, --ideal, --ideal-check, --ss-tol, --rate-tables
+    parser.add_argument('--processes', type=int, default=1, help='processes for the sweeps of the NEURON backends')
+    parser.add_argument('--outdir', default='.', help='directory of the result bundles')
+    parser.add_argument('--traces', action='store_true', help='also save the trace of every sweep (batch and NEURON backends)')
+    parser.add_argument('--trace-points', type=int, default=None, help='saved traces are decimated to min/max envelopes over this many time bins')
+    parser.add_argument('--dat', action='store_true', help='also write the .dat files of the specification')
+    parser.add_argument('--auto-dt', type=float, default=None, metavar='TOL',
+                        help='per protocol, the largest dt whose probe peak currents (relative) and P2/P1 ratios are within TOL')
+    parser.add_argument('--auto-dt-method', default='richardson', choices=methods, help='error estimate of --auto-dt (see auto_dt.py)')
+    parser.add_argument('--probes', type=int, default=3, help='probe sweeps of --auto-dt')
+    parser.add_argument('--cache', nargs='?', const=cache_dir_default, default=None, metavar='DIR',
+                        help='reuse and store the results of every sweep value in this cache (default: %s)' % cache_dir_default)
+    parser.add_argument('--cache-size', type=float, default=max_bytes_default/2**20, metavar='MB',
+                        help='the least recently used cache entries are removed beyond this size (MB)')
+    parser.add_argument('--timings', nargs='?', const='run_protocol_timings.jsonl', default=None,
+                        help='time the phases of every sweep and protocol into this JSONL report (default: run_protocol_timings.jsonl)')
+    args = parser.parse_args(argv)
+    if args.cvode is not None and args.backend not in ('record', 'loop'):
+        parser.error('--cvode needs a NEURON backend (record or loop)')
+    if args.ideal and args.backend not in ('record', 'loop'):
+        parser.error('--ideal needs a NEURON backend (record or loop): the other backends are ideal clamps already')
+    if args.cvode is not None and args.auto_dt is not None:
+        parser.error('--cvode and --auto-dt exclude each other: CVODE chooses its own time steps')
+    if args.rate_tables and args.backend not in ('record', 'loop'):
+        parser.error('--rate-tables needs a NEURON backend (record or loop)')
+    if args.backend in ('record', 'loop'):
+        from neuron_record import use_rate_tables
+        use_rate_tables(args.rate_tables)
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    if args.timings:
+        phase_timers.enable(args.timings)
+    for name in args.protocols:
+        p = protocol(int(name) if name.isdigit() else name)
+        dt, params, gbar, ena = model_settings(p, args.dt)
+        phase_timers.begin_run(title=p['title'], backend=args.backend)
+        auto = None
+        if args.auto_dt is not None:
+            start = time.time()
+            with phase('auto_dt'):
+                dt, auto = choose_dt(p, args.auto_dt, args.backend, args.auto_dt_method, args.probes, args.dt, ss_tol=args.ss_tol,
+                                     mechanism=args.mechanism)
+            print('%s: dt %g ms, estimated error %.2e (peak currents %.2e, P2/P1 %.2e, order %.2f), %.3f s'
+                  % (p['title'], dt, auto['error'], auto['ipeak_error'], auto['ratio_error'], auto['order'], time.time()-start))
+        bundle = os.path.join(args.outdir, p['outputs'].get('bundle', re.sub(r'\W+', '_', p['title']).strip('_')))
+        with phase('bundle'):
+            create_bundle(bundle, dict(title=p['title'], backend=args.backend, dt=dt, ss_tol=args.ss_tol, auto_dt=auto,
+                                       mechanism=args.mechanism if args.backend in ('record', 'loop') else None,
+                                       cvode=args.cvode, ideal=args.ideal, rate_tables=args.rate_tables,
+                                       parameters=dict(na15_parameters, **(params or {})), spec=p['spec']))
+        start = time.time()
+        x, y = run_protocol(p, args.backend, dt, args.ss_tol, args.processes, bundle if args.traces else None,
+                            args.trace_points, args.mechanism, args.cvode, args.ideal, args.cache, int(args.cache_size*2**20))
+        with phase('bundle'):
+            append_columns(bundle, **{p['sweep_name']: x, p['measure']: y})
+        print('%s: %d sweeps, %s backend, %.3f s' % (p['title'], len(x), args.backend, time.time()-start))
+        if args.dat:
+            with phase('dat'):
+                for key, values in (('x', x), ('y', y)):
+                    if key in p['outputs']:
+                        write_dat(os.path.join(args.outdir, p['outputs'][key]['file']), p['outputs'][key]['name'], values)
+        end_run(dt=dt)
+    phase_timers.disable()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,42 @@
+# The following script contains the command-line options shared by the stand-alone scripts and by
+# run_protocol.py, so that each option is defined once: the options of the NEURON runs (channel
+# mechanism, CVODE, ideal clamp, steady-state fast-forward, rate tables) and, for the scripts, headless mode and
+# the phase timers. e.g.
+#
+#   python 5_sl_inact_rec_static.py --headless --kinetic --ss-tol --timings
+#
+# Arguments the scripts do not know (e.g. those of nrniv -python) are ignored.
+
+import sys
+import argparse
+
+
+def add_neuron_options(parser):
+    """Adds the options of the NEURON runs to the argparse parser: mechanism, cvode, ideal, ss_tol and
+    rate_tables."""
+
+    parser.add_argument('--mechanism', default='na15', choices=('na15', 'na15k'),
+                        help='channel mechanism: na15 (Na15.mod, cnexp) or na15k (Na15k.mod, KINETIC scheme)')
+    parser.add_argument('--kinetic', dest='mechanism', action='store_const', const='na15k', help='as --mechanism na15k')
+    parser.add_argument('--cvode', nargs='?', type=float, const=1e-6, default=None, metavar='ATOL',
+                        help='variable time step (CVODE, absolute tolerance ATOL, default 1e-6) with the clamp VClamp_cvode')
+    parser.add_argument('--ideal', action='store_const', const=True, default=False,
+                        help='ideal clamp: v prescribed from the levels and ina from the na15 state (see run_clamp)')
+    parser.add_argument('--ideal-check', dest='ideal', action='store_const', const='check',
+                        help='as --ideal, each trace being compared with that of the full clamp')
+    parser.add_argument('--ss-tol', nargs='?', type=float, const=1e-9, default=None, metavar='TOL',
+                        help='jump over the clamp levels on which the na15 state settles within TOL (default 1e-9)')
+    parser.add_argument('--rate-tables', action='store_true',
+                        help='interpolate the rates of the mechanism in its TABLE instead of evaluating them (see Na15.mod)')
+    return parser
+
+
+def script_options(timings_report, argv=None):
+    """Options of the command line of a script (default sys.argv): mechanism, cvode, ideal, ss_tol,
+    rate_tables, headless and timings (the report file of --timings, timings_report if none is given, else None)."""
+
+    parser = add_neuron_options(argparse.ArgumentParser(description='Runs the protocol of the script.'))
+    parser.add_argument('--headless', action='store_true', help='results only: no NEURON GUI, no matplotlib, no figure')
+    parser.add_argument('--timings', nargs='?', const=timings_report, default=None, metavar='REPORT',
+                        help='time the phases of each sweep and of the run into this JSONL report (default: %s)' % timings_report)
+    return parser.parse_known_args(sys.argv[1:] if argv is None else argv)[0]
@@ -1,107 +1,136 @@
-# The following script contains a function 'finding_state_variables(v,celsius)', which takes as input # the holding potential in mV and the temperature in celsius and solves the ODE system, describing the # dynamic of the states, at equilibrium.  
+# The following script contains a function 'finding_state_variables(v,celsius)', which takes as input # the holding potential in mV and the temperature in celsius and solves the ODE system, describing the # dynamic of the states, at equilibrium.
+#
+# 'steady_states(v, celsius, params)' does the same for arrays of holding potentials and temperatures
+# (and optionally a list of parameter sets) with one batched np.linalg.solve. Solutions are kept in a
+# bounded LRU cache keyed on (v, celsius, parameters), so that parameter scans over v_init and h.celsius
+# only solve each system once. One holding potential and temperature (the scripts' initial states) take a
+# scalar path instead: rates in python floats and a single 5x5 solve, without arrays to broadcast.
+# The rates are those of na15_kinetics.py (same parameters as Na15.mod).
+
+from collections import OrderedDict
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.integrate import odeint
+
+from na15_kinetics import transition_rates, transitions, equilibrium, na15_parameters
 
 dtype = np.float64
 
+cache_size = 4096           # maximum number of (v, celsius, parameters) solutions kept
+_cache = OrderedDict()
 
-def finding_state_variables(v,celsius):
 
-    global C1, C2, O1, I1, I2
+def parameters_key(params):
+    """Hashable key of a parameter set (None for the default parameters of Na15.mod)."""
+
+    if not params:
+        return None
+    return tuple(sorted((name, float(value)) for name, value in params.items()))
+
+
+def solve_state_variables(v, celsius, params=None):
+    """Equilibrium [C1, C2, O1, I1, I2] (shape v.shape+(5,)) for arrays v and celsius, and parameter
+    values that may themselves be arrays broadcast against them. No caching."""
 
-    ### parameters
-    C1C2b2	  = 8
-    C1C2v2    = -16
-    C1C2k2	  = -9
-
-    C2C1b1	  = 2
-    C2C1v1    = -82
-    C2C1k1	  = 5
-    C2C1b2	  = 8
-    C2C1v2    = -16
-    C2C1k2	  = -9
-
-    C2O1b2	  = 8
-    C2O1v2    = -26
-    C2O1k2	  = -9
-
-    O1C2b1	  = 3
-    O1C2v1    = -92
-    O1C2k1	  = 5
-    O1C2b2	  = 8
-    O1C2v2    = -26
-    O1C2k2	  = -9
-
-    O1I1b1	  = 8
-    O1I1v1	  = -50
-    O1I1k1	  = 4
-    O1I1b2	  = 6
-    O1I1v2	  = 10
-    O1I1k2	  = -100
-
-    I1O1b1	  = 0.00001
-    I1O1v1	  = -20
-    I1O1k1	  = 10
-
-    I1C1b1	  = 0.35
-    I1C1v1	  = -122
-    I1C1k1	  = 9
-
-    C1I1b2	  = 0.04
-    C1I1v2	  = -78
-    C1I1k2	  = -10
-
-    I1I2b2	  = 0.00018
-    I1I2v2	  = -60
-    I1I2k2	  = -5
-
-    I2I1b1	  = 0.001825
-    I2I1v1	  = -88
-    I2I1k1	  = 31
-
-    ###
-    def rates2(v,b,vv,k):
-        return b/(1+np.exp((v-vv)/k))
-    ###
-
-    Q10 = 3**((celsius-20)/10)
-
-    C1C2_a = Q10*(rates2(v, C1C2b2, C1C2v2, C1C2k2))
-    C2C1_a = Q10*(rates2(v, C2C1b1, C2C1v1, C2C1k1) + rates2(v, C2C1b2, C2C1v2, C2C1k2))
-    C2O1_a = Q10*(rates2(v, C2O1b2, C2O1v2, C2O1k2))
-    O1C2_a = Q10*(rates2(v, O1C2b1, O1C2v1, O1C2k1) + rates2(v, O1C2b2, O1C2v2, O1C2k2))
-    O1I1_a = Q10*(rates2(v, O1I1b1, O1I1v1, O1I1k1) + rates2(v, O1I1b2, O1I1v2, O1I1k2))
-    I1O1_a = Q10*(rates2(v, I1O1b1, I1O1v1, I1O1k1))
-    I1C1_a = Q10*(rates2(v, I1C1b1, I1C1v1, I1C1k1))
-    C1I1_a = Q10*(rates2(v, C1I1b2, C1I1v2, C1I1k2))
-    I1I2_a = Q10*(rates2(v, I1I2b2, I1I2v2, I1I2k2))
-    I2I1_a = Q10*(rates2(v, I2I1b1, I2I1v1, I2I1k1))
+    r = transition_rates(v, celsius, params)
+    r = dict(zip(r.keys(), np.broadcast_arrays(*r.values())))
+    zero = np.zeros_like(r['C1C2_a'])
 
     ### solving the ODE system at equilibrium taking into account the conservation law:
     ### C1+C2+O1+I1+I2 =1 ->
-    ### solving the following linear system 
+    ### solving the following linear system
 
-    A= np.array([[-(C1I1_a+C1C2_a),+C2C1_a,0,I1C1_a],
-                 [C1C2_a,-(C2C1_a+C2O1_a),+O1C2_a,0],
-                 [0,+ C2O1_a, -(O1C2_a+O1I1_a),+I1O1_a],
-                 [(C1I1_a-I2I1_a), -I2I1_a, (O1I1_a-I2I1_a),-(I1C1_a+I1I2_a+I1O1_a+I2I1_a)]])
+    A = np.stack([np.stack([-(r['C1I1_a']+r['C1C2_a']), +r['C2C1_a'], zero, r['I1C1_a']], -1),
+                  np.stack([r['C1C2_a'], -(r['C2C1_a']+r['C2O1_a']), +r['O1C2_a'], zero], -1),
+                  np.stack([zero, +r['C2O1_a'], -(r['O1C2_a']+r['O1I1_a']), +r['I1O1_a']], -1),
+                  np.stack([(r['C1I1_a']-r['I2I1_a']), -r['I2I1_a'], (r['O1I1_a']-r['I2I1_a']),
+                            -(r['I1C1_a']+r['I1I2_a']+r['I1O1_a']+r['I2I1_a'])], -1)], -2)
 
+    b = np.stack([zero, zero, zero, -r['I2I1_a']], -1)
 
-    b=np.array([0,0,0,-I2I1_a])
+    x = np.linalg.solve(A, b[..., None])[..., 0]
 
+    return np.concatenate([x, 1-x.sum(-1, keepdims=True)], -1)
 
-    x=np.linalg.solve(A,b)
 
-    C1=x[0]
-    C2=x[1]
-    O1=x[2]
-    I1=x[3]
-    I2= 1-np.sum([x])
+def scalar_state_variables(v, celsius, params=None):
+    """Equilibrium [C1, C2, O1, I1, I2] for one holding potential and temperature (python floats):
+    the rate matrix built from float rates and a single 5x5 solve. No caching."""
+
+    r = transition_rates(v, celsius, params)
+    Q = [[0.]*5 for _ in range(5)]
+    for name, (i, j) in transitions.items():
+        Q[j][i] += r[name]
+        Q[i][i] -= r[name]
+
+    return equilibrium(Q)
+
+
+def scalar_steady_state(v, celsius, params=None):
+    """Cached equilibrium [C1, C2, O1, I1, I2] (shape (5,), not to be modified) for one holding potential
+    and temperature and one parameter set (None or a dict): the scalar path of steady_states."""
+
+    key = (float(v), float(celsius), parameters_key(params))
+    x = _cache.get(key)
+    if x is None:
+        x = _cache[key] = scalar_state_variables(key[0], key[1], params)
+        if len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    return x
 
-    return C1, C2, O1, I1, I2
 
+def steady_states(v, celsius, params=None):
+    """Equilibrium [C1, C2, O1, I1, I2] for arrays of holding potentials v (mV) and temperatures
+    celsius, broadcast against each other: the result has shape broadcast(v, celsius).shape+(5,).
+    params is None (parameters of Na15.mod), a dict of parameters to change, or a list of such dicts,
+    in which case the result gets a leading axis over the parameter sets."""
 
+    if np.ndim(v) == 0 and np.ndim(celsius) == 0 and not isinstance(params, (list, tuple)):
+        return scalar_steady_state(v, celsius, params).copy()
 
+    sets = params if isinstance(params, (list, tuple)) else [params]
+    v, celsius = np.broadcast_arrays(np.asarray(v, dtype), np.asarray(celsius, dtype))
+    keys = [(float(vi), float(ci), parameters_key(p)) for p in sets for vi, ci in zip(v.ravel(), celsius.ravel())]
+    combos = [(vi, ci, p) for p in sets for vi, ci in zip(v.ravel(), celsius.ravel())]
 
+    missing = {}
+    for key, combo in zip(keys, combos):
+        if key in _cache:
+            _cache.move_to_end(key)
+        else:
+            missing[key] = combo
+
+    if missing:
+        vm = np.array([c[0] for c in missing.values()], dtype)
+        cm = np.array([c[1] for c in missing.values()], dtype)
+        names = set(name for c in missing.values() if c[2] for name in c[2])
+        pm = dict((name, np.array([(c[2] or {}).get(name, np.nan) for c in missing.values()], dtype))
+                  for name in names)
+        for name, values in pm.items():     # parameters not changed in some sets keep their default
+            values[np.isnan(values)] = na15_parameters[name]
+        x = solve_state_variables(vm, cm, pm)
+        for key, state in zip(missing, x):
+            _cache[key] = state
+            _cache.move_to_end(key)
+
+    result = np.array([_cache[key] for key in keys], dtype)
+    while len(_cache) > cache_size:
+        _cache.popitem(last=False)
+
+    shape = v.shape+(5,) if not isinstance(params, (list, tuple)) else (len(sets),)+v.shape+(5,)
+    return result.reshape(shape)
+
+
+def finding_state_variables(v,celsius,params=None):
+
+    global C1, C2, O1, I1, I2
+
+    if np.ndim(v) == 0 and np.ndim(celsius) == 0 and not isinstance(params, (list, tuple)):
+        x = scalar_steady_state(v, celsius, params).tolist()     # python floats, as before the cache
+    else:
+        x = np.moveaxis(steady_states(v, celsius, params), -1, 0)
+
+    C1, C2, O1, I1, I2 = x
+
+    return C1, C2, O1, I1, I2
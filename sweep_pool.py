@@ -0,0 +1,149 @@
+# The following script contains a function 'run_sweeps(f3cl, seg, v_init, level, values)' which runs the
+# independent sweeps of a protocol on a pool of processes, each worker with its own NEURON instance
+# (na15 on a soma and its own clamp), and returns the traces in sweep order, as run_clamp would have
+# returned them one after the other.
+#
+# With measurement windows each worker measures the peaks of its sweeps level by level instead (see
+# clamp_peaks in neuron_record.py) and, with a bundle, writes their traces to a bundle of its own,
+# copied into the caller's in sweep order, so that no trace is ever held in memory as a whole.
+#
+# With the 'fork' start method (default where available) each worker is a copy of the calling script,
+# with its soma and clamp already built. With 'spawn' the worker builds them again from the settings
+# read from the caller's objects (geometry, ena, na15 parameters and initial values, clamp levels).
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+from neuron import h
+import numpy as np
+
+from neuron_record import run_clamp, clamp_peaks, na15_mechanism
+from result_bundle import create_bundle, copy_traces
+from na15_kinetics import na15_parameters, states
+import phase_timers
+
+_cell = None    # (f3cl, seg, v_init, record_mode, ss_tol, ideal) used by the worker process
+
+
+def cell_settings(f3cl, seg, v_init, record_mode=True, ss_tol=None, ideal=False):
+    """Everything needed to rebuild the soma, na15 and the clamp f3cl in another process."""
+
+    sec = seg.sec
+    mechanism = na15_mechanism(seg)
+    mech = getattr(seg, mechanism)
+    return dict(
+        section=dict(diam=sec.diam, L=sec.L, cm=sec.cm, Ra=sec.Ra, nseg=sec.nseg, ena=sec.ena),
+        mechanism=mechanism,
+        na15=dict([('gbar', mech.gbar)]+[('i'+s, getattr(mech, 'i'+s)) for s in states]),
+        globals=dict([(name+'_'+mechanism, getattr(h, name+'_'+mechanism)) for name in na15_parameters]
+                     + [('usetable_'+mechanism, getattr(h, 'usetable_'+mechanism)), ('celsius', h.celsius), ('dt', h.dt)]),
+        clamp=f3cl.hname().split('[')[0],
+        clamp_params=dict([('dur', list(f3cl.dur)), ('amp', list(f3cl.amp))]
+                          + [(name, getattr(f3cl, name)) for name in ('gain', 'rstim', 'tau1', 'tau2', 'rs') if hasattr(f3cl, name)]),
+        cvode=dict(active=bool(h.CVode().active()), atol=h.CVode().atol()),
+        v_init=v_init, record_mode=record_mode, ss_tol=ss_tol, ideal=ideal)
+
+
+def build_cell(settings):
+    """Soma with na15 (or settings['mechanism'], e.g. na15k) and the clamp, as in the scripts, from
+    cell_settings(); returns (f3cl, seg, soma)."""
+
+    mechanism = settings.get('mechanism', 'na15')
+    soma = h.Section(name='soma')
+    for name in ('nseg', 'diam', 'L', 'cm', 'Ra'):
+        setattr(soma, name, settings['section'][name])
+    soma.insert(mechanism)
+    soma.ena = settings['section']['ena']
+    for name, value in settings['globals'].items():
+        setattr(h, name, value)
+    if 'cvode' in settings:
+        h.CVode().active(settings['cvode']['active'])
+        h.CVode().atol(settings['cvode']['atol'])
+    for seg in soma:
+        for name, value in settings['na15'].items():
+            setattr(getattr(seg, mechanism), name, value)
+
+    f3cl = getattr(h, settings['clamp'])(soma(0.5))
+    for name, value in settings['clamp_params'].items():
+        if isinstance(value, list):
+            for j, x in enumerate(value):
+                getattr(f3cl, name)[j] = x
+        else:
+            setattr(f3cl, name, value)
+    return f3cl, soma(0.5), soma
+
+
+def _init_worker(settings, timed=False):
+    global _cell
+    phase_timers.enabled = timed    # the worker only times its phases, the report is the caller's
+    if _cell is None:   # spawned worker: nothing inherited from the caller
+        f3cl, seg, soma = build_cell(settings)
+        _cell = (f3cl, seg, settings['v_init'], settings['record_mode'], settings['ss_tol'], settings.get('ideal', False), soma)
+
+
+def _run_sweep(task):
+    level, value, windows, bundle, trace_points = task
+    f3cl, seg, v_init, record_mode, ss_tol, ideal = _cell[:6]
+    getattr(f3cl, level[0])[level[1]] = value
+    h.tstop = sum(f3cl.dur)
+    phase_timers.take()         # a forked worker starts with the phases of its parent
+    if windows is None:
+        result = run_clamp(f3cl, seg, v_init, record_mode, ss_tol, ideal)
+    else:
+        result = clamp_peaks(f3cl, seg, v_init, windows, record_mode, ss_tol, ideal,
+                             bundle and create_bundle(bundle), trace_points)
+    return result, phase_timers.take() if phase_timers.enabled else None
+
+
+def run_sweeps(f3cl, seg, v_init, level, values, processes=None, record_mode=True, ss_tol=None, start_method=None,
+               ideal=False, windows=None, bundle=None, trace_points=None):
+    """Runs one trace per value of 'values', assigned to f3cl.<level[0]>[level[1]] (e.g. ('dur', 2)
+    or ('amp', 1)), with h.tstop = sum(f3cl.dur), on 'processes' workers (default: all cores).
+
+    Sweeps are handed out longest first, so that the run takes about as long as the longest sweep
+    when there are enough cores. Returns the list of (t, v, dens, g) in the order of 'values'.
+    With windows it returns the list of their peaks instead (see clamp_peaks), and with bundle the
+    traces are appended to it in the order of 'values', decimated to trace_points time bins.
+    With the phase timers enabled the phases of the worker that ran values[k] are added as
+    'worker:<phase>' to the k-th sweep of the caller from its current one (see phase_timers.merge),
+    reported when the caller ends that sweep after handling values[k]."""
+
+    global _cell
+    values = list(values)
+    processes = min(processes or os.cpu_count(), len(values))
+    if start_method is None:
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+
+    # estimated cost of each sweep: its duration
+    cost = []
+    for x in values:
+        durs = list(f3cl.dur)
+        if level[0] == 'dur':
+            durs[level[1]] = x
+        cost.append(sum(durs))
+    order = np.argsort(cost, kind='stable')[::-1]
+
+    settings = cell_settings(f3cl, seg, v_init, record_mode, ss_tol, ideal)
+    _cell = (f3cl, seg, v_init, record_mode, ss_tol, ideal) if start_method == 'fork' else None
+    tmp = tempfile.mkdtemp(prefix='sweep_pool_') if windows is not None and bundle is not None else None
+    try:
+        ctx = multiprocessing.get_context(start_method)
+        with ctx.Pool(processes, _init_worker, (settings, phase_timers.enabled)) as pool:
+            traces = pool.map(_run_sweep, [(level, values[k], windows, tmp and os.path.join(tmp, str(k)), trace_points)
+                                           for k in order], chunksize=1)
+
+        result = [None]*len(values)
+        for k, (trace, phases) in zip(order, traces):
+            result[k] = trace
+            if phases:
+                phase_timers.merge(phases, ahead=k)
+        if tmp:
+            for k in range(len(values)):
+                copy_traces(bundle, os.path.join(tmp, str(k)))
+    finally:
+        _cell = None
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return result
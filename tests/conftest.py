@@ -0,0 +1,6 @@
+# The tests import the modules of the package from the directory above (python -m pytest tests).
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
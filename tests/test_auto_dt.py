@@ -0,0 +1,68 @@
+# Tests of the choice of the time step from an accuracy target (auto_dt.py): the error estimates of
+# estimate_error on known sequences, and choose_dt on the exact backend against a much finer dt.
+
+import numpy as np
+import pytest
+
+from auto_dt import estimate_error, choose_dt, probe_protocol
+from protocols import exact_peaks
+
+
+def first_order(dt, c=np.array([[0.5, -2.0], [1.0, -1.0]])):
+    """Peaks (2 probes x 2 windows) converging at first order to [[-1, -0.5], [-2, -1.5]]."""
+
+    return np.array([[-1, -0.5], [-2, -1.5]])+c*dt
+
+
+def test_richardson_of_a_first_order_sequence():
+    dt = 0.1
+    e = estimate_error(first_order(dt/2)[:, :1], first_order(dt)[:, :1], first_order(dt/4)[:, :1])
+    assert np.isclose(e['order'], 1) and e['ratio_error'] == 0
+    error = np.abs(first_order(dt)-first_order(0))/np.abs(first_order(dt/2)).max(axis=0)
+    assert np.isclose(e['ipeak_error'], error[:, 0].max())
+
+    e = estimate_error(first_order(dt/2), first_order(dt), first_order(dt/4))
+    ratio = lambda q: np.abs(q[:, 1])/np.abs(q[:, 0])
+    assert np.isclose(e['ipeak_error'], error.max(), rtol=0.1)
+    assert np.isclose(e['ratio_error'], np.abs(ratio(first_order(dt))-ratio(first_order(0))).max(), rtol=0.1)
+    assert e['error'] == max(e['ipeak_error'], e['ratio_error'])
+
+
+def test_reference_and_halving():
+    coarse, exact = first_order(0.1), first_order(0)
+    e = estimate_error(exact, coarse, order=np.inf)
+    assert e['ipeak_error'] == (np.abs(coarse-exact)/np.abs(exact).max(axis=0)).max()
+    assert estimate_error(exact, exact, order=np.inf)['error'] == 0
+    assert np.isfinite(estimate_error(first_order(0.05), coarse)['error'])
+    assert estimate_error(coarse, coarse)['error'] == np.inf
+
+
+@pytest.mark.parametrize('coarse, fine, finest', [
+    (0.1, 0.1, 0.1),        # no difference at all
+    (0.1, 0.1, 0.05),       # quantized: coarse and fine equal, finest different
+    (0.1, 0.05, 0.5),       # differences that grow
+])
+def test_differences_that_cannot_be_extrapolated(coarse, fine, finest):
+    e = estimate_error(first_order(fine), first_order(coarse), first_order(finest))
+    assert e['error'] == e['ipeak_error'] == e['ratio_error'] == np.inf
+
+
+def test_quantized_quantity():
+    coarse, fine, finest = first_order(0.1), first_order(0.05), first_order(0.025)
+    coarse[0, 0] = fine[0, 0]       # one peak unchanged by the first halving only
+    assert estimate_error(fine, coarse, finest)['error'] == np.inf
+
+
+@pytest.mark.parametrize('tol', [1e-3, 1e-4, 1e-5])
+def test_choose_dt_meets_the_target(tol):
+    dt, info = choose_dt(5, tol, 'exact', max_steps=8)
+    assert info['error'] <= tol and info['dt'] == dt
+    assert all(error > tol for step, error in info['tried'] if step < dt)
+    p = probe_protocol(5)
+    reference = exact_peaks(p, 0.075/512)[0]
+    assert (np.abs(exact_peaks(p, dt)[0]-reference)/np.abs(reference).max(axis=0)).max() <= tol
+
+
+def test_choose_dt_gives_up():
+    with pytest.raises(ValueError):
+        choose_dt(5, 1e-12, 'exact', max_steps=2)
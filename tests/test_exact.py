@@ -0,0 +1,69 @@
+# Tests of the exact engine (exact_clamp in na15_kinetics.py) and of the batch engine that runs every
+# sweep of a protocol together (batch_clamp), against each other and against a direct expm, and the
+# settling time bound used to jump over the settled clamp levels (settling_time).
+
+import numpy as np
+import pytest
+from scipy.linalg import expm
+
+from na15_kinetics import exact_clamp, batch_clamp, rate_matrix, steady_state, settling_time
+from protocols import protocol, exact_protocol, batch_protocol, sweep_levels
+
+
+@pytest.mark.parametrize('number', [1, 2, 3, 4, 5])
+def test_exact_protocol_matches_batch_protocol(number):
+    x_exact, y_exact = exact_protocol(number)
+    x_batch, y_batch = batch_protocol(number)[:2]
+    assert np.array_equal(x_exact, x_batch)
+    assert np.abs(y_exact-y_batch).max() < 1e-12
+
+
+def test_exact_clamp_matches_expm():
+    segments = [(5, -120), (2.5, -10), (3, -70)]
+    t = np.array([0, 1, 5, 6.2, 7.5, 10.5])
+    t, v, x, ina = exact_clamp(segments, -120, 24, t)
+
+    x0 = steady_state(-120, 24)
+    Q = rate_matrix(np.array([-120, -10, -70.0]), 24)
+    expected = [x0, x0, x0, expm(Q[1]*1.2) @ x0, expm(Q[2]*0) @ expm(Q[1]*2.5) @ x0,
+                expm(Q[2]*3) @ expm(Q[1]*2.5) @ x0]
+    assert np.allclose(x, expected, rtol=0, atol=1e-13)
+    assert np.array_equal(v, [-120, -120, -10, -10, -70, -70])     # a boundary belongs to the next level
+    assert np.allclose(x.sum(axis=1), 1, rtol=0, atol=1e-13)
+
+
+def test_exact_clamp_initial_state():
+    x_init = np.array([0.2, 0.2, 0.1, 0.3, 0.2])
+    t, v, x, ina = exact_clamp([(10, -20)], None, 24, [0, 4], x_init=x_init)
+    assert np.allclose(x[0], x_init, rtol=0, atol=1e-15)
+    assert np.allclose(x[1], expm(rate_matrix(-20.0, 24)*4) @ x_init, rtol=0, atol=1e-13)
+
+
+def test_batch_clamp_masks_samples_after_the_end_of_each_sweep():
+    p = protocol(3)
+    durs, amps = sweep_levels(p)
+    t, v, g, ina, x_end = batch_clamp(durs[:3], amps[:3], p['v_init'], p['celsius'], p['dt'], p['params'],
+                                      p['cell']['gbar'], p['cell']['ena'])
+    total = durs[:3].sum(axis=1)
+    for n in range(3):
+        assert np.isnan(ina[n, t >= total[n]]).all()
+        assert np.isfinite(ina[n, t < total[n]]).all()
+
+    segments = p['segments'](p['sweep'][0])
+    inside = t < total[0]
+    t0, v0, x0, ina0 = exact_clamp(segments, p['v_init'], p['celsius'], t[inside], p['params'], p['cell']['gbar'],
+                                   p['cell']['ena'])
+    assert np.abs(ina[0, inside]-ina0).max() < 1e-12
+
+
+def test_settling_time_bounds_the_distance_to_the_steady_state():
+    Q = rate_matrix(-120, 24)
+    x0 = steady_state(-20, 24)
+    tau, x_ss = settling_time(x0, Q, 1e-6)
+    assert 0 < tau < np.inf and np.allclose(x_ss, steady_state(-120, 24))
+    for t in (tau, 2*tau):
+        assert np.abs(expm(Q*t) @ x0 - x_ss).max() <= 1e-6+1e-12        # tight at tau, up to the rounding of expm
+
+    assert settling_time(x0, Q, 1e-6, horizon=tau/2)[0] == np.inf          # does not settle before horizon
+    assert np.isclose(settling_time(x0, Q, 1e-6, horizon=2*tau)[0], tau, rtol=1e-12)
+    assert settling_time(x_ss, Q, 1e-6, horizon=0)[0] == 0
@@ -0,0 +1,67 @@
+# Tests of the windowed peak measurement (peak_analysis.py): window bounds, single traces against
+# batches, NaN padding, and peaks measured in pieces with merge_peaks.
+
+import numpy as np
+import pytest
+
+from peak_analysis import window_mask, measure_peaks, merge_peaks
+
+dt = 0.025
+t = np.arange(801)*dt                                   # 0 to 20 ms
+level_starts = [0., 5., 12.]
+windows = [(1, 0, 3), (2, 0.5, 4)]
+
+
+def trace(shift=0.):
+    """Two negative transients, at 6.5+shift ms (-2) and 14+shift ms (-1), and a positive one outside the windows."""
+
+    return -2*np.exp(-((t-6.5-shift)/0.3)**2)-np.exp(-((t-14-shift)/0.3)**2)+3*np.exp(-((t-2)/0.3)**2)
+
+
+def test_window_bounds():
+    mask = window_mask(t, np.array([level_starts]), (1, 0, 3))[0]
+    inside = t[mask]
+    assert np.isclose(inside[0], 5+dt) and np.isclose(inside[-1], 8)     # start < t - t_j <= end
+    assert mask.sum() == 120
+
+
+def test_single_trace():
+    g = np.abs(trace())/10
+    peaks = measure_peaks(t, trace(), level_starts, windows, g=g)
+    assert np.allclose(peaks['tpeak'], [6.5, 14])
+    assert np.allclose(peaks['ipeak'], [-2, -1])
+    assert np.allclose(peaks['gpeak'], [0.2, 0.1])
+    assert np.isclose(peaks['ratio'], 0.5)
+
+
+def test_batch_equals_single_traces():
+    shifts = [0., 0.5, 1.]
+    dens = np.array([trace(shift) for shift in shifts])
+    starts = np.array([[s+shift for s in level_starts] for shift in shifts])
+    batch = measure_peaks(t, dens, starts, windows, g=dens**2)
+    for n, shift in enumerate(shifts):
+        single = measure_peaks(t, dens[n], starts[n], windows, g=dens[n]**2)
+        for key in ('ipeak', 'gpeak', 'tpeak', 'ratio'):
+            assert np.array_equal(batch[key][n], single[key])
+
+
+def test_nan_samples_are_ignored():
+    dens = np.array([trace(), trace()])
+    dens[1, 480:] = np.nan          # a shorter sweep, padded after 12 ms
+    peaks = measure_peaks(t, dens, np.array([level_starts]*2), [(1, 0, 3)])
+    assert np.array_equal(peaks['ipeak'][0], peaks['ipeak'][1])
+    with pytest.raises(ValueError):
+        measure_peaks(t, dens, np.array([level_starts]*2), windows)
+    assert np.isnan(measure_peaks(t, dens, np.array([level_starts]*2), windows, missing=True)['ipeak'][1, 1])
+
+
+@pytest.mark.parametrize('bounds', [[0, 801], [0, 200, 260, 801], [0, 300, 560, 561, 700, 801]])
+def test_merged_pieces_equal_the_whole(bounds):
+    dens, g = trace(), np.abs(trace())/10
+    whole = measure_peaks(t, dens, level_starts, windows, g=g)
+    peaks = None
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        peaks = merge_peaks(peaks, measure_peaks(t[start:end], dens[start:end], level_starts, windows,
+                                                 g=g[start:end], missing=True))
+    for key in ('ipeak', 'gpeak', 'tpeak', 'ratio'):
+        assert np.array_equal(peaks[key], whole[key])
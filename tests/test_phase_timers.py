@@ -0,0 +1,32 @@
+# Tests of the phase timers (phase_timers.py): the phases of worker processes are reported in the line
+# of the sweep they belong to, and summed in the run line.
+
+import json
+
+import phase_timers
+from phase_timers import enable, disable, merge, end_sweep, end_run, phase
+
+
+def test_worker_phases_belong_to_their_sweep(tmp_path):
+    path = str(tmp_path/'timings.jsonl')
+    enable(path, title='test')
+    try:
+        with phase('run_sweeps'):
+            for k in range(3):              # as run_sweeps: one worker per sweep, merged before the first ends
+                merge({'continuerun': [0.1*(k+1), 1], 'peaks': [0.01, 2]}, ahead=k)
+        for k in range(3):
+            end_sweep(value=10*k)
+        merge({'continuerun': [1.0, 1]}, ahead=1)      # a sweep that is never ended still counts in the run
+        end_run()
+    finally:
+        disable()
+
+    lines = [json.loads(line) for line in open(path)]
+    sweeps, run = lines[:3], lines[3]
+    assert [line['value'] for line in sweeps] == [0, 10, 20] and run['record'] == 'run'
+    for k, line in enumerate(sweeps):
+        assert abs(line['phases']['worker:continuerun']['seconds']-0.1*(k+1)) < 1e-12
+        assert line['phases']['worker:peaks']['calls'] == 2
+    assert 'run_sweeps' in sweeps[0]['phases'] and 'run_sweeps' not in sweeps[1]['phases']
+    assert abs(run['phases']['worker:continuerun']['seconds']-1.6) < 1e-12
+    assert run['phases']['worker:continuerun']['calls'] == 4 and not phase_timers._pending
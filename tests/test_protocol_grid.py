@@ -0,0 +1,28 @@
+# Tests of the (celsius, v_init) grid of protocol curves (protocol_grid.py) against exact_protocol run
+# cell by cell, with the eigenmodes of the clamp levels shared between the cells and the calls.
+
+import numpy as np
+import pytest
+
+from protocol_grid import grid_curves
+from protocols import protocol, exact_protocol
+
+celsius = [10., 24., 37.]
+v_init = [-120., -90., -70.]
+
+
+@pytest.mark.parametrize('number', [1, 2, 3, 4, 5])
+def test_grid_matches_exact_protocol_per_cell(number):
+    spec = protocol(number)['spec']
+    modes = {}
+    x, y = grid_curves(number, celsius, v_init, modes=modes)
+    assert y.shape == (len(celsius), len(v_init), len(x)) and modes
+    for a, c in enumerate(celsius):
+        for b, v in enumerate(v_init):
+            x_cell, y_cell = exact_protocol(dict(spec, celsius=c, v_init=v))
+            assert np.array_equal(x, x_cell)
+            assert np.allclose(y[a, b], y_cell, rtol=1e-9, atol=1e-12, equal_nan=True)
+
+    n_modes = len(modes)
+    assert np.array_equal(grid_curves(number, celsius, v_init, modes=modes)[1], y, equal_nan=True)
+    assert len(modes) == n_modes                # the second call reuses the eigenmodes of every level
@@ -0,0 +1,43 @@
+# Tests of the fit of the rate parameters (rate_fitting.py): recovery of known parameters from the curves
+# they produce (target_curves(params=...)), and the search space (encode, decode, parameter_bounds).
+
+import numpy as np
+import pytest
+
+from na15_kinetics import na15_parameters
+from rate_fitting import fit_parameters, target_curves, parameter_bounds, encode, decode, b_range, v_range
+
+names = ['O1I1b1', 'O1I1v1', 'O1I1k2', 'I1C1k1', 'I1O1b1']
+
+
+def test_encode_and_decode_are_inverse():
+    z = encode(na15_parameters, names)
+    assert z[0] == np.log10(8) and z[1] == -50 and z[4] == -5     # b in log10, v and k as they are
+    assert decode(z, names) == pytest.approx(dict((name, na15_parameters[name]) for name in names), rel=1e-12)
+    z = np.array([0.5, -40., -80., 12., -3.])
+    assert np.allclose(encode(decode(z, names), names), z, rtol=0, atol=1e-12)
+
+
+def test_parameter_bounds():
+    lower, upper = parameter_bounds(names)
+    z = encode(na15_parameters, names)
+    assert np.all(lower < z) and np.all(z < upper)
+    assert np.allclose(upper-lower, [2*np.log10(b_range), 2*v_range, 150, 13.5, 2*np.log10(b_range)])
+    assert decode(lower, names)['O1I1k2'] == -200 and decode(upper, names)['O1I1k2'] == -50    # k keeps its sign
+
+    lower, upper = parameter_bounds(names, dict(O1I1b1=(100, 1), O1I1v1=(-60, -55)))
+    assert decode(lower, names)['O1I1b1'] == pytest.approx(1) and decode(upper, names)['O1I1b1'] == pytest.approx(100)
+    assert (lower[1], upper[1]) == (-60, -55)
+    with pytest.raises(ValueError):
+        parameter_bounds(['O1I1b1'], dict(O1I1b1=(0, 1)))
+
+
+@pytest.mark.parametrize('optimizer', ['differential_evolution', 'cross_entropy'])
+def test_fit_recovers_the_parameters_of_the_targets(optimizer):
+    true = dict(I1I2b2=3e-4, I2I1b1=1.2e-3)                          # slow inactivation, off the defaults
+    targets = target_curves((4, 5), params=true)
+    fit = fit_parameters(targets, list(true), optimizer=optimizer, population=16, generations=30,
+                         processes=1, seed=1)
+    assert fit['parameters'] == pytest.approx(true, rel=1e-2)
+    assert fit['cost'] < 1e-5*fit['initial_cost']
+    assert len(fit['history']) == 30 and np.all(np.diff(fit['history']) <= 0)
@@ -0,0 +1,91 @@
+# Tests of the result bundles (result_bundle.py): columns appended in chunks, traces appended in
+# pieces, and the round trip through load_bundle, iter_traces and copy_traces.
+
+import os
+
+import numpy as np
+import pytest
+
+from result_bundle import create_bundle, append_columns, append_trace, load_bundle, iter_traces, copy_traces
+
+
+def sweep_trace(n, length):
+    t = np.arange(length)*0.025
+    return t, -120+n+0*t, np.sin(t+n), np.cos(t+n)**2
+
+
+def write_traces(path, lengths, pieces=1):
+    for n, length in enumerate(lengths):
+        columns = sweep_trace(n, length)
+        bounds = np.linspace(0, length, pieces+1).astype(int)
+        for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            append_trace(path, *[x[start:end] for x in columns], new_sweep=k == 0)
+
+
+def test_columns_round_trip(tmp_path):
+    path = create_bundle(str(tmp_path/'bundle'), dict(title='test', dt=np.float64(0.025), levels=[(5, -120), (20, -10)]))
+    x, y = np.arange(10.), np.linspace(0, 1, 10)
+    for start in range(0, 10, 3):
+        append_columns(path, x=x[start:start+3], y=y[start:start+3])
+    append_columns(path, peaks=np.ones((2, 3)))
+    append_columns(path, peaks=np.zeros((1, 3)))
+
+    bundle = load_bundle(path)
+    assert bundle['meta'] == dict(title='test', dt=0.025, levels=[[5, -120], [20, -10]])
+    assert isinstance(bundle['x'], np.memmap)
+    assert np.array_equal(bundle['x'], x) and np.array_equal(bundle['y'], y)
+    assert np.array_equal(bundle['peaks'], [[1, 1, 1], [1, 1, 1], [0, 0, 0]])
+    for name in ('x', 'y', 'peaks'):     # valid .npy files, as written
+        assert np.array_equal(np.load(os.path.join(path, name+'.npy')), bundle[name])
+
+
+def test_mismatched_chunks_are_refused(tmp_path):
+    path = create_bundle(str(tmp_path/'bundle'))
+    append_columns(path, peaks=np.ones((2, 3)))
+    with pytest.raises(ValueError):
+        append_columns(path, peaks=np.ones((2, 4)))
+    with pytest.raises(ValueError):
+        append_columns(path, peaks=np.ones((2, 3), np.int64))
+    assert load_bundle(path)['peaks'].shape == (2, 3)
+
+
+def test_create_bundle_empties_the_columns(tmp_path):
+    path = create_bundle(str(tmp_path/'bundle'))
+    append_columns(path, x=[1., 2.])
+    create_bundle(path, dict(title='again'))
+    assert load_bundle(path) == dict(meta=dict(title='again'))
+
+
+@pytest.mark.parametrize('pieces', [1, 4])
+def test_traces_round_trip(tmp_path, pieces):
+    path = create_bundle(str(tmp_path/'bundle'))
+    lengths = [401, 17, 1200]
+    write_traces(path, lengths, pieces)
+
+    assert np.array_equal(load_bundle(path)['trace_length'], lengths)
+    traces = list(iter_traces(path))
+    assert len(traces) == len(lengths)
+    for n, (trace, length) in enumerate(zip(traces, lengths)):
+        for name, x in zip(('t', 'v', 'dens', 'g'), sweep_trace(n, length)):
+            assert np.array_equal(trace[name], x)
+
+
+def test_copy_traces_in_chunks(tmp_path):
+    source = create_bundle(str(tmp_path/'source'))
+    write_traces(source, [401, 17, 1200], pieces=3)
+    path = create_bundle(str(tmp_path/'copy'))
+    write_traces(path, [5])
+    copy_traces(path, source, rows=100)
+
+    assert np.array_equal(load_bundle(path)['trace_length'], [5, 401, 17, 1200])
+    copied = list(iter_traces(path))[1:]
+    for trace, expected in zip(copied, iter_traces(source)):
+        for name in ('t', 'v', 'dens', 'g'):
+            assert np.array_equal(trace[name], expected[name])
+
+
+def test_bundle_without_traces(tmp_path):
+    path = create_bundle(str(tmp_path/'bundle'))
+    assert list(iter_traces(path)) == []
+    copy_traces(path, path)
+    assert 'trace_length' not in load_bundle(path)
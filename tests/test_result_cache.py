@@ -0,0 +1,109 @@
+# Tests of the cache of protocol results (result_cache.py): a rerun reads every sweep from the cache,
+# a grid overlapping one already run computes only the new values, and other settings give other keys.
+
+import os
+
+import numpy as np
+
+from protocols import protocol, target_protocol, exact_peaks, batch_protocol
+from result_bundle import create_bundle, append_trace, load_bundle, iter_traces
+from result_cache import cached_peaks, cache_entries, evict, sweep_key, source_files, package_dir
+
+
+def sweep_traces(traces):
+    """Traces of batch_protocol, one dict per sweep without the NaN padding."""
+
+    t = np.broadcast_to(traces['t'], traces['v'].shape)
+    for n in range(len(t)):
+        inside = ~np.isnan(traces['v'][n])
+        yield dict((name, np.array(x[n][inside])) for name, x in dict(traces, t=t).items())
+
+
+class Counting:
+    """compute() of cached_peaks with the exact engine, remembering the sweep values it was given."""
+
+    def __init__(self):
+        self.values = []
+
+    def __call__(self, q, bundle):
+        self.values.extend(q['sweep'])
+        if bundle is not None:
+            x, y, traces = batch_protocol(q)
+            for trace in sweep_traces(traces):
+                append_trace(bundle, trace['t'], trace['v'], trace['ina'], trace['g'])
+        return exact_peaks(q)
+
+
+def test_rerun_reads_the_cache(tmp_path):
+    compute = Counting()
+    ipeak, gpeak, computed = cached_peaks(3, dict(backend='exact'), compute, cache_dir=str(tmp_path))
+    assert computed == len(protocol(3)['sweep'])
+    assert len(cache_entries(str(tmp_path))) == computed
+    assert np.array_equal((ipeak, gpeak), exact_peaks(3))
+
+    compute.values = []
+    again = cached_peaks(3, dict(backend='exact'), compute, cache_dir=str(tmp_path))
+    assert again[2] == 0 and compute.values == []
+    assert np.array_equal(again[0], ipeak) and np.array_equal(again[1], gpeak)
+
+
+def test_overlapping_grid_computes_the_new_values(tmp_path):
+    x = np.asarray(protocol(3)['sweep'])
+    cached_peaks(target_protocol(3, x[::2]), dict(backend='exact'), Counting(), cache_dir=str(tmp_path))
+
+    compute = Counting()
+    ipeak, gpeak, computed = cached_peaks(3, dict(backend='exact'), compute, cache_dir=str(tmp_path))
+    assert computed == len(x[1::2])
+    assert np.array_equal(compute.values, x[1::2])
+    assert np.array_equal((ipeak, gpeak), exact_peaks(3))
+
+
+def test_settings_change_the_keys():
+    p = protocol(3)
+    x = p['sweep'][0]
+    keys = set(sweep_key(p, x, settings) for settings in
+               (dict(backend='exact'), dict(backend='exact', dt=0.01), dict(backend='batch')))
+    assert len(keys) == 3
+    assert sweep_key(p, x, dict(backend='exact')) == sweep_key(target_protocol(3, [x]), x, dict(backend='exact'))
+    assert sweep_key(p, x, dict(backend='exact')) != sweep_key(p, p['sweep'][1], dict(backend='exact'))
+
+
+def test_sources_of_the_results():
+    names = source_files()
+    assert all(os.path.isfile(os.path.join(package_dir, name)) for name in names)
+    assert {'Na15.mod', 'Na15k.mod', 'na15_kinetics.py', 'protocols.py', 'neuron_record.py'} <= set(names)
+    assert not {'benchmark.py', 'rate_fitting.py', 'compare_mechanisms.py', '3_f_inact_rec_static.py'} & set(names)
+
+
+def test_cached_traces(tmp_path):
+    x = np.asarray(protocol(4)['sweep'])[:6]
+    cached_peaks(target_protocol(4, x[:3]), dict(backend='batch'), Counting(), cache_dir=str(tmp_path),
+                 bundle=create_bundle(str(tmp_path/'first')))
+
+    compute = Counting()
+    bundle = create_bundle(str(tmp_path/'second'))
+    computed = cached_peaks(target_protocol(4, x), dict(backend='batch'), compute, cache_dir=str(tmp_path), bundle=bundle)[2]
+    assert computed == 3 and np.array_equal(compute.values, x[3:])
+
+    assert len(load_bundle(bundle)['trace_length']) == len(x)
+    for trace, expected in zip(iter_traces(bundle), sweep_traces(batch_protocol(target_protocol(4, x))[2])):
+        assert np.array_equal(trace['v'], expected['v']) and np.array_equal(trace['dens'], expected['ina'])
+
+    # entries without traces are computed again when the traces are asked for
+    compute = Counting()
+    cached_peaks(target_protocol(4, x[:2]), dict(backend='exact'), Counting(), cache_dir=str(tmp_path))
+    cached_peaks(target_protocol(4, x[:2]), dict(backend='exact'), compute, cache_dir=str(tmp_path),
+                 bundle=create_bundle(str(tmp_path/'third')))
+    assert np.array_equal(compute.values, x[:2])
+
+
+def test_evict_removes_the_least_recently_used(tmp_path):
+    cached_peaks(3, dict(backend='exact'), Counting(), cache_dir=str(tmp_path))
+    entries = sorted(cache_entries(str(tmp_path)), key=lambda entry: entry[2])
+    for k, (mtime, size, path) in enumerate(entries):
+        os.utime(path, (1e9+k, 1e9+k))
+    size = sum(entry[1] for entry in entries[-2:])
+
+    assert evict(str(tmp_path), size) == len(entries)-2
+    assert sorted(entry[2] for entry in cache_entries(str(tmp_path))) == [entry[2] for entry in entries[-2:]]
+    assert evict(str(tmp_path), size) == 0
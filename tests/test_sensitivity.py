@@ -0,0 +1,43 @@
+# Tests of the exact parameter sensitivities of the protocol curves (na15_sensitivity.py) against
+# central finite differences of exact_protocol.
+
+import numpy as np
+import pytest
+
+from na15_kinetics import na15_parameters, exact_clamp
+from na15_sensitivity import protocol_sensitivity, exact_clamp_sensitivity
+from protocols import exact_protocol
+
+
+def finite_difference(number, name, step):
+    value = na15_parameters[name]
+    up = exact_protocol(number, params={name: value+step})[1]
+    down = exact_protocol(number, params={name: value-step})[1]
+    return (up-down)/(2*step)
+
+
+@pytest.mark.parametrize('number, name', [(3, 'I1C1v1'), (3, 'I1C1b1'), (1, 'C1I1b2'), (2, 'C1I1b2'), (2, 'I1I2b2')])
+def test_protocol_sensitivity_matches_finite_differences(number, name):
+    r = protocol_sensitivity(number, names=(name,))
+    assert np.abs(r['y']-exact_protocol(number)[1]).max() < 1e-12
+    fd = finite_difference(number, name, 1e-5*abs(na15_parameters[name]))
+    assert np.abs(fd).max() > 1e-3      # a parameter the curve does depend on
+    assert np.abs(r['jacobian'][:, 0]-fd).max() < 1e-5*np.abs(fd).max()
+
+
+def test_relative_sensitivity_is_scaled_by_the_parameter():
+    absolute = protocol_sensitivity(3, names=('I1C1v1', 'I1C1b1'))
+    relative = protocol_sensitivity(3, names=('I1C1v1', 'I1C1b1'), relative=True)
+    assert np.allclose(relative['jacobian'], absolute['jacobian']*absolute['values'], rtol=1e-14, atol=0)
+
+
+def test_exact_clamp_sensitivity_matches_finite_differences():
+    segments = [(5, -120), (2, -10), (20, -120), (3, -10)]
+    t = np.linspace(0, 30, 61)
+    name, step = 'I1C1v1', 1e-4
+    t, v, x, ina, dx, dina = exact_clamp_sensitivity(segments, -120, 24, t, names=(name,))
+    up = exact_clamp(segments, -120, 24, t, params={name: na15_parameters[name]+step})
+    down = exact_clamp(segments, -120, 24, t, params={name: na15_parameters[name]-step})
+    assert np.abs(x-exact_clamp(segments, -120, 24, t)[2]).max() < 1e-12
+    assert np.abs(dx[:, :, 0]-(up[2]-down[2])/(2*step)).max() < 1e-8
+    assert np.abs(dina[:, 0]-(up[3]-down[3])/(2*step)).max() < 1e-8
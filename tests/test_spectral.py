@@ -0,0 +1,28 @@
+# Tests of the closed-form recovery/onset curves (spectral_protocol, interval_scan of na15_kinetics.py)
+# against the exact engine, sweep by sweep.
+
+import numpy as np
+import pytest
+
+from protocols import protocol, target_protocol, exact_protocol, exact_peaks, spectral_protocol, spectral_peaks
+
+
+@pytest.mark.parametrize('number', [3, 4, 5])
+def test_spectral_equals_exact(number):
+    x, y = spectral_protocol(number)
+    assert np.array_equal(x, exact_protocol(number)[0])
+    assert np.abs(y-exact_protocol(number)[1]).max() < 1e-10
+    for spectral, exact in zip(spectral_peaks(number), exact_peaks(number)):
+        assert np.abs(spectral-exact).max() < 1e-10*np.abs(exact).max()
+
+
+def test_intervals_off_the_sweep():
+    intervals = np.array([0.3, 1.7, 12.345, 250.])
+    ratio = spectral_protocol(3, intervals)[1]
+    assert np.abs(ratio-exact_protocol(target_protocol(3, intervals))[1]).max() < 1e-10
+
+
+def test_amplitude_sweeps_are_refused():
+    assert protocol(1)['sweep_level'][0] == 'amp'
+    with pytest.raises(ValueError):
+        spectral_protocol(1)
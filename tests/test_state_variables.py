@@ -0,0 +1,70 @@
+# Tests of the equilibrium states (state_variables.py): the scalar path against the batched solve, and the
+# LRU cache of solutions (hits, eviction of the least recently used, keys that differ by parameters).
+
+import numpy as np
+import pytest
+
+import state_variables
+from state_variables import finding_state_variables, steady_states, solve_state_variables
+from na15_kinetics import rate_matrix
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(state_variables, '_cache', state_variables.OrderedDict())
+    monkeypatch.setattr(state_variables, 'cache_size', 4)
+    return state_variables._cache
+
+
+def test_scalar_path_matches_the_batched_solve(cache):
+    v = np.array([-120., -70., -20., 30.])
+    for celsius, params in ((24., None), (37., dict(O1I1b1=5, C2O1v2=-30))):
+        batched = solve_state_variables(v, np.full_like(v, celsius), params)
+        for vi, expected in zip(v, batched):
+            x = steady_states(vi, celsius, params)
+            assert np.allclose(x, expected, rtol=1e-12, atol=1e-15)
+            assert np.isclose(x.sum(), 1) and np.abs(rate_matrix(vi, celsius, params) @ x).max() < 1e-15
+
+    states = finding_state_variables(-120, 24)
+    assert all(type(value) is float for value in states)
+    assert np.array_equal(states, steady_states(-120, 24))
+    assert np.array_equal(np.moveaxis(finding_state_variables(v, 24), 0, -1), steady_states(v, 24))
+
+
+def test_hits_return_the_cached_solution(cache, monkeypatch):
+    solved = []
+    scalar = state_variables.scalar_state_variables
+    monkeypatch.setattr(state_variables, 'scalar_state_variables',
+                        lambda *args: solved.append(args[:2]) or scalar(*args))
+
+    first = steady_states(-120, 24)
+    first[:] = 0                                # the result is a copy: the cached solution is kept
+    again = steady_states(-120., 24.)
+    assert solved == [(-120., 24.)] and len(cache) == 1
+    assert np.array_equal(again, finding_state_variables(-120, 24)) and again.sum() > 0
+
+    steady_states([-120., -100.], 24)           # the batched path reads the same entries
+    assert solved == [(-120., 24.)] and len(cache) == 2
+
+
+def test_least_recently_used_are_evicted(cache):
+    for v in (-120, -110, -100, -90):
+        finding_state_variables(v, 24)
+    finding_state_variables(-120, 24)           # used again: -110 is now the least recently used
+    finding_state_variables(-80, 24)
+    assert [key[0] for key in cache] == [-100., -90., -120., -80.]
+
+    steady_states(np.array([-70., -60.]), 24)
+    assert len(cache) == 4 and [key[0] for key in cache] == [-120., -80., -70., -60.]
+
+
+def test_parameters_change_the_keys(cache):
+    default = steady_states(-60, 24)
+    changed = steady_states(-60, 24, dict(O1I1b1=4))
+    assert len(cache) == 2 and not np.allclose(default, changed)
+    assert np.array_equal(steady_states(-60, 24, {}), default)                  # no change: the default key
+    assert np.array_equal(steady_states(-60, 24, dict(O1I1b1=4.0)), changed)
+    assert len(cache) == 2
+
+    both = steady_states(-60, 24, [None, dict(O1I1b1=4)])
+    assert np.array_equal(both, [default, changed]) and len(cache) == 2
@@ -0,0 +1,46 @@
+# Tests of the stochastic engine (na15_stochastic.py): reproducibility, the ensemble mean of the current
+# against the deterministic current of exact_clamp, within the statistical error, and the P2/P1 ratio
+# when some trials have no P1 peak.
+
+import numpy as np
+import pytest
+
+from na15_kinetics import exact_clamp
+from na15_stochastic import stochastic_clamp
+
+segments = [(2, -120), (3, -10), (2, -120), (3, -10)]
+windows = [(1, 0, 3), (3, 0, 3)]
+
+
+@pytest.mark.parametrize('method, n_channels', [('gillespie', 20), ('binomial', 500)])
+def test_mean_current_is_the_exact_current(method, n_channels):
+    r = stochastic_clamp(segments, -120, 24, n_channels, 4000, 0.05, method, windows, seed=1)
+    assert r['method'] == method and r['trials'] == 4000
+    ina = exact_clamp(segments, -120, 24, r['t'])[3]
+    error = np.sqrt(r['var']/r['trials'])
+    assert np.all(np.abs(r['mean']-ina) <= 5*error+1e-4*np.abs(ina).max())     # + openings too rare to be seen at -120 mV
+    assert np.abs(r['mean']-ina).max() > 0
+
+
+def test_seed_reproduces_the_run():
+    runs = [stochastic_clamp(segments, -120, 24, 50, 500, 0.05, windows=windows, seed=7) for k in range(2)]
+    for key in ('mean', 'var', 'ipeak_mean', 'gpeak_var', 'ratio_mean'):
+        assert np.array_equal(runs[0][key], runs[1][key])
+    other = stochastic_clamp(segments, -120, 24, 50, 500, 0.05, windows=windows, seed=8)
+    assert not np.array_equal(runs[0]['mean'], other['mean'])
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        stochastic_clamp(segments, -120, 24, 50, 10, 0.05, method='tau-leap')
+
+
+def test_trials_without_a_p1_peak_are_left_out_of_the_ratio():
+    r = stochastic_clamp(segments, -120, 24, 1, 2000, 0.05, 'gillespie', windows, seed=3)
+    assert 0 < r['ratio_dropped'] < r['trials']
+    assert np.isfinite(r['ratio_mean']) and np.isfinite(r['ratio_var'])
+    assert 0 <= r['ratio_mean'] <= 1                    # one channel at the same voltage: P2/P1 is 0 or 1
+
+    closed = stochastic_clamp([(2, -120), (3, -120), (2, -120), (3, -10)], -120, 24, 1, 200, 0.05, 'gillespie',
+                              windows, seed=3)
+    assert closed['ratio_dropped'] == 200 and np.isnan(closed['ratio_mean']) and np.isnan(closed['ratio_var'])
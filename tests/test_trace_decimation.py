@@ -0,0 +1,55 @@
+# Tests of the decimation of traces (trace_decimation.py): the min/max envelope of every bin, the samples
+# at the clamp-level boundaries and inside the measurement windows, and traces too short to decimate.
+
+import numpy as np
+import pytest
+
+from trace_decimation import decimate_trace, envelope_indices
+from peak_analysis import window_mask
+
+dt = 0.025
+t = np.arange(4000)*dt                                  # 0 to 100 ms
+level_starts = [0., 10., 60.3, 80.1]
+windows = [(1, 0, 5)]
+v = np.select([t < 10, t < 60.3, t < 80.1], [-120., -20., -120.], -60.)
+rng = np.random.default_rng(0)
+dens = -np.exp(-(t-10)/2)*(t >= 10)+1e-3*rng.standard_normal(len(t))    # transient and noise
+
+
+def bin_of(n_bins):
+    return np.minimum((t*n_bins/t[-1]).astype(int), n_bins-1)
+
+
+@pytest.mark.parametrize('n_bins', [10, 37, 200])
+def test_min_and_max_of_every_bin_are_kept(n_bins):
+    keep = decimate_trace(t, v, dens, n_bins, level_starts, windows)
+    assert len(keep) < len(t) and np.all(np.diff(keep) > 0)
+    bins = bin_of(n_bins)
+    for b in range(n_bins):
+        inside, kept = bins == b, keep[bins[keep] == b]
+        for y in (v, dens):
+            assert y[kept].min() == y[inside].min() and y[kept].max() == y[inside].max()
+    assert keep[0] == 0 and keep[-1] == len(t)-1
+
+
+def test_envelope_only_keeps_the_extremes():
+    keep = envelope_indices(t, (dens,), 50)
+    assert len(keep) <= 2*50+2
+
+
+def test_level_boundaries_and_windows_are_kept():
+    keep = decimate_trace(t, v, dens, 20, level_starts, windows)
+    for start in level_starts[1:]:
+        first = np.searchsorted(t, start)                       # the first sample of the level
+        assert {first-1, first} <= set(keep)
+        assert v[first-1] != v[first]                           # the step is drawn between two kept samples
+    inside = np.flatnonzero(window_mask(t, np.atleast_2d(level_starts), windows[0])[0])
+    assert set(inside) <= set(keep)                             # with the first and last samples inside
+    assert np.isclose(t[inside[0]], 10+dt) and np.isclose(t[inside[-1]], 15)
+
+
+def test_short_traces_are_unchanged():
+    for n_bins in (len(t), 2*len(t), None):
+        assert np.array_equal(decimate_trace(t, v, dens, n_bins, level_starts, windows), np.arange(len(t)))
+    short = slice(0, 30)
+    assert np.array_equal(decimate_trace(t[short], v[short], dens[short], 10, level_starts, windows), np.arange(30))
@@ -0,0 +1,47 @@
+# The following script contains the decimation stage between the recorded traces and their consumers
+# (plots, saved traces): 'decimate_trace(t, v, dens, n_bins)' returns the indices of the samples to keep
+# so that, in each of n_bins equal time bins (about one per pixel of the figure), the minimum and the
+# maximum of v and of dens are kept: the decimated trace draws the same envelope as the full one,
+# with at most ~4 n_bins points whatever the simulated duration and dt. The samples inside the
+# measurement windows (see peak_analysis.py) are all kept, so that the peaks are exact, and so are the
+# two samples on either side of each clamp-level boundary, so that the steps of v stay vertical.
+
+import numpy as np
+
+from peak_analysis import window_mask
+
+dtype = np.float64
+
+
+def envelope_indices(t, columns, n_bins, t_range=None):
+    """Sorted indices of the first and last samples and of the minimum and maximum of each column
+    in each of n_bins equal bins of t_range (default: from t[0] to t[-1]). t must be increasing."""
+
+    t = np.asarray(t, dtype)
+    if n_bins is None or len(t) <= 2*n_bins*len(columns)+2:
+        return np.arange(len(t))
+    t0, t1 = (t[0], t[-1]) if t_range is None else t_range
+    bins = np.clip(((t-t0)*(n_bins/max(t1-t0, np.finfo(dtype).tiny))).astype(np.int64), 0, n_bins-1)
+
+    keep = [np.array([0, len(t)-1])]
+    for y in columns:
+        order = np.lexsort((y, bins))       # by bin, then by value within the bin
+        first = np.r_[True, bins[order][1:] != bins[order][:-1]]
+        last = np.r_[first[1:], True]
+        keep += [order[first], order[last]]
+    return np.unique(np.concatenate(keep))
+
+
+def decimate_trace(t, v, dens, n_bins, level_starts=None, windows=(), t_range=None):
+    """Indices of the samples of a trace to keep: min/max envelope of v and dens over n_bins time
+    bins plus every sample inside the measurement windows (so peaks and their time course are exact)
+    and the last sample before and the first one from each of level_starts; every sample if n_bins
+    is None."""
+
+    keep = envelope_indices(t, (v, dens), n_bins, t_range)
+    if len(keep) < len(t) and level_starts is not None:
+        edges = np.searchsorted(t, np.ravel(level_starts))
+        keep = np.union1d(keep, np.clip(np.concatenate([edges-1, edges]), 0, len(t)-1))
+        for window in windows:
+            keep = np.union1d(keep, np.flatnonzero(window_mask(t, np.atleast_2d(level_starts), window)[0]))
+    return keep
@@ -0,0 +1,84 @@
+COMMENT
+Voltage clamp with "five" levels that works with CVODE as well as with the fixed step. It has the
+dur/amp interface of VClamp_plus (vclmp_pl.mod): the clamp is on at time 0, holds amp[j] during
+dur[j] (levels with dur[j] = 0 are skipped) and is off after dur[0]+...+dur[4], when the injected
+current is 0.
+
+The amplifier of VClamp_plus (gain, tau1, tau2 and a LINEAR block solved inside the fixed step)
+cannot be integrated by CVODE. Here the command potential vc drives the cell through the series
+resistance rs, as SEClamp does:
+
+	i = (vc - v)/rs
+
+which is an ideal voltage source in the limit rs -> 0 (the default 1e-4 megohm clamps the soma of
+the scripts within about 0.02 mV at the largest sodium current). The current is an algebraic
+function of v, so CVODE integrates it with the cell, and the step changes of vc are not seen as
+discontinuities of the right-hand side: each level change is a self-event (net_send) delivered at
+the exact time the level begins, at which CVODE stops and reinitializes. With the fixed step the
+events are delivered on the time grid.
+
+Since this is an electrode current model v refers to the internal potential (v+vext when the
+extracellular mechanism is present), and positive values of i depolarize the cell.
+ENDCOMMENT
+
+DEFINE NSTEP 5
+
+NEURON {
+	POINT_PROCESS VClamp_cvode
+	ELECTRODE_CURRENT i
+	RANGE dur, amp, rs, vc, i, level
+	THREADSAFE
+}
+
+UNITS {
+	(nA) = (nanoamp)
+	(mV) = (millivolt)
+}
+
+PARAMETER {
+	dur[NSTEP] (ms)		<0, 1e9>
+	amp[NSTEP] (mV)
+	rs = 1e-4 (megohm)	<1e-9, 1e9>
+}
+
+ASSIGNED {
+	v (mV)		: automatically v + vext when extracellular is present
+	i (nA)
+	vc (mV)		: command potential of the current level
+	level		: current level, NSTEP when the clamp is off
+}
+
+INITIAL {
+	level = next_level(-1)
+	if (level < NSTEP) {
+		vc = amp[level]
+		net_send(dur[level], 1)
+	}
+}
+
+BREAKPOINT {
+	if (level < NSTEP) {
+		i = (vc - v)/rs
+	}else{
+		i = 0
+	}
+}
+
+FUNCTION next_level(j) {	: first level after j with a positive duration (NSTEP: none)
+	LOCAL k
+	k = j + 1
+	while (k < NSTEP && dur[k] <= 0) {
+		k = k + 1
+	}
+	next_level = k
+}
+
+NET_RECEIVE(w) {
+	if (flag == 1) {	: end of the current level
+		level = next_level(level)
+		if (level < NSTEP) {
+			vc = amp[level]
+			net_send(dur[level], 1)
+		}
+	}
+}
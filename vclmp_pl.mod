@@ -41,6 +41,11 @@ Note that since this is an electrode current model v refers to the
 internal potential which is equivalent to the membrane potential v when
 there is no extracellular membrane mechanism present but is v+vext when
 one is present.
+
+The model is THREADSAFE (ParallelContext.nthread): the level stim and the end tc of the
+current level are RANGE variables, since update() (after the solve) computes the current of each
+instance from the values its vstim() set in the BREAKPOINT, and the VERBATIM blocks only read
+cvode_active_ and leave the loop of vstim() or update().
 Also since i is an electrode current,
 positive values of i depolarize the cell. (Normally, positive membrane currents
 are outward and thus hyperpolarize the cell)
@@ -52,6 +57,8 @@ NEURON {
 	POINT_PROCESS VClamp_plus
 	ELECTRODE_CURRENT i
 	RANGE e0,vo0,vi0,dur,amp,gain,rstim,tau1,tau2,fac,i
+	RANGE stim,tc
+	THREADSAFE
 }
 
 UNITS {
@@ -138,19 +145,24 @@ FUNCTION icur()(nA) {  : since this function uses range variables, it
 		vo0 = 0
 		icur = 0
 	}else{
-		SOLVE clamp
+		clamp()
 		icur = (vo - v)/rstim
 	}
 }
 
-LINEAR clamp {
+PROCEDURE clamp() {
+	: the linear system
+	:   vi = v + fac*vo - fac*v
+	:   t2*vo - t2*vo0 + vo = -gain * e
+	:   -stim - e  +  vi - e  +  t1*vi - t1*e - t1*(vi0 - e0) = 0
+	: solved for e, vo and vi (a LINEAR block is not thread safe)
 	LOCAL t1, t2
 	t1 = tau1/dt
 	t2 = tau2/dt
-	~ vi = v + fac*vo - fac*v
-	~ t2*vo - t2*vo0 + vo = -gain * e
-	~ -stim - e  +  vi - e  +  t1*vi - t1*e - t1*(vi0 - e0)
-	  = 0
+	e = ((1 + t1)*(v - fac*v + fac*t2*vo0/(1 + t2)) - stim - t1*(vi0 - e0))
+	    / (2 + t1 + (1 + t1)*fac*gain/(1 + t2))
+	vo = (t2*vo0 - gain*e)/(1 + t2)
+	vi = v + fac*vo - fac*v
 }
 
 PROCEDURE update() {